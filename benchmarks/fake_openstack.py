@@ -0,0 +1,534 @@
+"""Local stand-in for the Keystone and Cinder APIs used by cinder-snapshooter
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import datetime
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+import wsgiref.simple_server
+
+from typing import Dict, List, Optional
+
+
+USER_ID = "0123456789abcdef0123456789abcdef"
+USER_NAME = "snapshooter"
+PASSWORD = "benchmark"
+HOME_PROJECT = "home"
+MAX_LIMIT = 1000  # osapi_max_limit of Cinder
+RESOURCE_ID = re.compile(r"[0-9a-fA-F]{8}-?(?:[0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}")
+STATUSES = {
+    200: "200 OK",
+    201: "201 Created",
+    202: "202 Accepted",
+    300: "300 Multiple Choices",
+    400: "400 Bad Request",
+    401: "401 Unauthorized",
+    403: "403 Forbidden",
+    404: "404 Not Found",
+    500: "500 Internal Server Error",
+}
+
+
+def _timestamp(moment: datetime.datetime) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str = ""):
+        super().__init__(message)
+        self.status = status
+        self.message = message or STATUSES[status]
+
+
+class FakeOpenStack:
+    """Keystone and Cinder v3 keeping their inventory in memory
+
+    The user is a member of projects - trusted of them through a trust - each
+    with volumes_per_project volumes, largest has that many volumes instead
+    for the first project. enrolled is the share of volumes enrolled to
+    automatic snapshots, each having snapshot_days daily automatic snapshots
+    expiring after a week. Every request takes latency seconds, snapshots take
+    transition_delay seconds to be created or deleted and end up in error with
+    snapshot_error_rate. api_error_rate of the block storage requests fail with
+    an HTTP 500.
+    """
+
+    def __init__(
+        self,
+        projects: int = 10,
+        volumes_per_project: int = 10,
+        largest: Optional[int] = None,
+        enrolled: float = 0.5,
+        snapshot_days: int = 10,
+        trusted: float = 0.0,
+        latency: float = 0.0,
+        transition_delay: float = 0.0,
+        snapshot_error_rate: float = 0.0,
+        api_error_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.enrolled = enrolled
+        self.latency = latency
+        self.transition_delay = transition_delay
+        self.snapshot_error_rate = snapshot_error_rate
+        self.api_error_rate = api_error_rate
+        self.base_url = None
+        self.calls = collections.Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._trusts = {}
+        self._projects = collections.OrderedDict()
+        self._volumes = collections.OrderedDict()
+        self._snapshots = collections.OrderedDict()
+        self._pending = {}
+
+        now = datetime.datetime.utcnow()
+        for index in range(projects):
+            project_id = uuid.UUID(int=self._random.getrandbits(128)).hex
+            self._projects[project_id] = {
+                "id": project_id,
+                "name": f"project-{index}",
+                "domain_id": "default",
+                "enabled": True,
+            }
+            if self._random.random() < trusted:
+                trust_id = uuid.UUID(int=self._random.getrandbits(128)).hex
+                self._trusts[trust_id] = {
+                    "id": trust_id,
+                    "project_id": project_id,
+                    "trustee_user_id": USER_ID,
+                    "trustor_user_id": uuid.UUID(int=index).hex,
+                    "impersonation": False,
+                    "roles": [{"name": "member"}],
+                }
+            count = largest if index == 0 and largest else volumes_per_project
+            for _ in range(count):
+                volume = self._add_volume(project_id)
+                if volume["metadata"]:
+                    for days in range(1, snapshot_days + 1):
+                        self._add_snapshot(volume, now - datetime.timedelta(days=days))
+
+    def _new_id(self) -> str:
+        return str(uuid.UUID(int=self._random.getrandbits(128)))
+
+    def _add_volume(self, project_id: str) -> dict:
+        volume_id = self._new_id()
+        metadata = {}
+        if self._random.random() < self.enrolled:
+            metadata["automatic_snapshots"] = "true"
+        volume = {
+            "id": volume_id,
+            "name": f"volume-{volume_id[:8]}",
+            "status": self._random.choice(["available", "in-use"]),
+            "size": 10,
+            "volume_type": self._random.choice(["ssd", "hdd"]),
+            "metadata": metadata,
+            "os-vol-tenant-attr:tenant_id": project_id,
+            "created_at": _timestamp(datetime.datetime(2021, 1, 1)),
+            "attachments": [],
+            "bootable": "false",
+        }
+        self._volumes[volume_id] = volume
+        return volume
+
+    def _add_snapshot(
+        self, volume: dict, created_at: datetime.datetime, metadata: dict = None
+    ) -> dict:
+        if metadata is None:
+            expire_at = created_at + datetime.timedelta(days=7)
+            metadata = {"expire_at": expire_at.date().isoformat()}
+        snapshot = {
+            "id": self._new_id(),
+            "name": None,
+            "description": "Automatic daily snapshot",
+            "status": "available",
+            "size": volume["size"],
+            "volume_id": volume["id"],
+            "metadata": metadata,
+            "os-extended-snapshot-attributes:project_id": volume[
+                "os-vol-tenant-attr:tenant_id"
+            ],
+            "created_at": _timestamp(created_at),
+            "updated_at": None,
+        }
+        self._snapshots[snapshot["id"]] = snapshot
+        return snapshot
+
+    def reset_calls(self) -> Dict[str, int]:
+        """Return the API calls counted per operation and start counting again"""
+        with self._lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    @property
+    def snapshot_count(self) -> int:
+        return len(self._snapshots)
+
+    # WSGI
+
+    def __call__(self, environ, start_response):
+        method = environ["REQUEST_METHOD"]
+        path = environ["PATH_INFO"]
+        query = urllib.parse.parse_qs(environ.get("QUERY_STRING", ""))
+        query = {name: values[-1] for name, values in query.items()}
+        body = None
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        if length:
+            body = json.loads(environ["wsgi.input"].read(length))
+        headers = {}
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with self._lock:
+                self.calls[self._operation(method, path)] += 1
+                if path.startswith("/identity"):
+                    status, payload = self._identity(
+                        method, path[len("/identity") :], query, body, environ, headers
+                    )
+                elif path.startswith("/volume"):
+                    status, payload = self._block_storage(
+                        method, path[len("/volume") :], query, body, environ
+                    )
+                else:
+                    raise HTTPError(404)
+        except HTTPError as err:
+            status = err.status
+            payload = {"error": {"code": err.status, "message": err.message}}
+        content = b"" if payload is None else json.dumps(payload).encode()
+        headers["Content-Type"] = "application/json"
+        headers["Content-Length"] = str(len(content))
+        start_response(STATUSES[status], list(headers.items()))
+        return [content]
+
+    @staticmethod
+    def _operation(method: str, path: str) -> str:
+        segments = [
+            "{id}" if RESOURCE_ID.fullmatch(segment) else segment
+            for segment in path.rstrip("/").split("/")
+        ]
+        return f"{method} {'/'.join(segments) or '/'}"
+
+    # Keystone
+
+    def _identity_version(self) -> dict:
+        return {
+            "id": "v3.14",
+            "status": "stable",
+            "updated": "2020-04-07T00:00:00Z",
+            "links": [{"rel": "self", "href": f"{self.base_url}/identity/v3/"}],
+            "media-types": [
+                {
+                    "base": "application/json",
+                    "type": "application/vnd.openstack.identity-v3+json",
+                }
+            ],
+        }
+
+    def _identity(self, method, path, query, body, environ, headers):
+        path = path.rstrip("/")
+        if method == "GET" and path == "":
+            return 300, {"versions": {"values": [self._identity_version()]}}
+        if method == "GET" and path == "/v3":
+            return 200, {"version": self._identity_version()}
+        if method == "POST" and path == "/v3/auth/tokens":
+            token, payload = self._issue_token(body["auth"])
+            headers["X-Subject-Token"] = token
+            return 201, payload
+        scope = self._scope(environ)
+        if method == "GET" and path == "/v3/OS-TRUST/trusts":
+            trustee = query.get("trustee_user_id")
+            trusts = [
+                trust
+                for trust in self._trusts.values()
+                if trustee is None or trust["trustee_user_id"] == trustee
+            ]
+            return 200, {"trusts": trusts, "links": self._links(path)}
+        if method == "GET" and path == f"/v3/users/{USER_ID}/projects":
+            if scope["user_id"] != USER_ID:
+                raise HTTPError(403)
+            trusted = {trust["project_id"] for trust in self._trusts.values()}
+            projects = [
+                project
+                for project in self._projects.values()
+                if project["id"] not in trusted
+            ]
+            projects.append(self._home_project())
+            return 200, {"projects": projects, "links": self._links(path)}
+        raise HTTPError(404)
+
+    def _links(self, path: str) -> dict:
+        return {"self": f"{self.base_url}/identity{path}", "next": None}
+
+    @staticmethod
+    def _home_project() -> dict:
+        return {
+            "id": HOME_PROJECT,
+            "name": HOME_PROJECT,
+            "domain_id": "default",
+            "enabled": True,
+        }
+
+    def _issue_token(self, auth: dict):
+        user = auth["identity"]["password"]["user"]
+        if user.get("name", USER_NAME) != USER_NAME or user["password"] != PASSWORD:
+            raise HTTPError(401)
+        scope = auth.get("scope") or {}
+        trust_id = None
+        if "OS-TRUST:trust" in scope:
+            trust_id = scope["OS-TRUST:trust"]["id"]
+            if trust_id not in self._trusts:
+                raise HTTPError(404, "Trust not found")
+            project_id = self._trusts[trust_id]["project_id"]
+        elif "project" in scope:
+            project_id = scope["project"].get("id") or scope["project"].get("name")
+            if project_id not in self._projects and project_id != HOME_PROJECT:
+                raise HTTPError(401)
+        else:
+            project_id = None
+        token = uuid.uuid4().hex
+        self._tokens[token] = {"user_id": USER_ID, "project_id": project_id}
+        now = datetime.datetime.utcnow()
+        payload = {
+            "methods": ["password"],
+            "user": {
+                "id": USER_ID,
+                "name": USER_NAME,
+                "domain": {"id": "default", "name": "Default"},
+            },
+            "issued_at": now.isoformat() + "Z",
+            "expires_at": (now + datetime.timedelta(hours=12)).isoformat() + "Z",
+            "audit_ids": [token[:22]],
+        }
+        if project_id is not None:
+            project = self._projects.get(project_id) or self._home_project()
+            payload["project"] = {
+                "id": project["id"],
+                "name": project["name"],
+                "domain": {"id": "default", "name": "Default"},
+            }
+            payload["roles"] = [{"id": "member", "name": "member"}]
+            payload["catalog"] = self._catalog(project_id)
+        if trust_id is not None:
+            payload["OS-TRUST:trust"] = {
+                "id": trust_id,
+                "impersonation": False,
+                "trustee_user": {"id": USER_ID},
+                "trustor_user": {"id": self._trusts[trust_id]["trustor_user_id"]},
+            }
+        return token, {"token": payload}
+
+    def _catalog(self, project_id: str) -> List[dict]:
+        def service(service_type, name, url):
+            return {
+                "id": name,
+                "type": service_type,
+                "name": name,
+                "endpoints": [
+                    {
+                        "id": f"{name}-public",
+                        "interface": "public",
+                        "region": "RegionOne",
+                        "region_id": "RegionOne",
+                        "url": url,
+                    }
+                ],
+            }
+
+        return [
+            service("identity", "keystone", f"{self.base_url}/identity"),
+            service(
+                "block-storage", "cinderv3", f"{self.base_url}/volume/v3/{project_id}"
+            ),
+        ]
+
+    def _scope(self, environ) -> dict:
+        scope = self._tokens.get(environ.get("HTTP_X_AUTH_TOKEN"))
+        if scope is None:
+            raise HTTPError(401)
+        return scope
+
+    # Cinder
+
+    def _block_storage_versions(self) -> dict:
+        return {
+            "versions": [
+                {
+                    "id": "v3.0",
+                    "status": "CURRENT",
+                    "version": "3.60",
+                    "min_version": "3.0",
+                    "updated": "2016-02-08T12:20:21Z",
+                    "links": [{"rel": "self", "href": f"{self.base_url}/volume/v3/"}],
+                    "media-types": [
+                        {
+                            "base": "application/json",
+                            "type": "application/vnd.openstack.volume+json;version=3",
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _block_storage(self, method, path, query, body, environ):
+        segments = path.strip("/").split("/") if path.strip("/") else []
+        if method == "GET" and len(segments) <= 2:
+            # Version discovery, on the root, the version or the project endpoint
+            return 300 if not segments else 200, self._block_storage_versions()
+        if segments[0] != "v3":
+            raise HTTPError(404)
+        project_id, resource = segments[1], segments[2:]
+        scope = self._scope(environ)
+        if scope["project_id"] != project_id:
+            raise HTTPError(403)
+        if self.api_error_rate and self._random.random() < self.api_error_rate:
+            raise HTTPError(500)
+        self._resolve_pending()
+        if method == "GET" and resource == ["resource_filters"]:
+            filters = ["name", "status", "metadata", "bootable", "availability_zone"]
+            return 200, {
+                "resource_filters": [{"resource": "volume", "filters": filters}]
+            }
+        if method == "GET" and resource in (["volumes"], ["volumes", "detail"]):
+            volumes = self._filter(self._volumes.values(), project_id, query)
+            return 200, self._page("volumes", volumes, query, environ)
+        if method == "GET" and resource in (["snapshots"], ["snapshots", "detail"]):
+            # Newest first, as cinder sorts them by default
+            snapshots = self._filter(
+                sorted(
+                    self._snapshots.values(),
+                    key=lambda snapshot: snapshot["created_at"],
+                    reverse=True,
+                ),
+                project_id,
+                query,
+            )
+            return 200, self._page("snapshots", snapshots, query, environ)
+        if resource[:1] == ["snapshots"] and len(resource) == 2:
+            snapshot = self._snapshots.get(resource[1])
+            if snapshot is None or self._owner(snapshot) != project_id:
+                raise HTTPError(404)
+            if method == "GET":
+                return 200, {"snapshot": snapshot}
+            if method == "DELETE":
+                if snapshot["status"] not in ("available", "error"):
+                    raise HTTPError(400, "Invalid snapshot status")
+                snapshot["status"] = "deleting"
+                self._pending[snapshot["id"]] = (
+                    time.monotonic() + self.transition_delay,
+                    None,
+                )
+                return 202, None
+        if method == "POST" and resource == ["snapshots"]:
+            request = body["snapshot"]
+            volume = self._volumes.get(request["volume_id"])
+            if volume is None or self._owner(volume) != project_id:
+                raise HTTPError(404)
+            snapshot = self._add_snapshot(
+                volume, datetime.datetime.utcnow(), request.get("metadata") or {}
+            )
+            snapshot["description"] = request.get("description")
+            snapshot["status"] = "creating"
+            failed = self._random.random() < self.snapshot_error_rate
+            self._pending[snapshot["id"]] = (
+                time.monotonic() + self.transition_delay,
+                "error" if failed else "available",
+            )
+            return 202, {"snapshot": snapshot}
+        raise HTTPError(404)
+
+    @staticmethod
+    def _owner(resource: dict) -> str:
+        return resource.get("os-vol-tenant-attr:tenant_id") or resource.get(
+            "os-extended-snapshot-attributes:project_id"
+        )
+
+    def _resolve_pending(self):
+        now = time.monotonic()
+        for snapshot_id, (ready_at, status) in list(self._pending.items()):
+            if ready_at > now:
+                continue
+            del self._pending[snapshot_id]
+            if status is None:
+                self._snapshots.pop(snapshot_id, None)
+            else:
+                self._snapshots[snapshot_id]["status"] = status
+
+    def _filter(self, resources, project_id: str, query: dict) -> List[dict]:
+        all_tenants = query.get("all_tenants", "").lower() in ("true", "1")
+        if all_tenants and "project_id" in query:
+            project_id, all_tenants = query["project_id"], False
+        metadata = json.loads(query["metadata"]) if "metadata" in query else {}
+        return [
+            resource
+            for resource in resources
+            if (all_tenants or self._owner(resource) == project_id)
+            and query.get("status", resource["status"]) == resource["status"]
+            and query.get("volume_id", resource.get("volume_id"))
+            == resource.get("volume_id")
+            and all(resource["metadata"].get(k) == v for k, v in metadata.items())
+        ]
+
+    def _page(self, key: str, resources: List[dict], query: dict, environ) -> dict:
+        start = 0
+        if "marker" in query:
+            ids = [resource["id"] for resource in resources]
+            if query["marker"] not in ids:
+                raise HTTPError(400, "Marker not found")
+            start = ids.index(query["marker"]) + 1
+        limit = min(int(query.get("limit", MAX_LIMIT)), MAX_LIMIT)
+        page = resources[start : start + limit]
+        payload = {key: page}
+        if start + limit < len(resources):
+            next_query = dict(query, marker=page[-1]["id"], limit=limit)
+            url = f"{self.base_url}/volume{environ['PATH_INFO'][len('/volume'):]}"
+            payload[f"{key}_links"] = [
+                {"rel": "next", "href": f"{url}?{urllib.parse.urlencode(next_query)}"}
+            ]
+        return payload
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(cloud: FakeOpenStack, host: str = "127.0.0.1", port: int = 0):
+    """Serve cloud from a thread, returns the server and its base URL"""
+    server = wsgiref.simple_server.make_server(
+        host,
+        port,
+        cloud,
+        server_class=_ThreadingServer,
+        handler_class=_QuietHandler,
+    )
+    cloud.base_url = f"http://{host}:{server.server_port}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, cloud.base_url
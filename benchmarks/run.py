@@ -0,0 +1,238 @@
+"""Benchmark the creator and the destroyer against a local fake OpenStack
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import json
+import os
+import pathlib
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_openstack import PASSWORD, USER_NAME, FakeOpenStack, serve
+
+
+SHAPES = {
+    "small": {"projects": 10, "volumes_per_project": 10},
+    "wide": {"projects": 200, "volumes_per_project": 5},
+    "deep": {"projects": 3, "volumes_per_project": 200},
+    "skewed": {"projects": 50, "volumes_per_project": 5, "largest": 200},
+}
+CLOUDS_YAML = """\
+clouds:
+  benchmark:
+    auth_type: password
+    auth:
+      auth_url: {base_url}/identity/v3
+      username: {username}
+      password: {password}
+      user_domain_name: Default
+    region_name: RegionOne
+    interface: public
+    identity_api_version: 3
+"""
+
+
+def run_command(shape, command, pool_size, common_args, extra_args, workdir):
+    """Run a subcommand in a child process, returns its wall time and usage"""
+    log_path = workdir / f"{shape}-{command}-{pool_size}.log"
+    env = dict(os.environ, OS_CLIENT_CONFIG_FILE=str(workdir / "clouds.yaml"))
+    args = [sys.executable, "-m", "cinder_snapshooter", "--os-cloud", "benchmark"]
+    args += ["--pool-size", str(pool_size)] + common_args + [command] + extra_args
+    start = time.monotonic()
+    with log_path.open("w") as log_file:
+        process = subprocess.Popen(args, env=env, stdout=log_file, stderr=log_file)
+        _, status, usage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    if process.returncode != 0:
+        print(f"{command} exited with {process.returncode}, see {log_path}")
+    # ru_maxrss is in KiB on Linux
+    return wall_time, usage.ru_maxrss / 1024, process.returncode
+
+
+def benchmark(shape, command, pool_size, options, workdir):
+    cloud = FakeOpenStack(
+        latency=options.latency,
+        transition_delay=options.transition_delay,
+        snapshot_error_rate=options.snapshot_error_rate,
+        api_error_rate=options.api_error_rate,
+        enrolled=options.enrolled,
+        trusted=options.trusted,
+        **SHAPES[shape],
+    )
+    server, base_url = serve(cloud)
+    try:
+        (workdir / "clouds.yaml").write_text(
+            CLOUDS_YAML.format(base_url=base_url, username=USER_NAME, password=PASSWORD)
+        )
+        snapshots = cloud.snapshot_count
+        wall_time, peak_rss, returncode = run_command(
+            shape, command, pool_size, options.common_args, options.extra_args, workdir
+        )
+        calls = cloud.reset_calls()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {
+        "shape": shape,
+        "command": command,
+        "pool_size": pool_size,
+        "wall_time": round(wall_time, 3),
+        "peak_rss_mib": round(peak_rss, 1),
+        "api_calls": sum(calls.values()),
+        "snapshot_delta": cloud.snapshot_count - snapshots,
+        "returncode": returncode,
+        "calls": calls,
+    }
+
+
+def print_result(result, verbose):
+    print(
+        f"{result['shape']:<8} {result['command']:<10} {result['pool_size']:>5} "
+        f"{result['wall_time']:>9.2f} {result['peak_rss_mib']:>9.1f} "
+        f"{result['api_calls']:>9} {result['snapshot_delta']:>+9}"
+    )
+    if verbose:
+        for operation, count in sorted(result["calls"].items()):
+            print(f"    {count:>7}  {operation}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the creator and the destroyer against a local fake "
+        "OpenStack for several pool sizes and inventory shapes",
+    )
+    parser.add_argument(
+        "--shapes",
+        default="small,wide,deep,skewed",
+        help="comma separated inventory shapes among "
+        f"{', '.join(SHAPES)} (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--pool-sizes",
+        default="1,10,50",
+        help="comma separated pool sizes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--commands",
+        default="creator,destroyer",
+        help="comma separated subcommands to run (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.01,
+        help="seconds each API request takes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--transition-delay",
+        type=float,
+        default=0.5,
+        help="seconds for a snapshot to be created or deleted (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--enrolled",
+        type=float,
+        default=0.5,
+        help="share of volumes enrolled to automatic snapshots "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trusted",
+        type=float,
+        default=0.0,
+        help="share of projects reached through a trust (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--snapshot-error-rate",
+        type=float,
+        default=0.0,
+        help="share of snapshots ending up in error (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--api-error-rate",
+        type=float,
+        default=0.0,
+        help="share of block storage requests failing with an HTTP 500 "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--common-args",
+        type=shlex.split,
+        default=[],
+        help="arguments given before the subcommands, --page-size 500 for instance",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="keep the logs of the runs in this directory (default: a temporary one)",
+    )
+    parser.add_argument(
+        "--json",
+        dest="json_path",
+        help="also write the results as JSON to this file",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="detail the API calls per operation",
+    )
+    parser.add_argument(
+        "extra_args",
+        nargs=argparse.REMAINDER,
+        help="arguments given to every subcommand run, after --",
+    )
+    args = parser.parse_args(argv)
+    if args.extra_args[:1] == ["--"]:
+        args.extra_args = args.extra_args[1:]
+    unknown = set(args.shapes.split(",")) - set(SHAPES)
+    if unknown:
+        parser.error(f"unknown shapes: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = []
+    print(
+        f"{'shape':<8} {'command':<10} {'pool':>5} {'wall (s)':>9} "
+        f"{'rss (MiB)':>9} {'api calls':>9} {'snapshots':>9}"
+    )
+    with tempfile.TemporaryDirectory(prefix="cinder-snapshooter-bench-") as tmp:
+        workdir = pathlib.Path(options.workdir or tmp)
+        workdir.mkdir(parents=True, exist_ok=True)
+        for shape in options.shapes.split(","):
+            for command in options.commands.split(","):
+                for pool_size in options.pool_sizes.split(","):
+                    result = benchmark(shape, command, int(pool_size), options, workdir)
+                    print_result(result, options.verbose)
+                    results.append(result)
+    if options.json_path is not None:
+        with open(options.json_path, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+    return 0 if all(result["returncode"] == 0 for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,25 @@
+"""Run the command line with python -m cinder_snapshooter
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import sys
+
+from cinder_snapshooter.cli import cli
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
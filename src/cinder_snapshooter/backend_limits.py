@@ -0,0 +1,101 @@
+"""Caps on the snapshots created or deleted at once on each storage backend
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import contextlib
+
+from typing import Dict, Iterable, Mapping, Optional
+
+import eventlet.semaphore
+import structlog
+
+from . import metrics
+from .records import VolumeRecord
+
+
+log = structlog.get_logger()
+
+DEFAULT_BACKEND_KEY = "volume_type"
+UNKNOWN_BACKEND = "unknown"
+
+
+class BackendLimits:
+    """Semaphores bounding the snapshot operations in flight on each backend
+
+    The backend of a volume is its attribute named key: its volume type, its
+    host (only visible to admins) or its availability zone. limits maps
+    backends to the most snapshots being created or deleted at once on them,
+    default_limit applies to the other backends, which are not capped without
+    it. The semaphores are shared by every project of the run.
+    """
+
+    def __init__(
+        self,
+        key: str = DEFAULT_BACKEND_KEY,
+        limits: Optional[Mapping[str, int]] = None,
+        default_limit: Optional[int] = None,
+    ):
+        self.key = key
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self._semaphores = {}
+        self._lock = eventlet.semaphore.Semaphore()
+
+    def backend(self, volume: VolumeRecord) -> str:
+        return getattr(volume, self.key, None) or UNKNOWN_BACKEND
+
+    def volume_backends(
+        self,
+        block_storage,
+        volumes: Optional[Iterable[VolumeRecord]] = None,
+        page_size: Optional[int] = None,
+    ) -> Dict[str, str]:
+        """Backend of each volume, listed page_size at a time when not given"""
+        if volumes is None:
+            query = {} if page_size is None else {"limit": page_size}
+            volumes = map(VolumeRecord.from_resource, block_storage.volumes(**query))
+        return {volume.id: self.backend(volume) for volume in volumes}
+
+    def _semaphore(self, backend: str):
+        with self._lock:
+            if backend not in self._semaphores:
+                limit = self.limits.get(backend, self.default_limit)
+                self._semaphores[backend] = (
+                    None if limit is None else eventlet.semaphore.Semaphore(limit)
+                )
+            return self._semaphores[backend]
+
+    @contextlib.contextmanager
+    def slot(self, backend: str):
+        """Hold one of the operations allowed at once on backend"""
+        semaphore = self._semaphore(backend)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            metrics.BACKEND_OPERATIONS_IN_PROGRESS.inc(backend=backend)
+            try:
+                yield
+            finally:
+                metrics.BACKEND_OPERATIONS_IN_PROGRESS.dec(backend=backend)
+
+
+def volume_slot(backend_limits: Optional[BackendLimits], volume: VolumeRecord):
+    """The slot of the backend of volume, nothing to hold without backend_limits"""
+    if backend_limits is None:
+        return contextlib.nullcontext()
+    return backend_limits.slot(backend_limits.backend(volume))
@@ -1,18 +1,33 @@
-import eventlet
-
-
-eventlet.monkey_patch()
-
 import argparse
+import importlib
 import os
 
-import openstack
+from typing import Dict, Optional
 
-from . import snapshot_creator, snapshot_destroyer
-from .utils import setup_logging
 
+# The subcommand modules and what they need are only imported to run them
+SUBCOMMANDS = {
+    "creator": ("snapshot_creator", "Creates automatic snapshots"),
+    "destroyer": ("snapshot_destroyer", "Destroys expired snapshots"),
+    "reconcile": (
+        "reconcile",
+        "Creates automatic snapshots and destroys expired ones in one pass",
+    ),
+    "daemon": ("daemon", "Runs the creator and the destroyer on a schedule"),
+}
 
-SUBCOMMANDS = {"creator": snapshot_creator, "destroyer": snapshot_destroyer}
+
+def parse_backend_limits(value: str) -> Dict[str, int]:
+    """Parse comma separated backend=limit pairs"""
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        backend, _, limit = item.rpartition("=")
+        if not backend.strip() or not limit.strip().isdigit() or int(limit) < 1:
+            raise argparse.ArgumentTypeError(f"invalid backend limit: {item!r}")
+        limits[backend.strip()] = int(limit)
+    return limits
 
 
 def register_common_args(parser):
@@ -29,6 +44,97 @@ def register_common_args(parser):
         type=int,
         help="the number of snapshots to be processed concurrently (default: %(default)s)",
     )
+    parser.add_argument(
+        "--auth-concurrency",
+        dest="auth_concurrency",
+        default=os.environ.get("AUTH_CONCURRENCY"),
+        type=int,
+        help="the number of projects to authenticate to concurrently "
+        "(default: the pool size)",
+    )
+    parser.add_argument(
+        "--token-cache",
+        dest="token_cache_path",
+        default=os.environ.get("TOKEN_CACHE"),
+        help="a file to keep the project scoped tokens in between runs "
+        "(default: no cache)",
+    )
+    parser.add_argument(
+        "--token-min-validity",
+        dest="token_min_validity",
+        default=os.environ.get("TOKEN_MIN_VALIDITY", 3600),
+        type=int,
+        help="the time in seconds a cached token must still be valid for "
+        "to be reused, should cover a run (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--project-preference",
+        dest="project_preference",
+        default=os.environ.get("PROJECT_PREFERENCE", "membership"),
+        choices=["membership", "trust"],
+        help="how to reach a project both available through a trust and as a "
+        "member (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shard-index",
+        dest="shard_index",
+        default=os.environ.get("SHARD_INDEX", 0),
+        type=int,
+        help="the shard of the projects to process, from 0 to the shard count "
+        "minus one (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--shard-count",
+        dest="shard_count",
+        default=os.environ.get("SHARD_COUNT", 1),
+        type=int,
+        help="the number of runners splitting the projects between them, each "
+        "one with its own shard index (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--schedule",
+        dest="schedule",
+        default=os.environ.get("SCHEDULE", "listing"),
+        choices=["listing", "largest-first"],
+        help="the order projects are dispatched in, the one of the listing or "
+        "the longest to process first as per the stats file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stats-file",
+        dest="stats_file",
+        default=os.environ.get("STATS_FILE"),
+        help="a file to keep the processing time of each project in between "
+        "runs, to schedule them (default: none)",
+    )
+    parser.add_argument(
+        "--deadline",
+        dest="deadline",
+        default=os.environ.get("DEADLINE"),
+        type=float,
+        help="the time in seconds a run may last, the projects which do not fit "
+        "in are left for the next run to start with (default: none)",
+    )
+    parser.add_argument(
+        "--journal",
+        dest="journal_path",
+        default=os.environ.get("JOURNAL"),
+        help="a file to record the progress of the runs in as they go "
+        "(default: none)",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="carry on with the run the previous process left unfinished in the "
+        "journal, rather than starting afresh",
+    )
+    parser.add_argument(
+        "--all-tenants",
+        dest="all_tenants",
+        action="store_true",
+        help="list the volumes and snapshots of all tenants at once, "
+        "needs admin rights",
+    )
     parser.add_argument(
         "--wait-completion-timeout",
         dest="wait_completion_timeout",
@@ -37,6 +143,120 @@ def register_common_args(parser):
         help="the time in seconds to wait for snapshot "
         "creation/deletion completion (default: %(default)s)",
     )
+    parser.add_argument(
+        "--page-size",
+        dest="page_size",
+        default=os.environ.get("PAGE_SIZE"),
+        type=int,
+        help="the number of volumes or snapshots fetched per listing request "
+        "(default: the API's own page size)",
+    )
+    parser.add_argument(
+        "--group-snapshots",
+        dest="use_groups",
+        action="store_true",
+        help="snapshot the volume groups whose volumes are all enrolled as a "
+        "whole, for their snapshots to be consistent with each other",
+    )
+
+    polling_group = parser.add_argument_group(
+        "polling",
+        "how snapshot creation/deletion completion is polled",
+    )
+    polling_group.add_argument(
+        "--poll-initial-delay",
+        dest="poll_initial_delay",
+        default=os.environ.get("POLL_INITIAL_DELAY", 1),
+        type=float,
+        help="the time in seconds before the first poll (default: %(default)s)",
+    )
+    polling_group.add_argument(
+        "--poll-max-delay",
+        dest="poll_max_delay",
+        default=os.environ.get("POLL_MAX_DELAY", 10),
+        type=float,
+        help="the maximum time in seconds between two polls (default: %(default)s)",
+    )
+    polling_group.add_argument(
+        "--poll-backoff-factor",
+        dest="poll_backoff_factor",
+        default=os.environ.get("POLL_BACKOFF_FACTOR", 2),
+        type=float,
+        help="how much the time between two polls grows (default: %(default)s)",
+    )
+    polling_group.add_argument(
+        "--no-adaptive-polling",
+        dest="adaptive_polling",
+        action="store_false",
+        help="do not seed the first poll with the completion times seen so far",
+    )
+
+    backend_group = parser.add_argument_group(
+        "backend limits",
+        "how many snapshots are created or deleted at once on each storage backend",
+    )
+    backend_group.add_argument(
+        "--backend-key",
+        dest="backend_key",
+        default=os.environ.get("BACKEND_KEY", "volume_type"),
+        choices=("volume_type", "host", "availability_zone"),
+        help="the attribute of the volumes telling their backend, their host "
+        "is only visible to admins (default: %(default)s)",
+    )
+    backend_group.add_argument(
+        "--backend-concurrency",
+        dest="backend_concurrency",
+        default=os.environ.get("BACKEND_CONCURRENCY"),
+        type=parse_backend_limits,
+        help="comma separated backend=limit pairs, the most snapshots created or "
+        "deleted at once on these backends (default: none)",
+    )
+    backend_group.add_argument(
+        "--default-backend-concurrency",
+        dest="default_backend_concurrency",
+        default=os.environ.get("DEFAULT_BACKEND_CONCURRENCY"),
+        type=int,
+        help="the most snapshots created or deleted at once on the other "
+        "backends (default: no limit)",
+    )
+
+    rate_limit_group = parser.add_argument_group(
+        "rate limiting",
+        "how many API requests per second the whole process makes",
+    )
+    rate_limit_group.add_argument(
+        "--block-storage-rate-limit",
+        dest="block_storage_rate_limit",
+        default=os.environ.get("BLOCK_STORAGE_RATE_LIMIT"),
+        type=float,
+        help="the requests per second to the block storage API (default: no limit)",
+    )
+    rate_limit_group.add_argument(
+        "--identity-rate-limit",
+        dest="identity_rate_limit",
+        default=os.environ.get("IDENTITY_RATE_LIMIT"),
+        type=float,
+        help="the requests per second to the identity API (default: no limit)",
+    )
+
+    metrics_group = parser.add_argument_group(
+        "metrics",
+        "how Prometheus metrics are exported",
+    )
+    metrics_group.add_argument(
+        "--metrics-textfile",
+        dest="metrics_textfile",
+        default=os.environ.get("METRICS_TEXTFILE"),
+        help="a file to write the metrics to at the end of each run, for the "
+        "textfile collector of the node exporter (default: none)",
+    )
+    metrics_group.add_argument(
+        "--metrics-port",
+        dest="metrics_port",
+        default=os.environ.get("METRICS_PORT"),
+        type=int,
+        help="a port to serve the metrics on over HTTP (default: none)",
+    )
 
     logging_group = parser.add_argument_group(
         "logging",
@@ -54,22 +274,120 @@ def register_common_args(parser):
     )
 
 
-def parse_args(args=None):
+def load_subcommand(name: str):
+    """Import the module implementing a subcommand"""
+    return importlib.import_module(f".{SUBCOMMANDS[name][0]}", __package__)
+
+
+def _build_parser(subcommand: Optional[str] = None) -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser("cinder-snapshooter")
     register_common_args(parser)
     sub_parser = parser.add_subparsers(required=True)
 
-    for name, module in SUBCOMMANDS.items():
-        subcommand_parser = sub_parser.add_parser(name, help=module.cmd_help)
+    for name, (_, cmd_help) in SUBCOMMANDS.items():
+        if name != subcommand:
+            # Tells which subcommand to load, its own arguments are left unparsed
+            subcommand_parser = sub_parser.add_parser(
+                name, help=cmd_help, add_help=False
+            )
+            subcommand_parser.set_defaults(subcommand=name)
+            continue
+        module = load_subcommand(name)
+        subcommand_parser = sub_parser.add_parser(name, help=cmd_help)
         module.register_args(subcommand_parser)
         subcommand_parser.set_defaults(func=module.cli)
 
-    return parser.parse_args(args)
+    return parser
+
+
+def parse_common_args(args=None) -> argparse.Namespace:
+    """Parse the arguments common to all subcommands and the subcommand name
+
+    Nothing but the parser is imported, the global help and usage errors are
+    handled here.
+    """
+    parser = _build_parser()
+    common_args = parser.parse_known_args(args)[0]
+    if common_args.shard_count < 1:
+        parser.error("--shard-count must be at least 1")
+    if not 0 <= common_args.shard_index < common_args.shard_count:
+        parser.error("--shard-index must be between 0 and the shard count minus one")
+    if common_args.resume and common_args.journal_path is None:
+        parser.error("--resume needs a --journal to resume from")
+    if common_args.deadline is not None and common_args.stats_file is None:
+        parser.error("--deadline needs a --stats-file to remember the projects skipped")
+    if (
+        common_args.schedule == "largest-first"
+        and common_args.stats_file is None
+        and not common_args.all_tenants
+    ):
+        # Only the listings of all tenants otherwise tell the size of the projects
+        parser.error("--schedule largest-first needs a --stats-file or --all-tenants")
+    return common_args
+
+
+def parse_args(args=None) -> argparse.Namespace:
+    return _build_parser(parse_common_args(args).subcommand).parse_args(args)
 
 
 def cli():
+    parse_common_args()
+    # Eventlet must patch the process before the HTTP stack gets imported
+    import eventlet
+
+    eventlet.monkey_patch()
     args = parse_args()
+
+    import openstack
+
+    from . import metrics
+    from .backend_limits import BackendLimits
+    from .journal import Journal
+    from .project_stats import ProjectStats
+    from .rate_limit import RateLimiter
+    from .token_cache import TokenCache
+    from .utils import PollingPolicy, setup_logging
+
     setup_logging(args)
+    if args.metrics_port is not None:
+        metrics.serve(args.metrics_port)
     args.os_client = openstack.connect(cloud=args.os_cloud)
+    args.rate_limiter = RateLimiter(
+        {
+            "block-storage": args.block_storage_rate_limit,
+            "identity": args.identity_rate_limit,
+        }
+    )
+    args.rate_limiter.install(args.os_client)
+    args.polling = PollingPolicy(
+        args.poll_initial_delay,
+        args.poll_max_delay,
+        args.poll_backoff_factor,
+        args.adaptive_polling,
+    )
+    args.token_cache = None
+    if args.token_cache_path is not None:
+        args.token_cache = TokenCache(args.token_cache_path, args.token_min_validity)
+    args.project_stats = None
+    if args.stats_file is not None:
+        args.project_stats = ProjectStats(args.stats_file)
+    args.backend_limits = None
+    if args.backend_concurrency or args.default_backend_concurrency is not None:
+        args.backend_limits = BackendLimits(
+            args.backend_key,
+            args.backend_concurrency,
+            args.default_backend_concurrency,
+        )
+    args.journal = None
+    if args.journal_path is not None:
+        args.journal = Journal(args.journal_path, args.resume)
+    args.connections = None  # Only worth keeping when running as a daemon
 
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        args.rate_limiter.log_stats()
+        if args.journal is not None:
+            args.journal.close()
+        if args.metrics_textfile is not None:
+            metrics.write_textfile(args.metrics_textfile)
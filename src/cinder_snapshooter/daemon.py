@@ -0,0 +1,224 @@
+"""Long running process creating and destroying snapshots on a schedule
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import functools
+import os
+import signal
+import time
+
+from typing import Callable, Dict, FrozenSet, Tuple
+
+import eventlet
+import structlog
+
+from dateutil.relativedelta import relativedelta
+
+from . import metrics, snapshot_creator, snapshot_destroyer
+
+
+log = structlog.get_logger()
+
+DEFAULT_SCHEDULE = "0 0 * * *"
+MAX_SLEEP = 1  # How long a stop request may wait between two passes
+MAX_YEARS_AHEAD = 5
+
+
+def _parse_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_value = part.split("/", 1)
+            step = int(step_value)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(bound) for bound in part.split("-", 1))
+        else:
+            start = int(part)
+            # "5/15" means every 15 starting at 5
+            end = high if step != 1 else start
+        if step < 1 or not low <= start <= end <= high:
+            raise ValueError(f"invalid cron field {field!r}")
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class CronSchedule:
+    """The times matching a cron expression, in UTC
+
+    The expression has the usual five fields: minute, hour, day of month, month
+    and day of week (0 or 7 being Sunday). Each field is either *, a value, a
+    range or a comma separated list of those, optionally followed by a /step.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"invalid cron expression {expression!r}")
+        self.expression = expression
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12)
+        self.weekdays = frozenset(day % 7 for day in _parse_field(fields[4], 0, 7))
+        # As in cron, a day matches either field when both are restricted
+        self._any_day = fields[2] != "*" and fields[4] != "*"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CronSchedule) and other.expression == self.expression
+
+    def __hash__(self) -> int:
+        return hash(self.expression)
+
+    def _day_matches(self, when: datetime.datetime) -> bool:
+        day = when.day in self.days
+        weekday = (when.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return day or weekday
+        return day and weekday
+
+    def next_after(self, after: datetime.datetime) -> datetime.datetime:
+        """The first time matching the schedule strictly after the given one"""
+        when = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        while when.year <= after.year + MAX_YEARS_AHEAD:
+            if when.month not in self.months:
+                when = when.replace(day=1, hour=0, minute=0) + relativedelta(months=1)
+            elif not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + datetime.timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += datetime.timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError(f"cron expression {self.expression!r} never matches")
+
+
+class Daemon:
+    """Run passes on their schedule until stopped
+
+    Passes run one at a time, in the given order when due at the same time. A
+    pass outlasting the next occurrence of its schedule is not run again for
+    the occurrences it missed.
+    """
+
+    def __init__(self, passes: Dict[str, Tuple[CronSchedule, Callable[[], bool]]]):
+        self.passes = passes
+        self.stopping = False
+
+    def stop(self, signum=None, frame=None):
+        log.info("Stopping once the running pass is over", signal=signum)
+        self.stopping = True
+
+    def _run_pass(self, name: str):
+        log.info("Starting pass", command=name)
+        start = time.monotonic()
+        try:
+            success = self.passes[name][1]()
+        except Exception:
+            log.exception("Pass failed", command=name)
+            success = False
+        log.info(
+            "Pass over",
+            command=name,
+            success=success,
+            duration=round(time.monotonic() - start, 3),
+        )
+
+    def run_forever(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        next_runs = {
+            name: schedule.next_after(now)
+            for name, (schedule, _) in self.passes.items()
+        }
+        log.info("Daemon started", next_runs=next_runs)
+        while not self.stopping:
+            name = min(next_runs, key=next_runs.get)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            delay = (next_runs[name] - now).total_seconds()
+            if delay > 0:
+                eventlet.sleep(min(delay, MAX_SLEEP))
+                continue
+            self._run_pass(name)
+            schedule = self.passes[name][0]
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if schedule.next_after(next_runs[name]) <= now:
+                log.warning(
+                    "Pass overran its schedule, skipping missed runs", command=name
+                )
+            next_runs[name] = schedule.next_after(now)
+        log.info("Daemon stopped")
+
+
+def _run_pass(run: Callable[..., bool], args) -> bool:
+    try:
+        return run(args)
+    finally:
+        if args.metrics_textfile is not None:
+            metrics.write_textfile(args.metrics_textfile)
+
+
+def register_args(parser):
+    """Registers subcommand specific arguments to parse using argparse"""
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Do not create nor delete any snapshot, only pretend to",
+    )
+    parser.add_argument(
+        "--creator-schedule",
+        dest="creator_schedule",
+        default=os.environ.get("CREATOR_SCHEDULE", DEFAULT_SCHEDULE),
+        type=CronSchedule,
+        help="when to create snapshots, as a cron expression in UTC "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--destroyer-schedule",
+        dest="destroyer_schedule",
+        default=os.environ.get("DESTROYER_SCHEDULE", DEFAULT_SCHEDULE),
+        type=CronSchedule,
+        help="when to destroy expired snapshots, as a cron expression in UTC "
+        "(default: %(default)s)",
+    )
+    snapshot_creator.register_options(parser)
+    snapshot_destroyer.register_options(parser)
+
+
+def cli(args):
+    """Entrypoint for CLI subcommand"""
+    # Keep the project scoped clients, with their token and HTTP connections
+    args.connections = {}
+    daemon = Daemon(
+        {
+            "creator": (
+                args.creator_schedule,
+                functools.partial(_run_pass, snapshot_creator.run, args),
+            ),
+            "destroyer": (
+                args.destroyer_schedule,
+                functools.partial(_run_pass, snapshot_destroyer.run, args),
+            ),
+        }
+    )
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run_forever()
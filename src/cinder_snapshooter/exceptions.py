@@ -29,6 +29,16 @@ class SnapshotInError(Exception):
         )
 
 
+class SnapshotCreationTimeout(Exception):
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        super().__init__(
+            f"Snapshot {self.snapshot.id} "
+            f"for volume {self.snapshot.volume_id} "
+            f"is still {self.snapshot.status} after timeout"
+        )
+
+
 class SnapshotStillPresent(Exception):
     def __init__(self, snapshot: Snapshot):
         self.snapshot = snapshot
@@ -37,3 +47,44 @@ class SnapshotStillPresent(Exception):
             f"for volume {self.snapshot.volume_id} "
             f"is still present with status {self.snapshot.status}"
         )
+
+
+class GroupSnapshotInError(SnapshotInError):
+    def __init__(self, group_snapshot):
+        self.snapshot = group_snapshot
+        Exception.__init__(
+            self,
+            f"Group snapshot {group_snapshot.id} for group "
+            f"{group_snapshot.group_id} in error",
+        )
+
+
+class GroupSnapshotCreationTimeout(SnapshotCreationTimeout):
+    def __init__(self, group_snapshot):
+        self.snapshot = group_snapshot
+        Exception.__init__(
+            self,
+            f"Group snapshot {group_snapshot.id} "
+            f"for group {group_snapshot.group_id} "
+            f"is still {group_snapshot.status} after timeout",
+        )
+
+
+class GroupSnapshotStillPresent(SnapshotStillPresent):
+    def __init__(self, group_snapshot):
+        self.snapshot = group_snapshot
+        Exception.__init__(
+            self,
+            f"Group snapshot {group_snapshot.id} "
+            f"for group {group_snapshot.group_id} "
+            f"is still present with status {group_snapshot.status}",
+        )
+
+
+class DeadlineReached(Exception):
+    def __init__(self, project_id: str, remaining: float):
+        self.project_id = project_id
+        super().__init__(
+            f"Not enough time left to process project {project_id}, "
+            f"{max(remaining, 0):.1f}s remaining"
+        )
@@ -0,0 +1,304 @@
+"""Snapshots of whole Cinder generic volume groups, taken as one unit
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import json
+import time
+
+from typing import Iterator, NamedTuple, Optional, Tuple
+
+import structlog
+
+from openstack import resource
+from openstack.connection import Connection
+from openstack.exceptions import ResourceNotFound
+from tenacity import Retrying, stop_after_attempt, wait_random
+
+from . import metrics
+from .exceptions import (
+    GroupSnapshotCreationTimeout,
+    GroupSnapshotInError,
+    GroupSnapshotStillPresent,
+)
+from .utils import (
+    DEFAULT_CREATE_RETRIES,
+    DEFAULT_DELETE_RETRIES,
+    RETRY_UNLESS_AUTH_FAILED,
+    SnapshotTracker,
+)
+
+
+log = structlog.get_logger()
+
+GROUP_SNAPSHOT_NAME = "Automatic daily snapshot"
+
+
+class _Group(resource.Resource):
+    """Generic volume group, along with its volumes since the microversion 3.25"""
+
+    resources_key = "groups"
+    base_path = "/groups"
+    allow_list = True
+    # The project of the resources is only given from the microversion 3.58
+    _max_microversion = "3.58"
+    _query_mapping = resource.QueryParameters(
+        "list_volume", "project_id", all_projects="all_tenants"
+    )
+
+    name = resource.Body("name")
+    status = resource.Body("status")
+    volumes = resource.Body("volumes", type=list)
+    project_id = resource.Body("project_id")
+
+
+class _GroupSnapshot(resource.Resource):
+    """Snapshot of every volume of a group, taken at once"""
+
+    resource_key = "group_snapshot"
+    resources_key = "group_snapshots"
+    base_path = "/group_snapshots"
+    allow_create = True
+    allow_fetch = True
+    allow_delete = True
+    allow_list = True
+    _max_microversion = "3.58"
+    _query_mapping = resource.QueryParameters(
+        "project_id", "status", all_projects="all_tenants"
+    )
+
+    name = resource.Body("name")
+    description = resource.Body("description")
+    status = resource.Body("status")
+    group_id = resource.Body("group_id")
+    created_at = resource.Body("created_at")
+    project_id = resource.Body("project_id")
+
+
+class GroupRecord(NamedTuple):
+    """The attributes of a group needed to snapshot it"""
+
+    id: str
+    status: str
+    volume_ids: Tuple[str, ...]
+    project_id: Optional[str]
+
+    @classmethod
+    def from_resource(cls, group: _Group) -> "GroupRecord":
+        return cls(
+            group.id,
+            group.status,
+            tuple(group.volumes or ()),
+            group.project_id,
+        )
+
+
+def _expire_at(group_snapshot: _GroupSnapshot) -> Optional[str]:
+    # Group snapshots have no metadata, the expiry date is in their description
+    try:
+        description = json.loads(group_snapshot.description or "")
+    except ValueError:
+        return None
+    if not isinstance(description, dict):
+        return None
+    return description.get("expire_at")
+
+
+class GroupSnapshotRecord(NamedTuple):
+    """The attributes of a group snapshot needed to index or expire it
+
+    expire_at is None for the group snapshots which are not automatic ones.
+    """
+
+    id: str
+    status: str
+    group_id: str
+    created_at: str
+    expire_at: Optional[str]
+    project_id: Optional[str]
+
+    @classmethod
+    def from_resource(cls, group_snapshot: _GroupSnapshot) -> "GroupSnapshotRecord":
+        return cls(
+            group_snapshot.id,
+            group_snapshot.status,
+            group_snapshot.group_id,
+            group_snapshot.created_at,
+            _expire_at(group_snapshot),
+            group_snapshot.project_id,
+        )
+
+
+def list_groups(block_storage, **query) -> Iterator[GroupRecord]:
+    """Stream the groups having volumes as records"""
+    groups = block_storage._list(
+        _Group, base_path="/groups/detail", list_volume=True, **query
+    )
+    return (
+        GroupRecord.from_resource(group)
+        for group in groups
+        # Groups are listed without their volumes before the microversion 3.25
+        if group.volumes
+    )
+
+
+def list_group_snapshots(block_storage, **query) -> Iterator[GroupSnapshotRecord]:
+    """Stream the group snapshots as records"""
+    return map(
+        GroupSnapshotRecord.from_resource,
+        block_storage._list(
+            _GroupSnapshot, base_path="/group_snapshots/detail", **query
+        ),
+    )
+
+
+class _GroupSnapshotTracker(SnapshotTracker):
+    def _get(self, group_snapshot_id: str) -> Optional[_GroupSnapshot]:
+        try:
+            return self.os_client.block_storage._get(_GroupSnapshot, group_snapshot_id)
+        except ResourceNotFound:
+            return None
+
+    def _list(self, status: str) -> Iterator[_GroupSnapshot]:
+        return self.os_client.block_storage._list(
+            _GroupSnapshot, base_path="/group_snapshots/detail", status=status
+        )
+
+
+class GroupCreationTracker(_GroupSnapshotTracker):
+    """Wait for group snapshots to become available"""
+
+    kind = "group creation"
+    pending_status = "creating"
+    settled_statuses = ("error",)
+    recent_status = "available"
+
+    def check(self, group_snapshot, current: Optional[_GroupSnapshot]):
+        if current is not None:
+            if current.status == "available":
+                return current
+            if current.status == "error":
+                raise GroupSnapshotInError(current)
+        log.debug(
+            "Group snapshot not done yet, waiting...",
+            project_id=self.os_client.current_project_id,
+            group_snapshot_id=group_snapshot.id,
+            status=group_snapshot.status if current is None else current.status,
+        )
+        return None
+
+    def timeout_error(self, group_snapshot) -> Exception:
+        return GroupSnapshotCreationTimeout(group_snapshot)
+
+
+class GroupDeletionTracker(_GroupSnapshotTracker):
+    """Wait for group snapshots to disappear"""
+
+    kind = "group deletion"
+    pending_status = "deleting"
+    settled_statuses = ("error_deleting",)
+    unlisted_gone = True
+
+    def check(self, group_snapshot, current: Optional[_GroupSnapshot]):
+        if current is None:
+            return group_snapshot
+        if current.status == "error_deleting":
+            raise GroupSnapshotStillPresent(current)
+        return None
+
+    def timeout_error(self, group_snapshot) -> Exception:
+        return GroupSnapshotStillPresent(group_snapshot)
+
+
+def create_group_snapshot(
+    os_client: Connection,
+    group: GroupRecord,
+    expiry_date: datetime.datetime,
+    timeout: int,
+    retries: Optional[int] = DEFAULT_CREATE_RETRIES,
+    *,
+    tracker: Optional[GroupCreationTracker] = None,
+):
+    """Snapshot every volume of group at once and wait for it to be available"""
+    for attempt in Retrying(
+        wait=wait_random(min=1, max=3),
+        stop=stop_after_attempt(retries),
+        retry=RETRY_UNLESS_AUTH_FAILED,
+    ):
+        with attempt:
+            group_snapshot = os_client.block_storage._create(
+                _GroupSnapshot,
+                group_id=group.id,
+                name=GROUP_SNAPSHOT_NAME,
+                description=json.dumps({"expire_at": expiry_date.date().isoformat()}),
+            )
+
+    if tracker is None:
+        tracker = GroupCreationTracker(os_client, timeout)
+    start = time.monotonic()
+    group_snapshot = tracker.wait(group_snapshot)
+    metrics.SNAPSHOT_COMPLETION.observe(time.monotonic() - start, operation="create")
+    metrics.SNAPSHOTS_CREATED.inc(
+        len(group.volume_ids), project=os_client.current_project_id
+    )
+    log.info(
+        "Created group snapshot",
+        group=group.id,
+        group_snapshot=group_snapshot.id,
+        volumes=len(group.volume_ids),
+        project=os_client.current_project_id,
+        expire_at=expiry_date.date().isoformat(),
+    )
+    return group_snapshot
+
+
+def delete_group_snapshot(
+    os_client: Connection,
+    group_snapshot: GroupSnapshotRecord,
+    timeout: int,
+    retries: Optional[int] = DEFAULT_DELETE_RETRIES,
+    *,
+    tracker: Optional[GroupDeletionTracker] = None,
+):
+    """Delete a group snapshot, along with the snapshots of its volumes"""
+    for attempt in Retrying(
+        wait=wait_random(min=1, max=3),
+        stop=stop_after_attempt(retries),
+        retry=RETRY_UNLESS_AUTH_FAILED,
+        reraise=True,
+    ):
+        with attempt:
+            try:
+                os_client.block_storage._delete(
+                    _GroupSnapshot, group_snapshot.id, ignore_missing=False
+                )
+            except ResourceNotFound:
+                return True
+
+    if tracker is None:
+        tracker = GroupDeletionTracker(os_client, timeout)
+    start = time.monotonic()
+    tracker.wait(group_snapshot)
+    metrics.SNAPSHOT_COMPLETION.observe(time.monotonic() - start, operation="delete")
+    metrics.SNAPSHOTS_DELETED.inc(project=os_client.current_project_id)
+    log.info(
+        "Deleted group snapshot",
+        group_snapshot=group_snapshot.id,
+        group=group_snapshot.group_id,
+        project=os_client.current_project_id,
+    )
+    return True
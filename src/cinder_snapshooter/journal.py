@@ -0,0 +1,175 @@
+"""Append-only journal of the progress of the runs, to resume them after a crash
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import os
+
+from typing import Optional
+
+import eventlet.semaphore
+import structlog
+
+
+log = structlog.get_logger()
+
+
+class _Run:
+    def __init__(self):
+        self.projects = set()
+        self.pending = {}
+        self.available = set()
+
+
+class Journal:
+    """Progress of the runs of each task, one JSON event per line
+
+    Between the beginning and the end of a run, the projects it processed
+    successfully are recorded, along with the snapshots requested by the
+    creator and then seen available. Each event is on disk before the run goes
+    on, a line left torn by a crash is ignored.
+
+    With resume, the runs left unfinished by the previous process are picked up
+    where it died: their finished projects are skipped and the snapshots still
+    pending are waited upon rather than requested again. The journal otherwise
+    starts empty, and is emptied whenever no run is left in progress.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self._runs = {}
+        self._lock = eventlet.semaphore.Semaphore()
+        torn = resume and self._load()
+        self._file = open(path, "a" if resume else "w")
+        if torn:
+            self._file.write("\n")  # The next event starts on a line of its own
+
+    def _load(self) -> bool:
+        """Replay the journal, returns whether its last line is torn"""
+        try:
+            with open(self.path) as journal_file:
+                lines = journal_file.readlines()
+        except FileNotFoundError:
+            return False
+        for line in lines:
+            try:
+                self._apply(json.loads(line))
+            except (ValueError, KeyError):
+                log.warning("Ignoring torn journal entry", path=self.path)
+        return bool(lines) and not lines[-1].endswith("\n")
+
+    def _apply(self, event: dict):
+        if event["event"] == "begin":
+            self._runs[event["task"]] = _Run()
+            return
+        if event["event"] == "end":
+            self._runs.pop(event["task"], None)
+            return
+        run = self._runs.get(event["task"])
+        if run is None:
+            return  # The run it belongs to is over
+        if event["event"] == "project":
+            run.projects.add(event["project"])
+        elif event["event"] == "requested":
+            run.pending[event["project"], event["volume"]] = event["snapshot"]
+        elif event["event"] == "available":
+            run.pending.pop((event["project"], event["volume"]), None)
+            run.available.add((event["project"], event["volume"]))
+
+    def _write(self, event: dict):
+        with self._lock:
+            self._apply(event)
+            self._file.write(json.dumps(event) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if not self._runs:
+                self._file.seek(0)
+                self._file.truncate()
+
+    def begin(self, task: str):
+        """Begin a run of task, unless resuming the one left unfinished"""
+        run = self._runs.get(task)
+        if run is not None:
+            log.info(
+                "Resuming run left unfinished",
+                task=task,
+                finished=len(run.projects),
+                pending=len(run.pending),
+            )
+            return
+        self._write({"event": "begin", "task": task})
+
+    def end(self, task: str):
+        """End the run of task, forgetting its progress"""
+        self._write({"event": "end", "task": task})
+
+    def finished(self, task: str, project_id: str) -> bool:
+        """Whether the run of task already processed the project"""
+        run = self._runs.get(task)
+        return run is not None and project_id in run.projects
+
+    def project_done(self, task: str, project_id: str):
+        """Record the project as processed successfully by the run of task"""
+        self._write({"event": "project", "task": task, "project": project_id})
+
+    def run(self, task: str) -> "RunJournal":
+        """The journal of the run of task, for its snapshots"""
+        return RunJournal(self, task)
+
+    def close(self):
+        self._file.close()
+
+
+class RunJournal:
+    """The snapshots requested by a run and seen available, for each volume"""
+
+    def __init__(self, journal: Journal, task: str):
+        self.journal = journal
+        self.task = task
+
+    def snapshot_requested(self, project_id: str, volume_id: str, snapshot_id: str):
+        """Record a snapshot requested for the volume, yet to be available"""
+        self.journal._write(
+            {
+                "event": "requested",
+                "task": self.task,
+                "project": project_id,
+                "volume": volume_id,
+                "snapshot": snapshot_id,
+            }
+        )
+
+    def snapshot_available(self, project_id: str, volume_id: str):
+        """Record the snapshot requested for the volume as available"""
+        self.journal._write(
+            {
+                "event": "available",
+                "task": self.task,
+                "project": project_id,
+                "volume": volume_id,
+            }
+        )
+
+    def pending_snapshot(self, project_id: str, volume_id: str) -> Optional[str]:
+        """The snapshot requested for the volume and not seen available yet"""
+        run = self.journal._runs.get(self.task)
+        return None if run is None else run.pending.get((project_id, volume_id))
+
+    def snapshotted(self, project_id: str, volume_id: str) -> bool:
+        """Whether a snapshot of the volume was seen available by the run"""
+        run = self.journal._runs.get(self.task)
+        return run is not None and (project_id, volume_id) in run.available
@@ -0,0 +1,281 @@
+"""Prometheus metrics of the runs
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import bisect
+import re
+import urllib.parse
+
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import eventlet
+import eventlet.wsgi
+import structlog
+
+from .token_cache import write_atomically
+
+
+log = structlog.get_logger()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+RESOURCE_ID = re.compile(r"[0-9a-fA-F]{8}-?(?:[0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_labels(labels: Sequence[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[Tuple[str, Sequence[Tuple[str, str]], float]]:
+        for key, value in self._values.items():
+            yield self.name, tuple(zip(self.labelnames, key)), value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {_escape(self.documentation)}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for name, labels, value in self._samples():
+            yield f"{name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class Counter(_Metric):
+    """A value only going up"""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Counter):
+    """A value going up and down"""
+
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Observed values counted in cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if key not in self._values:
+            self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0}
+        entry = self._values[key]
+        entry["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+        entry["sum"] += value
+
+    def count(self, **labels) -> int:
+        entry = self._values.get(self._key(labels))
+        return 0 if entry is None else sum(entry["buckets"])
+
+    def _samples(self):
+        for key, entry in self._values.items():
+            labels = tuple(zip(self.labelnames, key))
+            cumulated = 0
+            for bound, count in zip(self.buckets, entry["buckets"]):
+                cumulated += count
+                yield (
+                    f"{self.name}_bucket",
+                    labels + (("le", _format_value(bound)),),
+                    cumulated,
+                )
+            yield f"{self.name}_sum", labels, entry["sum"]
+            yield f"{self.name}_count", labels, cumulated
+
+
+class Registry:
+    """The metrics exported together"""
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text format"""
+        return "".join(
+            f"{line}\n" for metric in self.metrics for line in metric.render()
+        )
+
+
+REGISTRY = Registry()
+
+PROJECT_DURATION = REGISTRY.register(
+    Gauge(
+        "cinder_snapshooter_project_duration_seconds",
+        "Time spent processing the project during the last run",
+        ["task", "project"],
+    )
+)
+PROJECTS_IN_PROGRESS = REGISTRY.register(
+    Gauge(
+        "cinder_snapshooter_projects_in_progress",
+        "Projects being processed, out of the green pool size",
+        ["task"],
+    )
+)
+PROJECTS_LEFT_OUT = REGISTRY.register(
+    Gauge(
+        "cinder_snapshooter_projects_left_out",
+        "Projects skipped or cancelled at the deadline of the last run",
+        ["task", "reason"],
+    )
+)
+POOL_SIZE = REGISTRY.register(
+    Gauge(
+        "cinder_snapshooter_pool_size",
+        "Size of the green pool processing the projects",
+        ["task"],
+    )
+)
+BACKEND_OPERATIONS_IN_PROGRESS = REGISTRY.register(
+    Gauge(
+        "cinder_snapshooter_backend_operations_in_progress",
+        "Snapshots being created or deleted on a capped backend",
+        ["backend"],
+    )
+)
+SNAPSHOTS_CREATED = REGISTRY.register(
+    Counter(
+        "cinder_snapshooter_snapshots_created_total",
+        "Snapshots created and available",
+        ["project"],
+    )
+)
+SNAPSHOTS_DELETED = REGISTRY.register(
+    Counter(
+        "cinder_snapshooter_snapshots_deleted_total",
+        "Snapshots deleted",
+        ["project"],
+    )
+)
+SNAPSHOT_ERRORS = REGISTRY.register(
+    Counter(
+        "cinder_snapshooter_snapshot_errors_total",
+        "Snapshots which could not be created or deleted",
+        ["project", "operation"],
+    )
+)
+SNAPSHOT_COMPLETION = REGISTRY.register(
+    Histogram(
+        "cinder_snapshooter_snapshot_completion_seconds",
+        "Time for a snapshot to be available once created or gone once deleted",
+        ["operation"],
+    )
+)
+API_REQUESTS = REGISTRY.register(
+    Counter(
+        "cinder_snapshooter_api_requests_total",
+        "Requests made to the OpenStack APIs",
+        ["endpoint", "operation", "status"],
+    )
+)
+API_LATENCY = REGISTRY.register(
+    Histogram(
+        "cinder_snapshooter_api_request_duration_seconds",
+        "Latency of the requests made to the OpenStack APIs",
+        ["endpoint", "operation"],
+        buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    )
+)
+
+
+def api_operation(method: str, url: str) -> str:
+    """Name the operation of an API request: list, get, create, update or delete"""
+    method = method.upper()
+    if method == "GET":
+        path = urllib.parse.urlsplit(url).path.rstrip("/")
+        if RESOURCE_ID.fullmatch(path.rsplit("/", 1)[-1]):
+            return "get"
+        return "list"
+    return {
+        "POST": "create",
+        "PUT": "update",
+        "PATCH": "update",
+        "DELETE": "delete",
+    }.get(method, method.lower())
+
+
+def write_textfile(path: str, registry: Registry = REGISTRY):
+    """Write the metrics for the textfile collector of the node exporter"""
+    # The node exporter usually runs as another user
+    write_atomically(path, registry.render(), mode=0o644)
+    log.debug("Wrote metrics", path=path)
+
+
+def _application(environ, start_response, registry: Registry = REGISTRY):
+    if environ["PATH_INFO"] not in ("/", "/metrics"):
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not Found\n"]
+    start_response("200 OK", [("Content-Type", CONTENT_TYPE)])
+    return [registry.render().encode()]
+
+
+def serve(port: int, host: str = ""):
+    """Serve the metrics over HTTP in the background"""
+    listener = eventlet.listen((host, port))
+    log.info("Serving metrics", port=listener.getsockname()[1])
+    return eventlet.spawn(eventlet.wsgi.server, listener, _application, log_output=False)
@@ -0,0 +1,87 @@
+"""On-disk record of how long each project takes to process
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+
+from typing import Optional
+
+import structlog
+
+from .token_cache import write_atomically
+
+
+log = structlog.get_logger()
+
+DEFAULT_WEIGHT = 0.5
+
+
+class ProjectStats:
+    """Processing time of the projects in the previous runs, per task
+
+    The estimate of a project is an exponentially weighted average of the
+    durations measured, weight being the one of the last duration. The projects
+    left out at the deadline of a run are marked skipped until processed again.
+    """
+
+    def __init__(self, path: str, weight: float = DEFAULT_WEIGHT):
+        self.path = path
+        self.weight = weight
+        self._tasks = {}
+        try:
+            with open(self.path) as stats_file:
+                self._tasks = json.load(stats_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            log.warning("Unable to read project stats, ignoring them", path=self.path)
+
+    def estimate(self, task: str, project_id: str) -> Optional[float]:
+        """Expected time to process the project, None if it never was"""
+        entry = self._tasks.get(task, {}).get(project_id)
+        if entry is None:
+            return None
+        return entry.get("estimate")
+
+    def record(self, task: str, project_id: str, duration: float):
+        """Record the time the project took to process"""
+        estimate = self.estimate(task, project_id)
+        if estimate is not None:
+            estimate += self.weight * (duration - estimate)
+        else:
+            estimate = duration
+        self._tasks.setdefault(task, {})[project_id] = {
+            "estimate": estimate,
+            "duration": duration,
+        }
+
+    def skip(self, task: str, project_id: str):
+        """Mark the project as left out, until its next duration is recorded"""
+        self._tasks.setdefault(task, {}).setdefault(project_id, {})["skipped"] = True
+
+    def skipped(self, task: str, project_id: str) -> bool:
+        """Whether the project was left out since it was last processed"""
+        return self._tasks.get(task, {}).get(project_id, {}).get("skipped", False)
+
+    def save(self):
+        """Write the stats to disk"""
+        write_atomically(self.path, json.dumps(self._tasks), mode=0o644)
+        log.debug(
+            "Saved project stats",
+            path=self.path,
+            projects=sum(len(projects) for projects in self._tasks.values()),
+        )
@@ -0,0 +1,211 @@
+"""Process wide limit of the rate of the OpenStack API requests
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import datetime
+import email.utils
+import functools
+import time
+
+from typing import Dict, Mapping, Optional
+
+import eventlet
+import keystoneauth1.exceptions
+import structlog
+
+from openstack.connection import Connection
+
+from . import metrics
+
+
+log = structlog.get_logger()
+
+THROTTLED_STATUSES = {413, 429}
+BLOCK_STORAGE_SERVICE_TYPES = {
+    "block-storage",
+    "block-store",
+    "volume",
+    "volumev2",
+    "volumev3",
+}
+DEFAULT_THROTTLED_RETRIES = 5
+DEFAULT_RETRY_AFTER = 1
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> float:
+    """Seconds to wait as per the Retry-After header, in seconds or as a date"""
+    value = headers.get("Retry-After")
+    if value is None:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((retry_at - now).total_seconds(), 0)
+
+
+class TokenBucket:
+    """Let requests through at rate per second on average
+
+    Up to burst requests go through at once after an idle period. Without a
+    rate, requests are only held while the bucket is paused.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(rate or 1, 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Hold every request for the given time"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self) -> float:
+        """Wait for our turn to send a request, returns the time waited"""
+        start = time.monotonic()
+        now = start
+        while now < self._paused_until:
+            eventlet.sleep(self._paused_until - now)
+            now = time.monotonic()
+        if self.rate is not None:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # Take the token right away, callers arriving meanwhile queue up behind
+            self._tokens -= 1
+            if self._tokens < 0:
+                eventlet.sleep(-self._tokens / self.rate)
+        return time.monotonic() - start
+
+
+class RateLimiter:
+    """Rate limit shared by all the requests of the connections it is installed on
+
+    rates gives the requests per second allowed for each endpoint,
+    "block-storage" or "identity", an endpoint without rate is not limited.
+    Throttled requests (HTTP 413 or 429) are retried up to retries times once
+    the delay asked by the Retry-After header has elapsed, during that delay
+    the other requests to the same endpoint are held as well. The count and
+    latency of the requests are exported as metrics.
+    """
+
+    def __init__(
+        self,
+        rates: Dict[str, Optional[float]],
+        retries: int = DEFAULT_THROTTLED_RETRIES,
+    ):
+        self.retries = retries
+        self._buckets = collections.defaultdict(TokenBucket)
+        for endpoint, rate in rates.items():
+            self._buckets[endpoint] = TokenBucket(rate)
+        self.requests = collections.Counter()
+        self.throttled = collections.Counter()
+        self.waited = collections.Counter()
+
+    @staticmethod
+    def endpoint(endpoint_filter: Optional[dict]) -> str:
+        """Endpoint targeted by a request given its endpoint filter"""
+        if not endpoint_filter:
+            # Requests out of the service catalog are the authentication ones
+            return "identity"
+        service_type = endpoint_filter.get("service_type")
+        if service_type in BLOCK_STORAGE_SERVICE_TYPES:
+            return "block-storage"
+        return service_type or "identity"
+
+    def install(self, os_client: Connection):
+        """Limit the requests of os_client and of the connections derived from it"""
+        session = os_client.session
+        session.request = functools.partial(self._request, session.request)
+        connect_as = os_client.connect_as
+
+        @functools.wraps(connect_as)
+        def limited_connect_as(*args, **kwargs):
+            connection = connect_as(*args, **kwargs)
+            self.install(connection)
+            return connection
+
+        os_client.connect_as = limited_connect_as
+
+    def _request(self, request, url: str, method: str, **kwargs):
+        endpoint = self.endpoint(kwargs.get("endpoint_filter"))
+        bucket = self._buckets[endpoint]
+        for attempt in range(self.retries + 1):
+            self.waited[endpoint] += bucket.acquire()
+            self.requests[endpoint] += 1
+            try:
+                response = self._send(request, endpoint, url, method, **kwargs)
+            except keystoneauth1.exceptions.HttpError as err:
+                if err.http_status not in THROTTLED_STATUSES or attempt == self.retries:
+                    raise
+                response = err.response
+            else:
+                if (
+                    response.status_code not in THROTTLED_STATUSES
+                    or attempt == self.retries
+                ):
+                    return response
+            retry_after = parse_retry_after(getattr(response, "headers", {}))
+            self.throttled[endpoint] += 1
+            log.warning(
+                "Request throttled, retrying later",
+                endpoint=endpoint,
+                method=method,
+                url=url,
+                retry_after=retry_after,
+            )
+            bucket.pause(retry_after)
+
+    @staticmethod
+    def _send(request, endpoint: str, url: str, method: str, **kwargs):
+        operation = metrics.api_operation(method, url)
+        status = "error"
+        start = time.monotonic()
+        try:
+            response = request(url, method, **kwargs)
+            status = response.status_code
+            return response
+        except keystoneauth1.exceptions.HttpError as err:
+            status = err.http_status
+            raise
+        finally:
+            metrics.API_LATENCY.observe(
+                time.monotonic() - start, endpoint=endpoint, operation=operation
+            )
+            metrics.API_REQUESTS.inc(
+                endpoint=endpoint, operation=operation, status=status
+            )
+
+    def log_stats(self):
+        """Log how many requests were made and how long they were held"""
+        for endpoint, requests in self.requests.items():
+            log.info(
+                "API requests",
+                endpoint=endpoint,
+                requests=requests,
+                throttled=self.throttled[endpoint],
+                waited=round(self.waited[endpoint], 3),
+            )
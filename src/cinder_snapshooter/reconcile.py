@@ -0,0 +1,187 @@
+"""Create the missing snapshots and destroy the expired ones in a single pass
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import functools
+import sys
+
+from typing import Iterable, Optional, Union
+
+import structlog
+
+from openstack.connection import Connection
+
+from . import snapshot_creator, snapshot_destroyer
+from .backend_limits import BackendLimits
+from .groups import GroupRecord, GroupSnapshotRecord, list_group_snapshots, list_groups
+from .journal import RunJournal
+from .records import SnapshotRecord, VolumeRecord, list_snapshots, list_volumes
+from .state import StateStore
+from .utils import PollingPolicy, run_on_all_projects, run_on_all_tenants, run_options
+
+
+log = structlog.get_logger()
+
+
+def process_project(
+    os_client: Connection,
+    wait_completion_timeout: int,
+    dry_run: bool,
+    volume_concurrency: int = 1,
+    delete_concurrency: int = 1,
+    volumes: Optional[Iterable[VolumeRecord]] = None,
+    snapshots: Optional[Iterable[SnapshotRecord]] = None,
+    polling: Optional[PollingPolicy] = None,
+    state: Optional[StateStore] = None,
+    metadata_filter: Union[bool, snapshot_creator.MetadataFilterProbe] = False,
+    page_size: Optional[int] = None,
+    backend_limits: Optional[BackendLimits] = None,
+    use_groups: bool = False,
+    groups: Optional[Iterable[GroupRecord]] = None,
+    group_snapshots: Optional[Iterable[GroupSnapshotRecord]] = None,
+    journal: Optional[RunJournal] = None,
+):
+    """Create the missing snapshots then delete the expired ones
+
+    The snapshots of the project are listed once, whatever their status, both
+    to find the volumes needing a snapshot and the snapshots to delete. volumes
+    and snapshots are the volumes and snapshots of the project when they were
+    already listed. backend_limits caps the creations and deletions together.
+    With use_groups, the group snapshots are listed once the same way. The
+    snapshots created are recorded in journal, the one of the run.
+    """
+    if snapshots is None:
+        snapshots = list_snapshots(os_client.block_storage, page_size)
+    snapshots = list(snapshots)
+    if use_groups and group_snapshots is None:
+        group_snapshots = list_group_snapshots(os_client.block_storage)
+    if group_snapshots is not None:
+        group_snapshots = list(group_snapshots)
+    created = snapshot_creator.process_volumes(
+        os_client,
+        wait_completion_timeout,
+        dry_run,
+        volume_concurrency,
+        volumes=volumes,
+        snapshots=snapshots,
+        polling=polling,
+        state=state,
+        metadata_filter=metadata_filter,
+        page_size=page_size,
+        backend_limits=backend_limits,
+        use_groups=use_groups,
+        groups=groups,
+        group_snapshots=group_snapshots,
+        journal=journal,
+    )
+    destroyed = snapshot_destroyer.process_snapshots(
+        os_client,
+        wait_completion_timeout,
+        dry_run,
+        delete_concurrency,
+        snapshots=snapshots,
+        polling=polling,
+        page_size=page_size,
+        volumes=volumes,
+        backend_limits=backend_limits,
+        use_groups=use_groups,
+        group_snapshots=group_snapshots,
+    )
+    return created and destroyed
+
+
+def register_args(parser):
+    """Registers subcommand specific arguments to parse using argparse"""
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Do not create nor delete any snapshot, only pretend to",
+    )
+    snapshot_creator.register_options(parser)
+    snapshot_destroyer.register_options(parser)
+
+
+def cli(args):
+    """Entrypoint for CLI subcommand"""
+    if not run(args):
+        sys.exit(1)  # Something went wrong during execution exit with 1
+
+
+def run(args) -> bool:
+    """Process all projects, returns whether it succeeded everywhere"""
+    metadata_filter = snapshot_creator.MetadataFilterProbe(args.server_side_filter)
+    state = None
+    if args.state_file is not None:
+        state = StateStore(args.state_file, args.state_max_age)
+    try:
+        if args.all_tenants:
+            listings = {
+                "volumes": functools.partial(
+                    list_volumes,
+                    args.os_client.block_storage,
+                    metadata_filter(args.os_client),
+                    args.page_size,
+                ),
+                "snapshots": functools.partial(
+                    list_snapshots, args.os_client.block_storage, args.page_size
+                ),
+            }
+            if args.use_groups:
+                listings["groups"] = functools.partial(
+                    list_groups, args.os_client.block_storage
+                )
+                listings["group_snapshots"] = functools.partial(
+                    list_group_snapshots, args.os_client.block_storage
+                )
+            results = run_on_all_tenants(
+                args.os_client,
+                process_project,
+                args.pool_size,
+                args.wait_completion_timeout,
+                args.dry_run,
+                args.volume_concurrency,
+                args.delete_concurrency,
+                polling=args.polling,
+                state=state,
+                listings=listings,
+                scoped=True,  # Snapshots belong to the project creating them
+                backend_limits=args.backend_limits,
+                use_groups=args.use_groups,
+                **run_options(args),
+            )
+        else:
+            results = run_on_all_projects(
+                args.os_client,
+                process_project,
+                args.pool_size,
+                args.wait_completion_timeout,
+                args.dry_run,
+                args.volume_concurrency,
+                args.delete_concurrency,
+                polling=args.polling,
+                state=state,
+                metadata_filter=metadata_filter,
+                page_size=args.page_size,
+                backend_limits=args.backend_limits,
+                use_groups=args.use_groups,
+                **run_options(args),
+            )
+    finally:
+        if state is not None:
+            state.close()
+    return all(results)
@@ -0,0 +1,123 @@
+"""Compact records of the volumes and snapshots listed
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+
+from typing import Iterator, NamedTuple, Optional
+
+from openstack import resource
+from openstack.block_storage.v3.snapshot import Snapshot
+from openstack.block_storage.v3.volume import Volume
+
+from .utils import str2bool
+
+
+# The value documented to enroll a volume, the only one matched server side
+ENROLLED_METADATA = {"automatic_snapshots": "true"}
+
+
+class _EnrolledVolume(Volume):
+    """Volume listable with Cinder's metadata filter"""
+
+    _query_mapping = resource.QueryParameters(
+        "name", "status", "project_id", "metadata", all_projects="all_tenants"
+    )
+
+
+class VolumeRecord(NamedTuple):
+    """The attributes of a volume needed to snapshot it"""
+
+    id: str
+    status: str
+    volume_type: Optional[str]
+    project_id: Optional[str]
+    enrolled: bool
+    host: Optional[str] = None
+    availability_zone: Optional[str] = None
+
+    @classmethod
+    def from_resource(cls, volume: Volume) -> "VolumeRecord":
+        return cls(
+            volume.id,
+            volume.status,
+            volume.volume_type,
+            getattr(volume, "project_id", None),
+            str2bool((volume.metadata or {}).get("automatic_snapshots", "false")),
+            getattr(volume, "host", None),
+            getattr(volume, "availability_zone", None),
+        )
+
+
+class SnapshotRecord(NamedTuple):
+    """The attributes of a snapshot needed to index or expire it
+
+    expire_at is None for the snapshots which are not automatic ones.
+    """
+
+    id: str
+    status: str
+    volume_id: str
+    created_at: str
+    expire_at: Optional[str]
+    project_id: Optional[str]
+
+    @classmethod
+    def from_resource(cls, snapshot: Snapshot) -> "SnapshotRecord":
+        return cls(
+            snapshot.id,
+            snapshot.status,
+            snapshot.volume_id,
+            snapshot.created_at,
+            (snapshot.metadata or {}).get("expire_at"),
+            getattr(snapshot, "project_id", None),
+        )
+
+
+def list_snapshots(
+    block_storage, page_size: Optional[int] = None, **query
+) -> Iterator[SnapshotRecord]:
+    """Stream the snapshots as records, fetching page_size of them per request"""
+    if page_size is not None:
+        query["limit"] = page_size
+    return map(SnapshotRecord.from_resource, block_storage.snapshots(**query))
+
+
+def list_volumes(
+    block_storage,
+    metadata_filter: bool = False,
+    page_size: Optional[int] = None,
+    **query,
+) -> Iterator[VolumeRecord]:
+    """Stream the volumes as records, only the enrolled ones with metadata_filter
+
+    Volumes are still to be checked client side, the server side filter only
+    avoids downloading the volumes which are not enrolled. Up to page_size
+    volumes are fetched per request.
+    """
+    if page_size is not None:
+        query["limit"] = page_size
+    if not metadata_filter:
+        volumes = block_storage.volumes(**query)
+    else:
+        volumes = _EnrolledVolume.list(
+            block_storage,
+            base_path="/volumes/detail",
+            metadata=json.dumps(ENROLLED_METADATA),
+            **query,
+        )
+    return map(VolumeRecord.from_resource, volumes)
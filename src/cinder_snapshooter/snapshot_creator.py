@@ -16,146 +16,546 @@ limitations under the License.
 
 SPDX-License-Identifier: Apache-2.0
 """
+import collections
 import datetime
+import functools
+import os
 import sys
 
+from typing import Dict, Iterable, Optional, Union
+
+import eventlet
 import structlog
 
 from dateutil.relativedelta import relativedelta
-from openstack.block_storage.v3.volume import Volume
 from openstack.connection import Connection
 from openstack.exceptions import HttpException
 
-from .exceptions import SnapshotInError
-from .utils import create_snapshot, delete_snapshot, run_on_all_projects, str2bool
+from . import metrics
+from .backend_limits import BackendLimits, volume_slot
+from .exceptions import GroupSnapshotInError, SnapshotInError
+from .groups import (
+    GroupCreationTracker,
+    GroupDeletionTracker,
+    GroupRecord,
+    GroupSnapshotRecord,
+    create_group_snapshot,
+    delete_group_snapshot,
+    list_group_snapshots,
+    list_groups,
+)
+from .journal import RunJournal
+from .records import SnapshotRecord, VolumeRecord, list_snapshots, list_volumes
+from .state import SnapshotHistory, StateStore
+from .utils import (
+    CreationTracker,
+    DeletionTracker,
+    PollingPolicy,
+    adopt_snapshot,
+    cancelling,
+    create_snapshot,
+    delete_snapshot,
+    run_on_all_projects,
+    run_on_all_tenants,
+    run_options,
+)
 
 
 log = structlog.get_logger()
-cmd_help = "Creates automatic snapshots"
+
+
+def supports_metadata_filter(os_client: Connection) -> bool:
+    """Whether Cinder accepts to filter the volumes on their metadata
+
+    The resource filters API appeared with the microversion 3.33, older
+    deployments are considered not to filter on metadata.
+    """
+    try:
+        return any(
+            "metadata" in (resource_filter.filters or [])
+            for resource_filter in os_client.block_storage.resource_filters(
+                resource="volume"
+            )
+        )
+    except HttpException as err:
+        log.info(
+            "Unable to probe the volume filters, filtering them client side",
+            error=err.details,
+        )
+        return False
+
+
+class MetadataFilterProbe:
+    """Whether to filter the enrolled volumes server side, probed once per run
+
+    The main connection may not be scoped to any project and then has no block
+    storage endpoint, the probe is made with the first project needing it.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._supported = None
+        self._lock = eventlet.semaphore.Semaphore()
+
+    def __call__(self, os_client: Connection) -> bool:
+        if not self.enabled:
+            return False
+        with self._lock:
+            if self._supported is None:
+                self._supported = supports_metadata_filter(os_client)
+        return self._supported
+
+
+def snapshot_index(
+    snapshots: Iterable[Union[SnapshotRecord, GroupSnapshotRecord]],
+    key: str = "volume_id",
+) -> Dict[str, SnapshotHistory]:
+    """Index the available automatic snapshots by volume
+
+    The listing is streamed and only the newest snapshot of each volume is kept
+    along with whether one was created this month. Group snapshots are indexed
+    by group with key set to group_id.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    index = {}
+    for snapshot in snapshots:
+        snapshotted = getattr(snapshot, key)
+        log.debug(
+            "Looking at snapshot",
+            snapshot=snapshot.id,
+            expire_at=snapshot.expire_at,
+            **{key.replace("_id", ""): snapshotted},
+        )
+        if snapshot.status != "available":
+            continue
+        if snapshot.expire_at is None:
+            continue  # Not an automatic snapshot
+        created_at = datetime.datetime.fromisoformat(snapshot.created_at)
+        this_month = created_at.year == now.year and created_at.month == now.month
+        history = index.get(snapshotted)
+        if history is None:
+            index[snapshotted] = SnapshotHistory(created_at, this_month)
+        else:
+            index[snapshotted] = SnapshotHistory(
+                max(history.newest, created_at), history.this_month or this_month
+            )
+    return index
+
+
+def _next_expiry(history: Optional[SnapshotHistory]) -> Optional[datetime.datetime]:
+    """When the snapshot to take now expires, None when one was taken today
+
+    The snapshot will expire in 7 day unless it is the first of the month where it
+    will expire in 3 months
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if history is None or not history.this_month:
+        return now + relativedelta(months=+3)
+    if history.newest.date() == now.date():
+        return None
+    return now + relativedelta(days=+7)
 
 
 def create_snapshot_if_needed(
-    volume: Volume,
+    volume: VolumeRecord,
     os_client: Connection,
     wait_completion_timeout: int,
     dry_run: bool,
+    index: Optional[Dict[str, SnapshotHistory]] = None,
+    tracker: Optional[CreationTracker] = None,
+    state: Optional[StateStore] = None,
+    backend_limits: Optional[BackendLimits] = None,
+    journal: Optional[RunJournal] = None,
 ):
     """Create a snapshot if there isn't one for this volume today
     The snapshot will expire in 7 day unless it is the first of the month where it
     will expire in 3 months
+
+    index is the snapshot_index of the volume's project, when not given the
+    snapshots of this volume are listed. tracker is the project's
+    CreationTracker used to wait for the snapshot completion. The snapshot is
+    recorded in state once available. It is created within the cap of the
+    backend of the volume in backend_limits.
+
+    The snapshot is recorded in journal when requested and once available. A
+    snapshot requested by a previous attempt of the run is waited upon rather
+    than requested again. Returns the records of the snapshots created.
     """
-    volume_snapshots = os_client.block_storage.snapshots(
-        status="available",
-        volume_id=volume.id,
-    )
-    is_monthly = True
-    now = datetime.datetime.now(datetime.timezone.utc)
+    if journal is not None:
+        if journal.snapshotted(os_client.current_project_id, volume.id):
+            log.debug(
+                "Already a snapshot from the previous attempt for this volume",
+                volume=volume.id,
+                project=os_client.current_project_id,
+            )
+            return []
+        snapshot_id = journal.pending_snapshot(os_client.current_project_id, volume.id)
+        if snapshot_id is not None and not dry_run:
+            with volume_slot(backend_limits, volume):
+                snapshot = adopt_snapshot(
+                    os_client,
+                    volume,
+                    snapshot_id,
+                    wait_completion_timeout,
+                    tracker=tracker,
+                )
+            if snapshot is not None:
+                _record_snapshot(os_client, volume, snapshot, state, journal)
+                return [SnapshotRecord.from_resource(snapshot)]
+
+    if index is None:
+        index = snapshot_index(
+            list_snapshots(
+                os_client.block_storage, status="available", volume_id=volume.id
+            )
+        )
+    history = index.get(volume.id)
+    expiry_date = _next_expiry(history)
     created_snapshots = []
-    for snapshot in volume_snapshots:
+    if expiry_date is None:
         log.debug(
-            "Looking at snapshot",
-            snapshot=snapshot.id,
-            metadata=snapshot.metadata,
+            "Already a snapshot today for this volume",
             volume=volume.id,
             project=os_client.current_project_id,
         )
-        created_at = datetime.datetime.fromisoformat(snapshot.created_at)
-        if "expire_at" not in snapshot.metadata:
-            continue  # Not an automatic snapshot
-        if not created_at.year == now.year:
-            continue
-        if not created_at.month == now.month:
-            continue
-        # The snapshot was created this month
-        is_monthly = False
-        if created_at.day == now.day:
-            log.debug(
-                "Already a snapshot today for this volume",
-                volume=volume.id,
-                snapshot=snapshot.id,
-                project=os_client.current_project_id,
+        return created_snapshots
+
+    log.debug(
+        "Creating snapshot",
+        volume=volume.id,
+        monthly=history is None or not history.this_month,
+    )
+    if not dry_run:
+        with volume_slot(backend_limits, volume):
+            snapshot = create_snapshot(
+                os_client,
+                volume,
+                expiry_date,
+                wait_completion_timeout,
+                tracker=tracker,
+                journal=journal,
             )
-            return created_snapshots
+        created_snapshots.append(SnapshotRecord.from_resource(snapshot))
+        _record_snapshot(os_client, volume, snapshot, state, journal)
 
-    if is_monthly:
-        expiry_date = now + relativedelta(months=+3)
-    else:
-        expiry_date = now + relativedelta(days=+7)
+    return created_snapshots
 
-    log.debug("Creating snapshot", volume=volume.id, monthly=is_monthly)
-    if not dry_run:
-        created_snapshots.append(
-            create_snapshot(os_client, volume, expiry_date, wait_completion_timeout)
+
+def _record_snapshot(
+    os_client: Connection,
+    volume: VolumeRecord,
+    snapshot,
+    state: Optional[StateStore],
+    journal: Optional[RunJournal],
+):
+    if state is not None:
+        state.record(
+            os_client.current_project_id,
+            volume.id,
+            datetime.datetime.fromisoformat(snapshot.created_at),
         )
+    if journal is not None:
+        journal.snapshot_available(os_client.current_project_id, volume.id)
 
-    return created_snapshots
+
+def create_group_snapshot_if_needed(
+    group: GroupRecord,
+    os_client: Connection,
+    wait_completion_timeout: int,
+    dry_run: bool,
+    index: Dict[str, SnapshotHistory],
+    tracker: Optional[GroupCreationTracker] = None,
+):
+    """Snapshot every volume of group at once if it was not today
+
+    The group snapshot expires as a snapshot of a single volume would. index is
+    the snapshot_index of the group snapshots of the project, by group. Returns
+    the record of the group snapshot created.
+    """
+    history = index.get(group.id)
+    expiry_date = _next_expiry(history)
+    if expiry_date is None:
+        log.debug(
+            "Already a snapshot today for this group",
+            group=group.id,
+            project=os_client.current_project_id,
+        )
+        return []
+
+    log.debug(
+        "Creating group snapshot",
+        group=group.id,
+        volumes=len(group.volume_ids),
+        monthly=history is None or not history.this_month,
+    )
+    if dry_run:
+        return []
+    return [
+        GroupSnapshotRecord.from_resource(
+            create_group_snapshot(
+                os_client,
+                group,
+                expiry_date,
+                wait_completion_timeout,
+                tracker=tracker,
+            )
+        )
+    ]
 
 
 def process_volumes(
     os_client: Connection,
     wait_completion_timeout: int,
     dry_run: bool,
+    volume_concurrency: int = 1,
+    volumes: Optional[Iterable[VolumeRecord]] = None,
+    snapshots: Optional[Iterable[SnapshotRecord]] = None,
+    polling: Optional[PollingPolicy] = None,
+    state: Optional[StateStore] = None,
+    metadata_filter: Union[bool, MetadataFilterProbe] = False,
+    page_size: Optional[int] = None,
+    backend_limits: Optional[BackendLimits] = None,
+    use_groups: bool = False,
+    groups: Optional[Iterable[GroupRecord]] = None,
+    group_snapshots: Optional[Iterable[GroupSnapshotRecord]] = None,
+    journal: Optional[RunJournal] = None,
 ):
-    """Process all volumes searching for the ones with automatic snapshots"""
+    """Process all volumes searching for the ones with automatic snapshots
+
+    Up to volume_concurrency volumes of the project are processed concurrently,
+    the completion of the snapshots they create is polled for all of them at once.
+    volumes and snapshots are the volumes and snapshots of the project when they
+    were already listed. polling is the PollingPolicy of the completion waits.
+
+    When a state is given, the snapshots of the project are only listed if it is
+    stale or misses one of the volumes, the state is then reconciled with them.
+    With metadata_filter, or if its MetadataFilterProbe says so, only the
+    enrolled volumes are listed. Listings are
+    streamed page_size resources at a time, only compact records of the
+    resources being kept. Snapshots are created, and the ones in error deleted,
+    within the caps backend_limits sets on the backends of their volumes.
+
+    With use_groups, the volumes of a generic volume group which are all
+    enrolled are snapshotted at once by a group snapshot. groups and
+    group_snapshots are the groups and group snapshots of the project when they
+    were already listed.
+
+    The snapshots of the volumes are recorded in journal, the one of the run,
+    for an attempt resuming it to carry on with them.
+    """
     snapshot_created = 0
+    group_snapshot_created = 0
     errors = 0
     in_error = []
-    for volume in os_client.block_storage.volumes():
-        if volume.status not in ["available", "in-use"]:
-            continue
-        log.debug("Processing volume", volume=volume.id)
-        if str2bool(volume.metadata.get("automatic_snapshots", "false")):
-            try:
-                snapshot_created += len(
-                    create_snapshot_if_needed(
-                        volume,
-                        os_client,
-                        wait_completion_timeout,
-                        dry_run,
-                    )
+    group_in_error = []
+    index = None
+    group_index = None
+    known = None
+    if state is not None and snapshots is None:
+        known = state.index(os_client.current_project_id)
+    tracker = CreationTracker(os_client, wait_completion_timeout, polling)
+    pool = eventlet.GreenPool(size=volume_concurrency)
+
+    # Outcomes are tallied as soon as known, neither the green threads nor the
+    # snapshots they created are kept until the end of the project
+    def tally_volume(volume: VolumeRecord, volume_index: Dict[str, SnapshotHistory]):
+        nonlocal snapshot_created, errors
+        try:
+            snapshot_created += len(
+                create_snapshot_if_needed(
+                    volume,
+                    os_client,
+                    wait_completion_timeout,
+                    dry_run,
+                    volume_index,
+                    tracker,
+                    state,
+                    backend_limits,
+                    journal,
                 )
-            except SnapshotInError as err:
-                log.error(
-                    "Created snapshot in error",
-                    volume=err.snapshot.volume_id,
-                    snapshot=err.snapshot.id,
-                    project=os_client.current_project_id,
+            )
+        except SnapshotInError as err:
+            log.error(
+                "Created snapshot in error",
+                volume=err.snapshot.volume_id,
+                snapshot=err.snapshot.id,
+                project=os_client.current_project_id,
+            )
+            errors += 1
+            in_error.append((volume, SnapshotRecord.from_resource(err.snapshot)))
+        except HttpException as err:
+            log.error(
+                "Failed to create snapshot",
+                error=err.details,
+                request_id=err.request_id,
+                project=os_client.current_project_id,
+                volume=volume.id,
+            )
+            errors += 1
+        except Exception:
+            log.exception(
+                "Unable to create snapshot",
+                volume=volume.id,
+                project=os_client.current_project_id,
+            )
+            errors += 1
+
+    def tally_group(
+        group: GroupRecord,
+        group_index: Dict[str, SnapshotHistory],
+        group_tracker: GroupCreationTracker,
+    ):
+        nonlocal group_snapshot_created, errors
+        try:
+            group_snapshot_created += len(
+                create_group_snapshot_if_needed(
+                    group,
+                    os_client,
+                    wait_completion_timeout,
+                    dry_run,
+                    group_index,
+                    group_tracker,
                 )
-                errors += 1
-                in_error.append(err.snapshot)
-            except HttpException as err:
-                log.error(
-                    "Failed to create snapshot",
-                    error=err.details,
-                    request_id=err.request_id,
+            )
+        except GroupSnapshotInError as err:
+            log.error(
+                "Created group snapshot in error",
+                group=group.id,
+                group_snapshot=err.snapshot.id,
+                project=os_client.current_project_id,
+            )
+            errors += 1
+            group_in_error.append(GroupSnapshotRecord.from_resource(err.snapshot))
+        except HttpException as err:
+            log.error(
+                "Failed to create group snapshot",
+                error=err.details,
+                request_id=err.request_id,
+                project=os_client.current_project_id,
+                group=group.id,
+            )
+            errors += 1
+        except Exception:
+            log.exception(
+                "Unable to create group snapshot",
+                group=group.id,
+                project=os_client.current_project_id,
+            )
+            errors += 1
+
+    def snapshot_volume(volume: VolumeRecord):
+        nonlocal index, snapshots
+        if known is not None and volume.id in known:
+            volume_index = known
+        else:
+            if index is None:
+                # One listing for the whole project, only if a volume needs it
+                if snapshots is None:
+                    snapshots = list_snapshots(
+                        os_client.block_storage, page_size, status="available"
+                    )
+                index = snapshot_index(snapshots)
+                if state is not None:
+                    state.reconcile(os_client.current_project_id, index)
+            volume_index = index
+        pool.spawn(tally_volume, volume, volume_index)
+
+    with cancelling(pool):
+        members = {}
+        if use_groups:
+            if groups is None:
+                groups = list_groups(os_client.block_storage)
+            groups = {group.id: group for group in groups}
+            members = {
+                volume_id: group.id
+                for group in groups.values()
+                for volume_id in group.volume_ids
+            }
+        grouped = collections.defaultdict(list)
+        if volumes is None:
+            if isinstance(metadata_filter, MetadataFilterProbe):
+                metadata_filter = metadata_filter(os_client)
+            volumes = list_volumes(os_client.block_storage, metadata_filter, page_size)
+        for volume in volumes:
+            if volume.status not in ["available", "in-use"]:
+                continue
+            log.debug("Processing volume", volume=volume.id)
+            if volume.enrolled:
+                if volume.id in members:
+                    # Snapshotted with its group once all its volumes are known
+                    grouped[members[volume.id]].append(volume)
+                else:
+                    snapshot_volume(volume)
+
+        for group_id, group_volumes in grouped.items():
+            group = groups[group_id]
+            if group.status != "available" or len(group_volumes) < len(
+                group.volume_ids
+            ):
+                log.info(
+                    "Group not fully enrolled, snapshotting its volumes one by one",
+                    group=group.id,
+                    status=group.status,
+                    enrolled=len(group_volumes),
+                    volumes=len(group.volume_ids),
                     project=os_client.current_project_id,
-                    volume=volume.id,
                 )
-                errors += 1
+                for volume in group_volumes:
+                    snapshot_volume(volume)
+                continue
+            if group_index is None:
+                if group_snapshots is None:
+                    group_snapshots = list_group_snapshots(os_client.block_storage)
+                group_index = snapshot_index(group_snapshots, key="group_id")
+                group_tracker = GroupCreationTracker(
+                    os_client, wait_completion_timeout, polling
+                )
+            pool.spawn(tally_group, group, group_index, group_tracker)
+
+        pool.waitall()
+
+        # Delete failed snapshots right away.
+        # We can re-run the tool to try to create them again
+        deletion_tracker = DeletionTracker(os_client, wait_completion_timeout, polling)
+        for volume, s in in_error:
+            try:
+                with volume_slot(backend_limits, volume):
+                    delete_snapshot(
+                        os_client, s, wait_completion_timeout, tracker=deletion_tracker
+                    )
             except Exception:
                 log.exception(
-                    "Unable to create snapshot",
-                    volume=volume.id,
+                    "Failed to delete snapshot in error",
+                    snapshot=s.id,
                     project=os_client.current_project_id,
                 )
-                errors += 1
-
-    # Delete failed snapshots right away.
-    # We can re-run the tool to try to create them again
-    for s in in_error:
-        try:
-            delete_snapshot(os_client, s, wait_completion_timeout)
-        except Exception:
-            log.exception(
-                "Failed to delete snapshot in error",
-                snapshot=s.id,
-                project=os_client.current_project_id,
+        if group_in_error:
+            group_deletion_tracker = GroupDeletionTracker(
+                os_client, wait_completion_timeout, polling
             )
+        for group_snapshot in group_in_error:
+            try:
+                delete_group_snapshot(
+                    os_client,
+                    group_snapshot,
+                    wait_completion_timeout,
+                    tracker=group_deletion_tracker,
+                )
+            except Exception:
+                log.exception(
+                    "Failed to delete group snapshot in error",
+                    group_snapshot=group_snapshot.id,
+                    project=os_client.current_project_id,
+                )
 
+    metrics.SNAPSHOT_ERRORS.inc(
+        errors, project=os_client.current_project_id, operation="create"
+    )
     log.info(
         "All volumes processed for project",
         project=os_client.current_project_id,
         snapshot_created=snapshot_created,
+        group_snapshot_created=group_snapshot_created,
         errors=errors,
     )
     return errors == 0
@@ -169,17 +569,112 @@ def register_args(parser):
         action="store_true",
         help="Do not create any snapshot, only pretend to",
     )
+    register_options(parser)
+
+
+def register_options(parser):
+    """Registers the arguments shared with the daemon subcommand"""
+    parser.add_argument(
+        "--volume-concurrency",
+        dest="volume_concurrency",
+        default=os.environ.get("VOLUME_CONCURRENCY", 1),
+        type=int,
+        help="the number of volumes of a project to be processed concurrently "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--state-file",
+        dest="state_file",
+        default=os.environ.get("STATE_FILE"),
+        help="an SQLite file keeping the automatic snapshots created, to avoid "
+        "listing the snapshots of every project (default: no state)",
+    )
+    parser.add_argument(
+        "--state-max-age",
+        dest="state_max_age",
+        default=os.environ.get("STATE_MAX_AGE", 7 * 24 * 3600),
+        type=int,
+        help="the time in seconds the state of a project is trusted before "
+        "being reconciled with its snapshots (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--server-side-filter",
+        dest="server_side_filter",
+        action="store_true",
+        help="only list the volumes whose automatic_snapshots property is "
+        "exactly true when Cinder can filter them on their metadata, the other "
+        "spellings of true are then missed",
+    )
 
 
 def cli(args):
     """Entrypoint for CLI subcommand"""
-    if not all(
-        run_on_all_projects(
-            args.os_client,
-            process_volumes,
-            args.pool_size,
-            args.wait_completion_timeout,
-            args.dry_run,
-        )
-    ):
+    if not run(args):
         sys.exit(1)  # Something went wrong during execution exit with 1
+
+
+def run(args) -> bool:
+    """Process all projects, returns whether it succeeded everywhere"""
+    metadata_filter = MetadataFilterProbe(args.server_side_filter)
+    state = None
+    if args.state_file is not None:
+        state = StateStore(args.state_file, args.state_max_age)
+    try:
+        if args.all_tenants:
+            listings = {
+                "volumes": functools.partial(
+                    list_volumes,
+                    args.os_client.block_storage,
+                    # Listing all tenants needs an admin token scoped to a project
+                    metadata_filter(args.os_client),
+                    args.page_size,
+                ),
+                "snapshots": functools.partial(
+                    list_snapshots,
+                    args.os_client.block_storage,
+                    args.page_size,
+                    status="available",
+                ),
+            }
+            if args.use_groups:
+                listings["groups"] = functools.partial(
+                    list_groups, args.os_client.block_storage
+                )
+                listings["group_snapshots"] = functools.partial(
+                    list_group_snapshots, args.os_client.block_storage
+                )
+            results = run_on_all_tenants(
+                args.os_client,
+                process_volumes,
+                args.pool_size,
+                args.wait_completion_timeout,
+                args.dry_run,
+                args.volume_concurrency,
+                polling=args.polling,
+                state=state,
+                listings=listings,
+                scoped=True,  # Snapshots belong to the project creating them
+                backend_limits=args.backend_limits,
+                use_groups=args.use_groups,
+                **run_options(args),
+            )
+        else:
+            results = run_on_all_projects(
+                args.os_client,
+                process_volumes,
+                args.pool_size,
+                args.wait_completion_timeout,
+                args.dry_run,
+                args.volume_concurrency,
+                polling=args.polling,
+                state=state,
+                metadata_filter=metadata_filter,
+                page_size=args.page_size,
+                backend_limits=args.backend_limits,
+                use_groups=args.use_groups,
+                **run_options(args),
+            )
+    finally:
+        if state is not None:
+            state.close()
+    return all(results)
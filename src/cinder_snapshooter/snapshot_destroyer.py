@@ -16,92 +16,225 @@ limitations under the License.
 
 SPDX-License-Identifier: Apache-2.0
 """
+import contextlib
 import datetime
+import functools
+import itertools
+import os
 import sys
 
+from typing import Iterable, Optional
+
+import eventlet
 import structlog
 
 from openstack.connection import Connection
 
-from .utils import delete_snapshot, run_on_all_projects
+from . import metrics
+from .backend_limits import UNKNOWN_BACKEND, BackendLimits
+from .exceptions import SnapshotStillPresent
+from .groups import (
+    GroupDeletionTracker,
+    GroupSnapshotRecord,
+    delete_group_snapshot,
+    list_group_snapshots,
+)
+from .records import SnapshotRecord, VolumeRecord, list_snapshots, list_volumes
+from .utils import (
+    DeletionTracker,
+    PollingPolicy,
+    cancelling,
+    delete_snapshot,
+    run_on_all_projects,
+    run_on_all_tenants,
+    run_options,
+)
 
 
 log = structlog.get_logger()
-cmd_help = "Destroys expired snapshots"
+
+
+def is_expired(os_client: Connection, snapshot: SnapshotRecord) -> bool:
+    """Whether snapshot is an automatic snapshot past its expiry date"""
+    log.debug(
+        "Looking at snapshot",
+        snapshot=snapshot.id,
+        project=os_client.current_project_id,
+    )
+    if snapshot.expire_at is None:
+        return False
+    expire_at = datetime.datetime.combine(
+        date=datetime.date.fromisoformat(snapshot.expire_at),
+        time=datetime.time.min,
+        tzinfo=datetime.timezone.utc,
+    )
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if now > expire_at:
+        log.debug(
+            "Deleting snapshot",
+            snapshot=snapshot.id,
+            project=os_client.current_project_id,
+            expire_at=expire_at.isoformat(),
+        )
+        return True
+    log.debug(
+        "Keeping snapshot, still valid",
+        snapshot=snapshot.id,
+        expire_at=expire_at.isoformat(),
+    )
+    return False
+
+
+def _error_message(os_client: Connection, snapshot) -> Optional[str]:
+    """The message logged if deleting snapshot fails, None to keep snapshot"""
+    if snapshot.status == "available":
+        if is_expired(os_client, snapshot):
+            return "Failed to delete snapshot"
+    elif snapshot.status == "error":
+        # Cleanup left-over snapshots in error
+        if snapshot.expire_at is not None:
+            log.debug(
+                "Deleting snapshot in error",
+                snapshot=snapshot.id,
+                project=os_client.current_project_id,
+            )
+            return "Failed to delete snapshot in error"
+    return None
+
+
+def _delete_snapshot(slot, *args, **kwargs):
+    with slot:
+        return delete_snapshot(*args, **kwargs)
 
 
 def process_snapshots(
     os_client: Connection,
     wait_completion_timeout: int,
     dry_run: bool,
+    delete_concurrency: int = 1,
+    snapshots: Optional[Iterable[SnapshotRecord]] = None,
+    polling: Optional[PollingPolicy] = None,
+    page_size: Optional[int] = None,
+    volumes: Optional[Iterable[VolumeRecord]] = None,
+    backend_limits: Optional[BackendLimits] = None,
+    use_groups: bool = False,
+    group_snapshots: Optional[Iterable[GroupSnapshotRecord]] = None,
 ):
-    """Delete every expired snapshot"""
+    """Delete every expired snapshot
+
+    Up to delete_concurrency deletions are issued concurrently, the
+    disappearance of the deleted snapshots is then checked for all of them at
+    once. snapshots are the snapshots of the project when already listed,
+    polling is the PollingPolicy of the deletion checks. The snapshots are
+    listed page_size at a time.
+
+    With backend_limits, the deletions are made within the cap of the backend of
+    the volume of each snapshot. volumes are the volumes of the project when
+    already listed, they are otherwise listed once a snapshot is to be deleted.
+
+    With use_groups, the expired automatic group snapshots are deleted as well,
+    group_snapshots being the group snapshots of the project when already
+    listed. Their snapshots span several volumes, they are not capped by
+    backend_limits.
+    """
+    backends = None
     destroyed_snapshot = 0
+    destroyed_group_snapshot = 0
     errors = 0
-    for snapshot in os_client.block_storage.snapshots(status="available"):
-        log.debug(
-            "Looking at snapshot",
-            snapshot=snapshot.id,
-            project=os_client.current_project_id,
-        )
-        if "expire_at" not in snapshot.metadata:
-            continue
-        expire_at = datetime.datetime.combine(
-            date=datetime.date.fromisoformat(snapshot.metadata["expire_at"]),
-            time=datetime.time.min,
-            tzinfo=datetime.timezone.utc,
-        )
-        now = datetime.datetime.now(datetime.timezone.utc)
-        if now > expire_at:
-            log.debug(
-                "Deleting snapshot",
+    still_present = []
+    pool = eventlet.GreenPool(size=delete_concurrency)
+    tracker = DeletionTracker(os_client, wait_completion_timeout, polling)
+
+    # Outcomes are tallied as soon as known rather than keeping the green threads
+    def tally(snapshot, error_message: str, delete, *args, **kwargs):
+        nonlocal destroyed_snapshot, destroyed_group_snapshot, errors
+        try:
+            delete(*args, **kwargs)
+            if isinstance(snapshot, GroupSnapshotRecord):
+                destroyed_group_snapshot += 1
+            else:
+                destroyed_snapshot += 1
+        except SnapshotStillPresent as err:
+            log.error(
+                "Snapshot still present after deletion",
+                project=os_client.current_project_id,
                 snapshot=snapshot.id,
+                status=err.snapshot.status,
+            )
+            still_present.append(snapshot.id)
+            errors += 1
+        except Exception:
+            log.exception(
+                error_message,
                 project=os_client.current_project_id,
-                expire_at=expire_at.isoformat(),
+                snapshot=snapshot.id,
+            )
+            errors += 1
+
+    with cancelling(pool):
+        if snapshots is None:
+            snapshots = itertools.chain(
+                list_snapshots(os_client.block_storage, page_size, status="available"),
+                list_snapshots(os_client.block_storage, page_size, status="error"),
             )
+        for snapshot in snapshots:
+            error_message = _error_message(os_client, snapshot)
+            if error_message is None:
+                continue
             if not dry_run:
-                try:
-                    delete_snapshot(os_client, snapshot, wait_completion_timeout)
-                    destroyed_snapshot += 1
-                except Exception:
-                    log.exception(
-                        "Failed to delete snapshot",
-                        project=os_client.current_project_id,
-                        snapshot=snapshot.id,
+                slot = contextlib.nullcontext()
+                if backend_limits is not None:
+                    if backends is None:
+                        backends = backend_limits.volume_backends(
+                            os_client.block_storage, volumes, page_size
+                        )
+                    slot = backend_limits.slot(
+                        backends.get(snapshot.volume_id, UNKNOWN_BACKEND)
                     )
-                    errors += 1
-        else:
-            log.debug(
-                "Keeping snapshot, still valid",
-                snapshot=snapshot.id,
-                expire_at=expire_at.isoformat(),
-            )
+                pool.spawn(
+                    tally,
+                    snapshot,
+                    error_message,
+                    _delete_snapshot,
+                    slot,
+                    os_client,
+                    snapshot,
+                    wait_completion_timeout,
+                    tracker=tracker,
+                )
 
-    # Cleanup left-over snapshots in error
-    for snapshot in os_client.block_storage.snapshots(status="error"):
-        if "expire_at" not in snapshot.metadata:
-            continue
-        log.debug(
-            "Deleting snapshot in error",
-            snapshot=snapshot.id,
-            project=os_client.current_project_id,
-        )
-        if not dry_run:
-            try:
-                delete_snapshot(os_client, snapshot, wait_completion_timeout)
-                destroyed_snapshot += 1
-            except Exception:
-                log.exception(
-                    "Failed to delete snapshot in error",
-                    project=os_client.current_project_id,
-                    snapshot=snapshot.id,
+        if use_groups:
+            if group_snapshots is None:
+                group_snapshots = list_group_snapshots(os_client.block_storage)
+            group_tracker = GroupDeletionTracker(
+                os_client, wait_completion_timeout, polling
+            )
+            for group_snapshot in group_snapshots:
+                error_message = _error_message(os_client, group_snapshot)
+                if error_message is None or dry_run:
+                    continue
+                pool.spawn(
+                    tally,
+                    group_snapshot,
+                    error_message,
+                    delete_group_snapshot,
+                    os_client,
+                    group_snapshot,
+                    wait_completion_timeout,
+                    tracker=group_tracker,
                 )
-                errors += 1
 
+        pool.waitall()
+
+    metrics.SNAPSHOT_ERRORS.inc(
+        errors, project=os_client.current_project_id, operation="delete"
+    )
     log.info(
         "Processed all snapshots in project",
         destroyed_snapshot=destroyed_snapshot,
+        destroyed_group_snapshot=destroyed_group_snapshot,
         errors=errors,
+        still_present=still_present,
         project=os_client.current_project_id,
     )
     return errors == 0
@@ -115,18 +248,69 @@ def register_args(parser):
         action="store_true",
         help="Do not create any snapshot, only pretend to",
     )
+    register_options(parser)
+
+
+def register_options(parser):
+    """Registers the arguments shared with the daemon subcommand"""
+    parser.add_argument(
+        "--delete-concurrency",
+        dest="delete_concurrency",
+        default=os.environ.get("DELETE_CONCURRENCY", 10),
+        type=int,
+        help="the number of snapshots of a project to be deleted concurrently "
+        "(default: %(default)s)",
+    )
 
 
 def cli(args):
     """Entrypoint for CLI subcommand"""
+    if not run(args):
+        sys.exit(1)  # Something went wrong during execution exit with 1
 
-    if not all(
-        run_on_all_projects(
+
+def run(args) -> bool:
+    """Process all projects, returns whether it succeeded everywhere"""
+    if args.all_tenants:
+        listings = {
+            "snapshots": functools.partial(
+                list_snapshots, args.os_client.block_storage, args.page_size
+            )
+        }
+        if args.backend_limits is not None:
+            # The backend of the snapshots is the one of their volume
+            listings["volumes"] = functools.partial(
+                list_volumes, args.os_client.block_storage, page_size=args.page_size
+            )
+        if args.use_groups:
+            listings["group_snapshots"] = functools.partial(
+                list_group_snapshots, args.os_client.block_storage
+            )
+        results = run_on_all_tenants(
             args.os_client,
             process_snapshots,
             args.pool_size,
             args.wait_completion_timeout,
             args.dry_run,
+            args.delete_concurrency,
+            polling=args.polling,
+            listings=listings,
+            backend_limits=args.backend_limits,
+            use_groups=args.use_groups,
+            **run_options(args),
         )
-    ):
-        sys.exit(1)  # Something went wrong during execution exit with 1
+    else:
+        results = run_on_all_projects(
+            args.os_client,
+            process_snapshots,
+            args.pool_size,
+            args.wait_completion_timeout,
+            args.dry_run,
+            args.delete_concurrency,
+            polling=args.polling,
+            page_size=args.page_size,
+            backend_limits=args.backend_limits,
+            use_groups=args.use_groups,
+            **run_options(args),
+        )
+    return all(results)
@@ -0,0 +1,169 @@
+"""Local state of the automatic snapshots created
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import sqlite3
+
+from typing import Dict, NamedTuple, Optional
+
+import eventlet.semaphore
+import structlog
+
+
+log = structlog.get_logger()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    project_id TEXT NOT NULL,
+    volume_id TEXT NOT NULL,
+    month TEXT NOT NULL,
+    last_snapshot_at TEXT NOT NULL,
+    PRIMARY KEY (project_id, volume_id, month)
+);
+CREATE TABLE IF NOT EXISTS projects (
+    project_id TEXT PRIMARY KEY,
+    reconciled_at TEXT NOT NULL
+);
+"""
+
+
+class SnapshotHistory(NamedTuple):
+    """What we need to know about the automatic snapshots of a volume"""
+
+    newest: datetime.datetime
+    this_month: bool
+
+
+def _utc(value: datetime.datetime) -> datetime.datetime:
+    # Cinder gives naive UTC timestamps
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+
+def _month(value: datetime.datetime) -> str:
+    return value.strftime("%Y-%m")
+
+
+class StateStore:
+    """Last automatic snapshot of each volume, per month, in an SQLite file
+
+    The state of a project is trusted for max_age seconds after it was last
+    reconciled with a listing of its snapshots, it is then stale.
+    """
+
+    def __init__(self, path: str, max_age: int):
+        self.path = path
+        self.max_age = datetime.timedelta(seconds=max_age)
+        # Greenlets share the connection, they all run in the same thread
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = eventlet.semaphore.Semaphore()
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def _history(self, project_id: str) -> Dict[str, SnapshotHistory]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rows = self._db.execute(
+            "SELECT volume_id, MAX(last_snapshot_at), MAX(month = ?) "
+            "FROM snapshots WHERE project_id = ? GROUP BY volume_id",
+            (_month(now), project_id),
+        )
+        return {
+            volume_id: SnapshotHistory(
+                datetime.datetime.fromisoformat(newest), bool(this_month)
+            )
+            for volume_id, newest, this_month in rows
+        }
+
+    def _reconciled_at(self, project_id: str) -> Optional[datetime.datetime]:
+        row = self._db.execute(
+            "SELECT reconciled_at FROM projects WHERE project_id = ?", (project_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.fromisoformat(row[0])
+
+    def index(self, project_id: str) -> Optional[Dict[str, SnapshotHistory]]:
+        """The snapshot history of the project's volumes, None if stale"""
+        with self._lock:
+            reconciled_at = self._reconciled_at(project_id)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if reconciled_at is None or now - reconciled_at > self.max_age:
+                return None
+            return self._history(project_id)
+
+    def record(self, project_id: str, volume_id: str, created_at: datetime.datetime):
+        """Record an automatic snapshot confirmed available"""
+        created_at = _utc(created_at)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO snapshots VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (project_id, volume_id, month) DO UPDATE "
+                "SET last_snapshot_at = "
+                "MAX(last_snapshot_at, excluded.last_snapshot_at)",
+                (project_id, volume_id, _month(created_at), created_at.isoformat()),
+            )
+
+    def reconcile(self, project_id: str, index: Dict[str, SnapshotHistory]):
+        """Replace the state of the project with index, listed from the API"""
+        index = {
+            volume_id: SnapshotHistory(_utc(history.newest), history.this_month)
+            for volume_id, history in index.items()
+        }
+        with self._lock:
+            self._reconcile(project_id, index)
+
+    def _reconcile(self, project_id: str, index: Dict[str, SnapshotHistory]):
+        disagreeing = []
+        if self._reconciled_at(project_id) is not None:
+            known = self._history(project_id)
+            disagreeing = [
+                volume_id
+                for volume_id in known.keys() | index.keys()
+                if known.get(volume_id) != index.get(volume_id)
+            ]
+        if disagreeing:
+            log.warning(
+                "Local state disagreed with the API",
+                project=project_id,
+                volumes=sorted(disagreeing),
+            )
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._db:
+            self._db.execute(
+                "DELETE FROM snapshots WHERE project_id = ?", (project_id,)
+            )
+            self._db.executemany(
+                "INSERT INTO snapshots VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        project_id,
+                        volume_id,
+                        _month(history.newest),
+                        history.newest.isoformat(),
+                    )
+                    for volume_id, history in index.items()
+                ],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO projects VALUES (?, ?)",
+                (project_id, now.isoformat()),
+            )
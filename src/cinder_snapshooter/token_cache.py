@@ -0,0 +1,111 @@
+"""On-disk cache of the project scoped tokens
+
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import json
+import os
+import tempfile
+
+from typing import Optional
+
+import structlog
+
+from keystoneauth1.identity.base import BaseIdentityPlugin
+from openstack.connection import Connection
+
+
+log = structlog.get_logger()
+
+
+def write_atomically(path: str, content: str, mode: int = 0o600):
+    """Replace the file at path with content, readable by its owner only"""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=f".{os.path.basename(path)}.",
+    )
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class TokenCache:
+    """Scoped tokens kept between runs
+
+    A token is only reused when it is still valid for at least min_validity
+    seconds, the expected duration of a run.
+    """
+
+    def __init__(self, path: str, min_validity: int):
+        self.path = path
+        self.min_validity = datetime.timedelta(seconds=min_validity)
+        self._tokens = {}
+        try:
+            with open(self.path) as cache_file:
+                self._tokens = json.load(cache_file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            log.warning("Unable to read token cache, ignoring it", path=self.path)
+
+    @staticmethod
+    def key(os_client: Connection, trust_id: Optional[str], project_id: str) -> str:
+        """Identify the scoped token of a project for the user of os_client"""
+        if trust_id is None:
+            scope = f"project:{project_id}"
+        else:
+            scope = f"trust:{trust_id}"
+        return f"{os_client.config.name}:{os_client.current_user_id}:{scope}"
+
+    def restore(self, key: str, auth: BaseIdentityPlugin) -> bool:
+        """Install the cached token in auth if it is valid long enough"""
+        entry = self._tokens.get(key)
+        if entry is None:
+            return False
+        expires_at = datetime.datetime.fromisoformat(entry["expires_at"])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if expires_at - now < self.min_validity:
+            return False
+        auth.set_auth_state(entry["auth_state"])
+        return True
+
+    def store(self, key: str, auth: BaseIdentityPlugin):
+        """Record the token currently used by auth"""
+        if auth.auth_ref is None:
+            return
+        self._tokens[key] = {
+            "expires_at": auth.auth_ref.expires.isoformat(),
+            "auth_state": auth.get_auth_state(),
+        }
+
+    def save(self):
+        """Write the still valid tokens to disk"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        tokens = {
+            key: entry
+            for key, entry in self._tokens.items()
+            if datetime.datetime.fromisoformat(entry["expires_at"]) > now
+        }
+        write_atomically(self.path, json.dumps(tokens))
+        log.debug("Saved token cache", path=self.path, tokens=len(tokens))
@@ -16,12 +16,34 @@ limitations under the License.
 
 SPDX-License-Identifier: Apache-2.0
 """
+import abc
+import collections
+import contextlib
 import datetime
+import functools
+import hashlib
+import inspect
+import itertools
 import logging
+import random
+import statistics
+import time
 
-from typing import Optional
+from typing import (
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
 import eventlet
+import eventlet.event
+import eventlet.semaphore
 import keystoneauth1.exceptions
 import structlog
 
@@ -31,20 +53,281 @@ from openstack.connection import Connection
 from openstack.exceptions import ResourceNotFound
 from tenacity import (
     Retrying,
-    TryAgain,
     retry_if_not_exception_type,
     stop_after_attempt,
-    stop_after_delay,
     wait_random,
 )
 
-from .exceptions import SnapshotInError, SnapshotStillPresent
+from . import metrics
+from .exceptions import (
+    DeadlineReached,
+    SnapshotCreationTimeout,
+    SnapshotInError,
+    SnapshotStillPresent,
+)
+from .journal import Journal, RunJournal
+from .project_stats import ProjectStats
+from .token_cache import TokenCache
 
 
 log = structlog.get_logger()
 
 DEFAULT_DELETE_RETRIES = 3
 DEFAULT_CREATE_RETRIES = 3
+DEFAULT_DURATIONS_KEPT = 1000
+# Failing to authenticate to the project, the next attempts would fail as well
+RETRY_UNLESS_AUTH_FAILED = retry_if_not_exception_type(
+    keystoneauth1.exceptions.HTTPClientError
+)
+
+
+class PollingPolicy:
+    """How long to wait between two polls of a pending snapshot
+
+    Waits start at initial_delay and grow by factor up to max_delay, each one
+    being drawn at random in its upper half. When adaptive, the first wait is
+    seeded with the median completion time seen so far in the run for the same
+    kind of operation and volume type.
+    """
+
+    def __init__(
+        self,
+        initial_delay: float = 1,
+        max_delay: float = 10,
+        factor: float = 2,
+        adaptive: bool = True,
+    ):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.adaptive = adaptive
+        self._durations = collections.defaultdict(
+            lambda: collections.deque(maxlen=DEFAULT_DURATIONS_KEPT)
+        )
+
+    def delays(self, key: Hashable = None) -> Iterator[float]:
+        """Successive waits for an operation of the given kind"""
+        delay = self.initial_delay
+        if self.adaptive and self._durations.get(key):
+            delay = statistics.median(self._durations[key])
+        delay = min(max(delay, self.initial_delay), self.max_delay)
+        while True:
+            yield random.uniform(delay / 2, delay)
+            delay = min(delay * self.factor, self.max_delay)
+
+    def record(self, key: Hashable, duration: float):
+        """Record the completion time of an operation of the given kind"""
+        self._durations[key].append(duration)
+
+
+class _PendingSnapshot:
+    __slots__ = ("snapshot", "event", "key", "submitted_at", "deadline", "delays")
+
+    def __init__(self, snapshot, key, timeout, delays):
+        self.snapshot = snapshot
+        self.event = eventlet.event.Event()
+        self.key = key
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout
+        self.delays = delays
+
+
+class SnapshotTracker(abc.ABC):
+    """Wait for the status of many snapshots of a project to change
+
+    Every snapshot waited upon is recorded and a single poller resolves all of
+    them each round, whatever the number of snapshots in flight. A round lists
+    the project snapshots in the pending_status of the operation, then in the
+    settled_statuses it fails in, then in the recent_status it succeeds in back
+    to the oldest pending snapshot, the listings being sorted newest first.
+    The pending snapshots missing from these listings are fetched one by one,
+    unless unlisted_gone tells they no longer exist. A single pending snapshot
+    is fetched with one GET. Rounds happen when the earliest pending snapshot
+    is due as per polling.
+    """
+
+    kind = None
+    pending_status = None
+    settled_statuses = ()
+    recent_status = None
+    unlisted_gone = False
+
+    def __init__(
+        self,
+        os_client: Connection,
+        timeout: int,
+        polling: Optional[PollingPolicy] = None,
+    ):
+        self.os_client = os_client
+        self.timeout = timeout
+        self.polling = polling or PollingPolicy()
+        self._pending = {}
+        self._next_polls = {}
+        self._poller = None
+
+    def wait(self, snapshot: Snapshot, key: Hashable = None) -> Snapshot:
+        """Block until the snapshot is resolved and return its last known state
+
+        key tells apart the snapshots completing at different paces, the volume
+        type for instance.
+        """
+        key = (self.kind, key)
+        pending = _PendingSnapshot(
+            snapshot, key, self.timeout, self.polling.delays(key)
+        )
+        self._pending[snapshot.id] = pending
+        self._schedule(snapshot.id, pending.submitted_at)
+        if self._poller is None:
+            self._poller = eventlet.spawn(self._poll)
+        try:
+            return pending.event.wait()
+        finally:
+            if self._pending.get(snapshot.id) is pending:
+                # The waiter was killed, its project cancelled: stop polling for it
+                self._resolve(snapshot.id)
+                if not self._pending and self._poller is not None:
+                    self._poller.kill()
+
+    @abc.abstractmethod
+    def check(self, snapshot: Snapshot, current: Optional[Snapshot]):
+        """Return the resolved snapshot, None if still pending or raise on failure
+
+        current is the state fetched this round, None if it was not found.
+        """
+
+    @abc.abstractmethod
+    def timeout_error(self, snapshot: Snapshot) -> Exception:
+        """The exception to raise for a snapshot still pending after the timeout"""
+
+    def _schedule(self, snapshot_id: str, now: float):
+        pending = self._pending[snapshot_id]
+        self._next_polls[snapshot_id] = min(
+            now + next(pending.delays), pending.deadline
+        )
+
+    def _resolve(self, snapshot_id: str):
+        del self._next_polls[snapshot_id]
+        return self._pending.pop(snapshot_id)
+
+    def _get(self, snapshot_id: str) -> Optional[Snapshot]:
+        try:
+            return self.os_client.block_storage.get_snapshot(snapshot_id)
+        except ResourceNotFound:
+            return None
+
+    def _list(self, status: str) -> Iterator[Snapshot]:
+        return self.os_client.block_storage.snapshots(status=status)
+
+    def _listed(self) -> Iterator[Snapshot]:
+        # The pending status goes first: a snapshot leaving it meanwhile is
+        # found in the later listings
+        for status in (self.pending_status, *self.settled_statuses):
+            yield from self._list(status)
+        if self.recent_status is not None:
+            oldest = min(
+                pending.snapshot.created_at for pending in self._pending.values()
+            )
+            yield from itertools.takewhile(
+                lambda snapshot: snapshot.created_at >= oldest,
+                self._list(self.recent_status),
+            )
+
+    def _fetch(self) -> Dict[str, Snapshot]:
+        if len(self._pending) > 1:
+            current = {
+                snapshot.id: snapshot
+                for snapshot in self._listed()
+                if snapshot.id in self._pending
+            }
+            if self.unlisted_gone:
+                return current
+        else:
+            current = {}
+        for snapshot_id in self._pending.keys() - current.keys():
+            snapshot = self._get(snapshot_id)
+            if snapshot is not None:
+                current[snapshot_id] = snapshot
+        return current
+
+    def _poll(self):
+        try:
+            while self._pending:
+                wait = min(self._next_polls.values()) - time.monotonic()
+                if wait > 0:
+                    eventlet.sleep(wait)
+                    continue  # Snapshots may have been added meanwhile
+                try:
+                    current = self._fetch()
+                except Exception:
+                    log.exception(
+                        "Failed to poll snapshots",
+                        project=self.os_client.current_project_id,
+                    )
+                    current = None
+                now = time.monotonic()
+                for snapshot_id, pending in list(self._pending.items()):
+                    if current is not None:
+                        try:
+                            result = self.check(
+                                pending.snapshot, current.get(snapshot_id)
+                            )
+                        except Exception as err:
+                            self._resolve(snapshot_id).event.send_exception(err)
+                            continue
+                        if result is not None:
+                            self.polling.record(pending.key, now - pending.submitted_at)
+                            self._resolve(snapshot_id).event.send(result)
+                            continue
+                        pending.snapshot = current.get(snapshot_id, pending.snapshot)
+                    if now >= pending.deadline:
+                        self._resolve(snapshot_id).event.send_exception(
+                            self.timeout_error(pending.snapshot)
+                        )
+                    elif self._next_polls[snapshot_id] <= now:
+                        self._schedule(snapshot_id, now)
+        finally:
+            self._poller = None
+
+
+@contextlib.contextmanager
+def cancelling(pool: eventlet.GreenPool):
+    """Kill the green threads left in pool when the block exits on an exception
+
+    A project cancelled at the deadline stops the work it spawned at once, the
+    trackers no longer polling for the snapshots of the killed green threads.
+    """
+    try:
+        yield
+    except BaseException:
+        for greenthread in list(pool.coroutines_running):
+            greenthread.kill()
+        raise
+
+
+class CreationTracker(SnapshotTracker):
+    """Wait for snapshots to become available"""
+
+    kind = "creation"
+    pending_status = "creating"
+    settled_statuses = ("error",)
+    recent_status = "available"
+
+    def check(self, snapshot: Snapshot, current: Optional[Snapshot]):
+        if current is not None:
+            if current.status == "available":
+                return current
+            if current.status == "error":
+                raise SnapshotInError(current)
+        log.debug(
+            "Snapshot not done yet, waiting...",
+            project_id=self.os_client.current_project_id,
+            snapshot_id=snapshot.id,
+            status=snapshot.status if current is None else current.status,
+        )
+        return None
+
+    def timeout_error(self, snapshot: Snapshot) -> Exception:
+        return SnapshotCreationTimeout(snapshot)
 
 
 def create_snapshot(
@@ -53,9 +336,20 @@ def create_snapshot(
     expiry_date: datetime.datetime,
     timeout: int,
     retries: Optional[int] = DEFAULT_CREATE_RETRIES,
+    *,
+    tracker: Optional[CreationTracker] = None,
+    journal: Optional[RunJournal] = None,
 ):
+    """Create a snapshot of volume and wait for it to be available
+
+    tracker is shared between the snapshots created concurrently in a project so
+    their completion is polled together. The snapshot is recorded in journal as
+    soon as it is requested.
+    """
     for attempt in Retrying(
-        wait=wait_random(min=1, max=3), stop=stop_after_attempt(retries)
+        wait=wait_random(min=1, max=3),
+        stop=stop_after_attempt(retries),
+        retry=RETRY_UNLESS_AUTH_FAILED,
     ):
         with attempt:
             snapshot = os_client.block_storage.create_snapshot(
@@ -64,32 +358,78 @@ def create_snapshot(
                 is_forced=True,  # create snapshot even if volume is attached
                 metadata={"expire_at": expiry_date.date().isoformat()},
             )
+    if journal is not None:
+        journal.snapshot_requested(os_client.current_project_id, volume.id, snapshot.id)
 
-    for attempt in Retrying(
-        wait=wait_random(min=1, max=3),
-        stop=stop_after_delay(timeout),
-        retry=retry_if_not_exception_type(SnapshotInError),
-    ):
-        with attempt:
-            snapshot = os_client.block_storage.get_snapshot(snapshot.id)
-            if snapshot.status == "available":
-                log.info(
-                    "Created snapshot",
-                    volume=volume.id,
-                    snapshot=snapshot.id,
-                    project=os_client.current_project_id,
-                    expire_at=expiry_date.date().isoformat(),
-                )
-                return snapshot
-            elif snapshot.status == "error":
-                raise SnapshotInError(snapshot)
-            log.debug(
-                "Snapshot not done yet, waiting...",
-                project_id=os_client.current_project_id,
-                snapshot_id=snapshot.id,
-                status=snapshot.status,
-            )
-            raise TryAgain
+    if tracker is None:
+        tracker = CreationTracker(os_client, timeout)
+    start = time.monotonic()
+    snapshot = tracker.wait(snapshot, volume.volume_type)
+    metrics.SNAPSHOT_COMPLETION.observe(time.monotonic() - start, operation="create")
+    metrics.SNAPSHOTS_CREATED.inc(project=os_client.current_project_id)
+    log.info(
+        "Created snapshot",
+        volume=volume.id,
+        snapshot=snapshot.id,
+        project=os_client.current_project_id,
+        expire_at=expiry_date.date().isoformat(),
+    )
+    return snapshot
+
+
+def adopt_snapshot(
+    os_client: Connection,
+    volume: Volume,
+    snapshot_id: str,
+    timeout: int,
+    *,
+    tracker: Optional[CreationTracker] = None,
+) -> Optional[Snapshot]:
+    """Wait for a snapshot of volume requested by a previous attempt
+
+    Returns the snapshot once available, None if it is gone.
+    """
+    try:
+        snapshot = os_client.block_storage.get_snapshot(snapshot_id)
+    except ResourceNotFound:
+        log.info(
+            "Snapshot requested by the previous attempt is gone",
+            volume=volume.id,
+            snapshot=snapshot_id,
+            project=os_client.current_project_id,
+        )
+        return None
+    if snapshot.status != "available":
+        if tracker is None:
+            tracker = CreationTracker(os_client, timeout)
+        snapshot = tracker.wait(snapshot, volume.volume_type)
+    metrics.SNAPSHOTS_CREATED.inc(project=os_client.current_project_id)
+    log.info(
+        "Adopted snapshot",
+        volume=volume.id,
+        snapshot=snapshot.id,
+        project=os_client.current_project_id,
+    )
+    return snapshot
+
+
+class DeletionTracker(SnapshotTracker):
+    """Wait for snapshots to disappear"""
+
+    kind = "deletion"
+    pending_status = "deleting"
+    settled_statuses = ("error_deleting",)
+    unlisted_gone = True
+
+    def check(self, snapshot: Snapshot, current: Optional[Snapshot]):
+        if current is None:
+            return snapshot
+        if current.status == "error_deleting":
+            raise SnapshotStillPresent(current)
+        return None
+
+    def timeout_error(self, snapshot: Snapshot) -> Exception:
+        return SnapshotStillPresent(snapshot)
 
 
 def delete_snapshot(
@@ -97,67 +437,438 @@ def delete_snapshot(
     snapshot: Snapshot,
     timeout: int,
     retries: Optional[int] = DEFAULT_DELETE_RETRIES,
+    *,
+    tracker: Optional[DeletionTracker] = None,
 ):
+    """Delete a snapshot and wait for it to be gone
+
+    tracker is shared between the snapshots deleted concurrently in a project so
+    their disappearance is checked together.
+    """
     for attempt in Retrying(
         wait=wait_random(min=1, max=3),
         stop=stop_after_attempt(retries),
+        retry=RETRY_UNLESS_AUTH_FAILED,
         reraise=True,
     ):
         with attempt:
             try:
-                os_client.block_storage.delete_snapshot(snapshot)
+                os_client.block_storage.delete_snapshot(snapshot.id)
             except ResourceNotFound:
                 return True
 
-    for attempt in Retrying(
-        wait=wait_random(min=1, max=3),
-        stop=stop_after_delay(timeout),
-        reraise=True,
-    ):
-        with attempt:
-            try:
-                os_client.block_storage.get_snapshot(snapshot.id)
-            except ResourceNotFound:
-                log.info(
-                    "Deleted snapshot",
-                    snapshot=snapshot.id,
-                    project=os_client.current_project_id,
-                )
-                return True
-            raise SnapshotStillPresent(snapshot)
+    if tracker is None:
+        tracker = DeletionTracker(os_client, timeout)
+    start = time.monotonic()
+    tracker.wait(snapshot)
+    metrics.SNAPSHOT_COMPLETION.observe(time.monotonic() - start, operation="delete")
+    metrics.SNAPSHOTS_DELETED.inc(project=os_client.current_project_id)
+    log.info(
+        "Deleted snapshot",
+        snapshot=snapshot.id,
+        project=os_client.current_project_id,
+    )
+    return True
 
 
-def run_on_all_projects(
+def connect_project(
     os_client: Connection,
+    trust_id: Optional[str],
+    project_id: str,
+) -> Connection:
+    """Build a client scoped to the project, through the trust if there is one"""
+    if trust_id is None:
+        return os_client.connect_as(project_id=project_id)
+    return os_client.connect_as(trust_id=trust_id)
+
+
+def _authenticate(
+    os_client: Connection,
+    auth_semaphore: eventlet.semaphore.Semaphore,
+    token_cache: Optional[TokenCache],
+    connections: Optional[dict],
+    trust_id: Optional[str],
+    project_id: str,
+) -> Connection:
+    if connections is not None and (trust_id, project_id) in connections:
+        # keystoneauth issues a new token when the one of the session expires
+        return connections[trust_id, project_id]
+    with auth_semaphore:
+        os_project_client = connect_project(os_client, trust_id, project_id)
+        if token_cache is None or not token_cache.restore(
+            token_cache.key(os_client, trust_id, project_id),
+            os_project_client.session.auth,
+        ):
+            # Issue the scoped token right away so it counts in the auth concurrency
+            os_project_client.session.get_token()
+    if connections is not None:
+        connections[trust_id, project_id] = os_project_client
+    return os_project_client
+
+
+def _forget_connection(
+    connections: Optional[dict], trust_id: Optional[str], project_id: str
+):
+    # The trust or the role may be gone, authenticate again next time
+    if connections is not None:
+        connections.pop((trust_id, project_id), None)
+
+
+def _store_token(
+    os_client: Connection,
+    token_cache: Optional[TokenCache],
+    trust_id: Optional[str],
+    project_id: str,
+    os_project_client: Connection,
+):
+    if token_cache is not None:
+        # keystoneauth re-authenticates on a 401, keep the token in use
+        token_cache.store(
+            token_cache.key(os_client, trust_id, project_id),
+            os_project_client.session.auth,
+        )
+
+
+class _ProjectBlockStorage:
+    """Admin block storage proxy listing the resources of a single project"""
+
+    def __init__(self, proxy, project_id: str):
+        self._proxy = proxy
+        self._project_id = project_id
+
+    def volumes(self, **query):
+        return self._proxy.volumes(
+            all_projects=True, project_id=self._project_id, **query
+        )
+
+    def snapshots(self, **query):
+        return self._proxy.snapshots(
+            all_projects=True, project_id=self._project_id, **query
+        )
+
+    def _list(self, resource_type, **query):
+        # The resources the proxy has no method for, group snapshots for instance
+        return self._proxy._list(
+            resource_type, all_projects=True, project_id=self._project_id, **query
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._proxy, name)
+
+
+class ProjectConnection:
+    """Client of a single project, connecting on first use
+
+    When admin is set the connection is an admin one, its block storage
+    listings are then restricted to the project. A failure to authenticate is
+    kept in auth_error and raised again on every use rather than authenticating
+    again.
+    """
+
+    def __init__(self, project_id: str, connect, admin: bool = False):
+        self.current_project_id = project_id
+        self.connection = None
+        self.auth_error = None
+        self._connect = connect
+        self._admin = admin
+        self._lock = eventlet.semaphore.Semaphore()
+
+    def _get_connection(self) -> Connection:
+        with self._lock:
+            if self.auth_error is not None:
+                raise self.auth_error
+            if self.connection is None:
+                try:
+                    self.connection = self._connect()
+                except keystoneauth1.exceptions.HTTPClientError as err:
+                    self.auth_error = err
+                    raise
+        return self.connection
+
+    @property
+    def block_storage(self):
+        block_storage = self._get_connection().block_storage
+        if self._admin:
+            return _ProjectBlockStorage(block_storage, self.current_project_id)
+        return block_storage
+
+    def __getattr__(self, name):
+        return getattr(self._get_connection(), name)
+
+
+def _task_name(process_function) -> str:
+    # Partials have no name
+    return getattr(process_function, "__name__", "unknown")
+
+
+@contextlib.contextmanager
+def _project_metrics(
+    process_function, project_id: str, project_stats: Optional[ProjectStats]
+):
+    task = _task_name(process_function)
+    metrics.PROJECTS_IN_PROGRESS.inc(task=task)
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        # A failure says nothing of how long the project takes to process
+        project_stats = None
+        raise
+    finally:
+        duration = time.monotonic() - start
+        metrics.PROJECTS_IN_PROGRESS.dec(task=task)
+        metrics.PROJECT_DURATION.set(duration, task=task, project=project_id)
+        if project_stats is not None:
+            project_stats.record(task, project_id, duration)
+    log.info(
+        "Processed project", task=task, project=project_id, duration=round(duration, 3)
+    )
+
+
+@contextlib.contextmanager
+def _project_budget(
+    process_function,
+    project_id: str,
+    project_stats: Optional[ProjectStats],
+    deadline: Optional[float],
+):
+    """Process the project with what is left of the time of the run
+
+    The project is skipped when what is left does not cover its estimated
+    duration, or is exhausted for the projects never processed before. It is
+    cancelled by an eventlet.Timeout once deadline, a time.monotonic() value,
+    is reached.
+    """
+    if deadline is None:
+        yield
+        return
+    remaining = deadline - time.monotonic()
+    estimate = None
+    if project_stats is not None:
+        estimate = project_stats.estimate(_task_name(process_function), project_id)
+    if remaining <= (estimate or 0):
+        raise DeadlineReached(project_id, remaining)
+    with eventlet.Timeout(remaining):
+        yield
+
+
+def _process_project(
+    os_client: Connection,
+    auth_semaphore: eventlet.semaphore.Semaphore,
+    token_cache: Optional[TokenCache],
+    connections: Optional[dict],
+    trust_id: Optional[str],
+    project_id: str,
+    project_stats: Optional[ProjectStats],
+    deadline: Optional[float],
+    progress: Optional[Journal],  # Not journal, which process_function may take
     process_function,
-    pool_size: int,
     *args,
     **kwargs,
 ):
-    pool = eventlet.GreenPool(size=pool_size)
-    greenlets = []
-    for trust_id, project_id in available_projects(os_client):
-        log.debug("Processing project", project=project_id, trust=trust_id)
-        if trust_id is None:
-            os_project_client = os_client.connect_as(project_id=project_id)
+    with _project_budget(
+        process_function, project_id, project_stats, deadline
+    ), _project_metrics(process_function, project_id, project_stats):
+        result = _run_in_project(
+            os_client,
+            auth_semaphore,
+            token_cache,
+            connections,
+            trust_id,
+            project_id,
+            process_function,
+            *args,
+            **kwargs,
+        )
+    if result and progress is not None:
+        progress.project_done(_task_name(process_function), project_id)
+    return result
+
+
+def _run_in_project(
+    os_client: Connection,
+    auth_semaphore: eventlet.semaphore.Semaphore,
+    token_cache: Optional[TokenCache],
+    connections: Optional[dict],
+    trust_id: Optional[str],
+    project_id: str,
+    process_function,
+    *args,
+    **kwargs,
+):
+    try:
+        os_project_client = _authenticate(
+            os_client, auth_semaphore, token_cache, connections, trust_id, project_id
+        )
+    except Exception:
+        _forget_connection(connections, trust_id, project_id)
+        raise
+    try:
+        return process_function(os_project_client, *args, **kwargs)
+    except Exception:
+        _forget_connection(connections, trust_id, project_id)
+        raise
+    finally:
+        _store_token(os_client, token_cache, trust_id, project_id, os_project_client)
+
+
+def _process_tenant(
+    os_client: Connection,
+    auth_semaphore: eventlet.semaphore.Semaphore,
+    token_cache: Optional[TokenCache],
+    connections: Optional[dict],
+    trust_id: Optional[str],
+    project_id: str,
+    scoped: bool,
+    project_stats: Optional[ProjectStats],
+    deadline: Optional[float],
+    progress: Optional[Journal],
+    process_function,
+    *args,
+    **kwargs,
+):
+    if scoped:
+        os_project_client = ProjectConnection(
+            project_id,
+            functools.partial(
+                _authenticate,
+                os_client,
+                auth_semaphore,
+                token_cache,
+                connections,
+                trust_id,
+                project_id,
+            ),
+        )
+    else:
+        os_project_client = ProjectConnection(project_id, lambda: os_client, admin=True)
+    with _project_budget(
+        process_function, project_id, project_stats, deadline
+    ), _project_metrics(process_function, project_id, project_stats):
+        try:
+            result = process_function(os_project_client, *args, **kwargs)
+        except Exception:
+            _forget_connection(connections, trust_id, project_id)
+            raise
         else:
-            os_project_client = os_client.connect_as(
-                trust_id=trust_id,
-            )
-        greenlets.append(
-            {
-                "project_id": project_id,
-                "trust_id": trust_id,
-                "result": pool.spawn(
-                    process_function, os_project_client, *args, **kwargs
-                ),
-            }
+            if os_project_client.auth_error is not None:
+                # Raised in the green threads of the process function, which
+                # logged it on their own: the project is given up on as a whole
+                _forget_connection(connections, trust_id, project_id)
+                raise os_project_client.auth_error
+        finally:
+            if scoped and os_project_client.connection is not None:
+                _store_token(
+                    os_client,
+                    token_cache,
+                    trust_id,
+                    project_id,
+                    os_project_client.connection,
+                )
+    if result and progress is not None:
+        progress.project_done(_task_name(process_function), project_id)
+    return result
+
+
+def _schedule(
+    projects: Iterable[Tuple[Optional[str], str]],
+    process_function,
+    schedule: str,
+    project_stats: Optional[ProjectStats],
+    sizes: Optional[Mapping[str, int]] = None,
+) -> List[Tuple[Optional[str], str]]:
+    """Order the (trust, project) pairs in which projects are to be dispatched
+
+    Whatever the schedule, the projects left out at the deadline of the
+    previous run go first. Largest first then dispatches the projects by
+    decreasing estimated duration. The projects never processed before go
+    first, by decreasing size when sizes gives them, as they may be the largest
+    ones.
+    """
+    task = _task_name(process_function)
+
+    def skipped(project_id):
+        return project_stats is not None and project_stats.skipped(task, project_id)
+
+    left_out = [project_id for _, project_id in projects if skipped(project_id)]
+    if left_out:
+        log.info(
+            "Resuming projects left out by the previous run",
+            task=task,
+            projects=left_out,
+        )
+    projects = sorted(projects, key=lambda project: not skipped(project[1]))
+    if schedule == "listing":
+        return projects
+
+    def estimate(project):
+        _, project_id = project
+        if project_stats is not None:
+            duration = project_stats.estimate(task, project_id)
+            if duration is not None:
+                return (not skipped(project_id), 1, -duration)
+        return (not skipped(project_id), 0, -(sizes or {}).get(project_id, 0))
+
+    ordered = sorted(projects, key=estimate)
+    log.info(
+        "Scheduled projects largest first",
+        task=task,
+        order=[project_id for _, project_id in ordered],
+    )
+    return ordered
+
+
+def _resume(
+    projects: Iterable[Tuple[Optional[str], str]],
+    process_function,
+    journal: Optional[Journal],
+    kwargs: dict,
+) -> List[Tuple[Optional[str], str]]:
+    """Begin the run in journal, leaving out the projects it already processed
+
+    The journal of the run is added to kwargs when process_function takes it.
+    """
+    if journal is None:
+        return list(projects)
+    task = _task_name(process_function)
+    journal.begin(task)
+    if "journal" in inspect.signature(process_function).parameters:
+        kwargs["journal"] = journal.run(task)
+    remaining = []
+    finished = []
+    for trust_id, project_id in projects:
+        if journal.finished(task, project_id):
+            finished.append(project_id)
+        else:
+            remaining.append((trust_id, project_id))
+    if finished:
+        log.info(
+            "Skipping projects processed before the crash",
+            task=task,
+            projects=finished,
         )
+    return remaining
+
 
+def _wait_for_projects(
+    greenlets,
+    process_function,
+    token_cache: Optional[TokenCache],
+    project_stats: Optional[ProjectStats],
+    journal: Optional[Journal],
+):
+    task = _task_name(process_function)
     return_value = []
+    left_out = {"skipped": [], "cancelled": []}
     for g in greenlets:
         try:
             return_value.append(g["result"].wait())
+        except DeadlineReached:
+            left_out["skipped"].append(g["project_id"])
+            return_value.append(False)
+        except eventlet.Timeout:
+            left_out["cancelled"].append(g["project_id"])
+            return_value.append(False)
         except keystoneauth1.exceptions.HTTPClientError as err:
             if err.http_status == 403:
                 log.error(
@@ -169,18 +880,275 @@ def run_on_all_projects(
             else:
                 raise
 
+    for reason, projects in left_out.items():
+        metrics.PROJECTS_LEFT_OUT.set(len(projects), task=task, reason=reason)
+        if project_stats is not None:
+            for project_id in projects:
+                project_stats.skip(task, project_id)
+    if left_out["skipped"] or left_out["cancelled"]:
+        log.warning(
+            "Deadline reached, projects left out",
+            task=task,
+            processed=len(greenlets) - sum(len(p) for p in left_out.values()),
+            **left_out,
+        )
+    if token_cache is not None:
+        token_cache.save()
+    if project_stats is not None:
+        project_stats.save()
+    if journal is not None:
+        journal.end(task)
     return return_value
 
 
-def available_projects(os_client):
-    """List all projects we can operate on"""
+def run_on_all_projects(
+    os_client: Connection,
+    process_function,
+    pool_size: int,
+    *args,
+    auth_concurrency: Optional[int] = None,
+    token_cache: Optional[TokenCache] = None,
+    project_preference: str = "membership",
+    connections: Optional[dict] = None,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    schedule: str = "listing",
+    project_stats: Optional[ProjectStats] = None,
+    deadline: Optional[float] = None,
+    journal: Optional[Journal] = None,
+    **kwargs,
+):
+    """Run process_function concurrently on every project we can operate on
+
+    The project scoped clients are built in the pool as well so that
+    authentication overlaps with the processing of the other projects, no more
+    than auth_concurrency (defaulting to pool_size) at a time. Scoped tokens are
+    reused from and saved to token_cache when given. project_preference tells
+    available_projects how to reach projects available in several ways. When
+    given, connections keeps the project scoped clients to be reused by the next
+    runs, it is keyed by trust and project. Only the projects of the shard
+    shard_index out of shard_count are processed, they are dispatched in the
+    order given by schedule: the one of the listing or the largest first as
+    per the durations recorded in project_stats, which is updated. When given,
+    deadline is the time in seconds the run may last: the projects whose
+    estimated duration no longer fits are skipped, the ones in progress once it
+    is reached cancelled. They are marked in project_stats, for the next run to
+    start with them. When given, journal records the projects processed
+    successfully: resuming a run left unfinished by a crash skips them.
+    process_function gets the journal of the run as its journal keyword
+    argument when it takes one.
+    """
+    if deadline is not None:
+        deadline += time.monotonic()
+    pool = eventlet.GreenPool(size=pool_size)
+    metrics.POOL_SIZE.set(pool_size, task=_task_name(process_function))
+    auth_semaphore = eventlet.semaphore.Semaphore(auth_concurrency or pool_size)
+    greenlets = []
+    projects = available_projects(
+        os_client, project_preference, shard_index=shard_index, shard_count=shard_count
+    )
+    projects = _resume(projects, process_function, journal, kwargs)
+    for trust_id, project_id in _schedule(
+        projects, process_function, schedule, project_stats
+    ):
+        log.debug("Processing project", project=project_id, trust=trust_id)
+        greenlets.append(
+            {
+                "project_id": project_id,
+                "trust_id": trust_id,
+                "result": pool.spawn(
+                    _process_project,
+                    os_client,
+                    auth_semaphore,
+                    token_cache,
+                    connections,
+                    trust_id,
+                    project_id,
+                    project_stats,
+                    deadline,
+                    journal,
+                    process_function,
+                    *args,
+                    **kwargs,
+                ),
+            }
+        )
+
+    return _wait_for_projects(
+        greenlets, process_function, token_cache, project_stats, journal
+    )
 
+
+def run_on_all_tenants(
+    os_client: Connection,
+    process_function,
+    pool_size: int,
+    *args,
+    listings: Dict[str, Callable[..., Iterable]],
+    scoped: bool = False,
+    auth_concurrency: Optional[int] = None,
+    token_cache: Optional[TokenCache] = None,
+    project_preference: str = "membership",
+    connections: Optional[dict] = None,
+    shard_index: int = 0,
+    shard_count: int = 1,
+    schedule: str = "listing",
+    project_stats: Optional[ProjectStats] = None,
+    deadline: Optional[float] = None,
+    journal: Optional[Journal] = None,
+    **kwargs,
+):
+    """Run process_function concurrently on every project having resources
+
+    This needs admin rights: each listing is fetched once for all tenants and
+    split by project, process_function then gets the resources of its project
+    as the keyword argument named after the listing. Its client is the admin
+    client restricted to the project, unless scoped is set: a project scoped
+    client is then built on first use, for the projects available_projects
+    gives access to. The other options are the ones of run_on_all_projects,
+    the largest first schedule dispatches the projects without a recorded
+    duration by decreasing count of resources.
+    """
+    if deadline is not None:
+        deadline += time.monotonic()
+    inventories = collections.defaultdict(lambda: {name: [] for name in listings})
+    for name, listing in listings.items():
+        for resource in listing(all_projects=True):
+            if in_shard(resource.project_id, shard_index, shard_count):
+                inventories[resource.project_id][name].append(resource)
+    log.info("Listed resources of all tenants", projects=len(inventories))
+
+    trusts = {}
+    if scoped:
+        trusts = {
+            project_id: trust_id
+            for trust_id, project_id in available_projects(
+                os_client,
+                project_preference,
+                shard_index=shard_index,
+                shard_count=shard_count,
+            )
+        }
+    pool = eventlet.GreenPool(size=pool_size)
+    metrics.POOL_SIZE.set(pool_size, task=_task_name(process_function))
+    auth_semaphore = eventlet.semaphore.Semaphore(auth_concurrency or pool_size)
+    greenlets = []
+    projects = []
+    for project_id in inventories:
+        if scoped and project_id not in trusts:
+            log.warning("No access to project, skipping it", project=project_id)
+            continue
+        projects.append((trusts.get(project_id), project_id))
+    projects = _resume(projects, process_function, journal, kwargs)
+    sizes = {
+        project_id: sum(len(resources) for resources in inventory.values())
+        for project_id, inventory in inventories.items()
+    }
+    for trust_id, project_id in _schedule(
+        projects, process_function, schedule, project_stats, sizes
+    ):
+        inventory = inventories[project_id]
+        log.debug("Processing project", project=project_id, trust=trust_id)
+        greenlets.append(
+            {
+                "project_id": project_id,
+                "trust_id": trust_id,
+                "result": pool.spawn(
+                    _process_tenant,
+                    os_client,
+                    auth_semaphore,
+                    token_cache,
+                    connections,
+                    trust_id,
+                    project_id,
+                    scoped,
+                    project_stats,
+                    deadline,
+                    journal,
+                    process_function,
+                    *args,
+                    **inventory,
+                    **kwargs,
+                ),
+            }
+        )
+
+    return _wait_for_projects(
+        greenlets, process_function, token_cache, project_stats, journal
+    )
+
+
+def run_options(args) -> dict:
+    """Options of run_on_all_projects and run_on_all_tenants given on the CLI"""
+    return {
+        "auth_concurrency": args.auth_concurrency,
+        "token_cache": args.token_cache,
+        "project_preference": args.project_preference,
+        "connections": args.connections,
+        "shard_index": args.shard_index,
+        "shard_count": args.shard_count,
+        "schedule": args.schedule,
+        "project_stats": args.project_stats,
+        "deadline": args.deadline,
+        "journal": args.journal,
+    }
+
+
+def in_shard(project_id: str, shard_index: int = 0, shard_count: int = 1) -> bool:
+    """Whether the project belongs to the shard shard_index out of shard_count
+
+    Projects are spread evenly by a hash of their ID, every runner agrees on the
+    shard of a project whatever the projects it sees and from one run to another.
+    """
+    if shard_count == 1:
+        return True
+    digest = hashlib.sha256(project_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count == shard_index
+
+
+def available_projects(
+    os_client: Connection,
+    preference: str = "membership",
+    *,
+    shard_index: int = 0,
+    shard_count: int = 1,
+):
+    """List all projects we can operate on
+
+    A project reachable through several trusts or both through a trust and as a
+    member is yielded only once, using membership or a trust as per preference.
+    Only the projects of the shard shard_index out of shard_count are yielded.
+    """
+    projects = {}
+    duplicates = 0
     for trust in os_client.identity.trusts(trustee_user_id=os_client.current_user_id):
-        yield trust.id, trust.project_id
+        if trust.project_id in projects:
+            duplicates += 1
+            continue
+        projects[trust.project_id] = trust.id
     for project in os_client.identity.user_projects(
         os_client.current_user_id, enabled=True
     ):
-        yield None, project.id
+        if project.id in projects:
+            duplicates += 1
+            if preference == "trust":
+                continue
+        projects[project.id] = None
+
+    sharded = {
+        project_id: trust_id
+        for project_id, trust_id in projects.items()
+        if in_shard(project_id, shard_index, shard_count)
+    }
+    log.info(
+        "Listed available projects",
+        projects=len(projects),
+        duplicates_collapsed=duplicates,
+        in_shard=len(sharded),
+        shard=f"{shard_index}/{shard_count}",
+    )
+    for project_id, trust_id in sharded.items():
+        yield trust_id, project_id
 
 
 def setup_logging(args):
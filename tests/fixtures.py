@@ -16,6 +16,9 @@ limitations under the License.
 SPDX-License-Identifier: Apache-2.0
 """
 from dataclasses import dataclass
+from typing import Optional
+
+from cinder_snapshooter.records import VolumeRecord
 
 
 @dataclass
@@ -23,6 +26,11 @@ class FakeVolume:
     id: str
     status: str
     metadata: dict
+    volume_type: Optional[str] = None
+
+    @property
+    def enrolled(self):
+        return VolumeRecord.from_resource(self).enrolled
 
 
 @dataclass
@@ -33,6 +41,28 @@ class FakeSnapshot:
     volume_id: str
     created_at: str
 
+    @property
+    def expire_at(self):
+        return self.metadata.get("expire_at")
+
+
+@dataclass
+class FakeGroup:
+    id: str
+    status: str
+    volumes: list
+    project_id: Optional[str] = None
+
+
+@dataclass
+class FakeGroupSnapshot:
+    id: str
+    status: str
+    group_id: str
+    created_at: str
+    description: Optional[str] = None
+    project_id: Optional[str] = None
+
 
 @dataclass
 class FakeProject:
@@ -0,0 +1,105 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import eventlet
+import pytest
+
+from cinder_snapshooter.backend_limits import BackendLimits, volume_slot
+from cinder_snapshooter.records import VolumeRecord
+
+
+def volume_record(faker, **attributes):
+    return VolumeRecord(faker.uuid4(), "available", None, None, True)._replace(
+        **attributes
+    )
+
+
+@pytest.mark.parametrize(
+    "key,backend",
+    [("volume_type", "nfs"), ("host", "cinder@nfs#pool"), ("availability_zone", "az1")],
+)
+def test_backend(faker, key, backend):
+    backend_limits = BackendLimits(key)
+    volume = volume_record(
+        faker, volume_type="nfs", host="cinder@nfs#pool", availability_zone="az1"
+    )
+
+    assert backend_limits.backend(volume) == backend
+    assert backend_limits.backend(volume_record(faker)) == "unknown"
+
+
+@pytest.mark.parametrize("default_limit", [None, 3])
+def test_slot(faker, default_limit):
+    backend_limits = BackendLimits(limits={"nfs": 2}, default_limit=default_limit)
+    in_flight = {"nfs": [], "ceph": []}
+    max_in_flight = {"nfs": [], "ceph": []}
+
+    def operation(backend):
+        with backend_limits.slot(backend):
+            in_flight[backend].append(True)
+            max_in_flight[backend].append(len(in_flight[backend]))
+            eventlet.sleep(0.01)
+            in_flight[backend].pop()
+
+    pool = eventlet.GreenPool()
+    for backend in ["nfs", "ceph"] * 6:
+        pool.spawn(operation, backend)
+    pool.waitall()
+
+    assert max(max_in_flight["nfs"]) == 2
+    assert max(max_in_flight["ceph"]) == (default_limit or 6)
+
+
+@pytest.mark.parametrize("page_size", [None, 50])
+def test_volume_backends(mocker, faker, page_size):
+    block_storage = mocker.MagicMock()
+    volumes = [
+        mocker.MagicMock(id=faker.uuid4(), volume_type=volume_type, metadata={})
+        for volume_type in ("nfs", "ceph", None)
+    ]
+    block_storage.volumes.return_value = iter(volumes)
+    backend_limits = BackendLimits()
+
+    backends = backend_limits.volume_backends(block_storage, page_size=page_size)
+
+    assert backends == {
+        volumes[0].id: "nfs",
+        volumes[1].id: "ceph",
+        volumes[2].id: "unknown",
+    }
+    if page_size is None:
+        block_storage.volumes.assert_called_once_with()
+    else:
+        block_storage.volumes.assert_called_once_with(limit=page_size)
+
+    # Volumes already listed are not listed again
+    block_storage.volumes.reset_mock()
+    volume = volume_record(faker, volume_type="nfs")
+    assert backend_limits.volume_backends(block_storage, [volume]) == {volume.id: "nfs"}
+    block_storage.volumes.assert_not_called()
+
+
+def test_volume_slot(mocker, faker):
+    volume = volume_record(faker, volume_type="nfs")
+    backend_limits = mocker.MagicMock()
+    backend_limits.backend.return_value = "nfs"
+
+    assert volume_slot(backend_limits, volume) == backend_limits.slot.return_value
+    backend_limits.backend.assert_called_once_with(volume)
+    backend_limits.slot.assert_called_once_with("nfs")
+    with volume_slot(None, volume):
+        pass
@@ -1,9 +1,16 @@
 import argparse
+import runpy
+import subprocess
+import sys
 
+import eventlet
 import openstack
 import pytest
 
 import cinder_snapshooter.cli
+import cinder_snapshooter.daemon
+import cinder_snapshooter.journal
+import cinder_snapshooter.reconcile
 import cinder_snapshooter.snapshot_creator
 import cinder_snapshooter.snapshot_destroyer
 
@@ -19,7 +26,36 @@ import cinder_snapshooter.snapshot_destroyer
                 dry_run=False,
                 verbose=0,
                 pool_size=20,
+                auth_concurrency=None,
+                token_cache_path=None,
+                token_min_validity=3600,
+                project_preference="membership",
+                shard_index=0,
+                shard_count=1,
+                schedule="listing",
+                stats_file=None,
+                deadline=None,
+                journal_path=None,
+                resume=False,
+                all_tenants=False,
                 wait_completion_timeout=30,
+                page_size=None,
+                use_groups=False,
+                poll_initial_delay=1,
+                poll_max_delay=10,
+                poll_backoff_factor=2,
+                adaptive_polling=True,
+                backend_key="volume_type",
+                backend_concurrency=None,
+                default_backend_concurrency=None,
+                block_storage_rate_limit=None,
+                identity_rate_limit=None,
+                metrics_textfile=None,
+                metrics_port=None,
+                volume_concurrency=1,
+                state_file=None,
+                state_max_age=604800,
+                server_side_filter=False,
                 func=cinder_snapshooter.snapshot_creator.cli,
             ),
         ),
@@ -29,8 +65,51 @@ import cinder_snapshooter.snapshot_destroyer
                 "hello",
                 "--pool-size",
                 "30",
+                "--auth-concurrency",
+                "5",
+                "--token-cache",
+                "/var/cache/tokens.json",
+                "--token-min-validity",
+                "600",
+                "--project-preference",
+                "trust",
+                "--shard-index",
+                "2",
+                "--shard-count",
+                "3",
+                "--schedule",
+                "largest-first",
+                "--stats-file",
+                "/var/lib/cinder-snapshooter/stats.json",
+                "--deadline",
+                "3000",
+                "--journal",
+                "/var/lib/cinder-snapshooter/journal.jsonl",
+                "--resume",
+                "--all-tenants",
                 "--wait-completion-timeout",
                 "10",
+                "--poll-initial-delay",
+                "0.5",
+                "--poll-max-delay",
+                "30",
+                "--poll-backoff-factor",
+                "1.5",
+                "--no-adaptive-polling",
+                "--backend-key",
+                "host",
+                "--backend-concurrency",
+                "nfs@pool=4, ceph=50",
+                "--default-backend-concurrency",
+                "20",
+                "--block-storage-rate-limit",
+                "20",
+                "--identity-rate-limit",
+                "2.5",
+                "--metrics-textfile",
+                "/var/lib/node_exporter/cinder_snapshooter.prom",
+                "--metrics-port",
+                "9100",
                 "--devel",
                 "-vvv",
                 "destroyer",
@@ -41,28 +120,340 @@ import cinder_snapshooter.snapshot_destroyer
                 dry_run=False,
                 verbose=3,
                 pool_size=30,
+                auth_concurrency=5,
+                token_cache_path="/var/cache/tokens.json",
+                token_min_validity=600,
+                project_preference="trust",
+                shard_index=2,
+                shard_count=3,
+                schedule="largest-first",
+                stats_file="/var/lib/cinder-snapshooter/stats.json",
+                deadline=3000,
+                journal_path="/var/lib/cinder-snapshooter/journal.jsonl",
+                resume=True,
+                all_tenants=True,
                 wait_completion_timeout=10,
+                page_size=None,
+                use_groups=False,
+                poll_initial_delay=0.5,
+                poll_max_delay=30,
+                poll_backoff_factor=1.5,
+                adaptive_polling=False,
+                backend_key="host",
+                backend_concurrency={"nfs@pool": 4, "ceph": 50},
+                default_backend_concurrency=20,
+                block_storage_rate_limit=20,
+                identity_rate_limit=2.5,
+                metrics_textfile="/var/lib/node_exporter/cinder_snapshooter.prom",
+                metrics_port=9100,
+                delete_concurrency=10,
                 func=cinder_snapshooter.snapshot_destroyer.cli,
             ),
         ),
+        (
+            ["daemon", "--creator-schedule", "0 2 * * *", "--dry-run"],
+            argparse.Namespace(
+                os_cloud=None,
+                devel=False,
+                dry_run=True,
+                verbose=0,
+                pool_size=20,
+                auth_concurrency=None,
+                token_cache_path=None,
+                token_min_validity=3600,
+                project_preference="membership",
+                shard_index=0,
+                shard_count=1,
+                schedule="listing",
+                stats_file=None,
+                deadline=None,
+                journal_path=None,
+                resume=False,
+                all_tenants=False,
+                wait_completion_timeout=30,
+                page_size=None,
+                use_groups=False,
+                poll_initial_delay=1,
+                poll_max_delay=10,
+                poll_backoff_factor=2,
+                adaptive_polling=True,
+                backend_key="volume_type",
+                backend_concurrency=None,
+                default_backend_concurrency=None,
+                block_storage_rate_limit=None,
+                identity_rate_limit=None,
+                metrics_textfile=None,
+                metrics_port=None,
+                creator_schedule=cinder_snapshooter.daemon.CronSchedule("0 2 * * *"),
+                destroyer_schedule=cinder_snapshooter.daemon.CronSchedule("0 0 * * *"),
+                volume_concurrency=1,
+                state_file=None,
+                state_max_age=604800,
+                server_side_filter=False,
+                delete_concurrency=10,
+                func=cinder_snapshooter.daemon.cli,
+            ),
+        ),
+        (
+            [
+                "reconcile",
+                "--delete-concurrency",
+                "4",
+                "--server-side-filter",
+                "-n",
+            ],
+            argparse.Namespace(
+                os_cloud=None,
+                devel=False,
+                dry_run=True,
+                verbose=0,
+                pool_size=20,
+                auth_concurrency=None,
+                token_cache_path=None,
+                token_min_validity=3600,
+                project_preference="membership",
+                shard_index=0,
+                shard_count=1,
+                schedule="listing",
+                stats_file=None,
+                deadline=None,
+                journal_path=None,
+                resume=False,
+                all_tenants=False,
+                wait_completion_timeout=30,
+                page_size=None,
+                use_groups=False,
+                poll_initial_delay=1,
+                poll_max_delay=10,
+                poll_backoff_factor=2,
+                adaptive_polling=True,
+                backend_key="volume_type",
+                backend_concurrency=None,
+                default_backend_concurrency=None,
+                block_storage_rate_limit=None,
+                identity_rate_limit=None,
+                metrics_textfile=None,
+                metrics_port=None,
+                volume_concurrency=1,
+                state_file=None,
+                state_max_age=604800,
+                server_side_filter=True,
+                delete_concurrency=4,
+                func=cinder_snapshooter.reconcile.cli,
+            ),
+        ),
     ],
 )
 def test_parse_args(args, result):
     assert cinder_snapshooter.cli.parse_args(args) == result
 
 
-def test_cli(mocker, faker):
+@pytest.mark.parametrize("exported", [True, False])
+@pytest.mark.parametrize("token_cache", [True, False])
+@pytest.mark.parametrize("stats", [True, False])
+@pytest.mark.parametrize("backend_concurrency", [{"ceph": 50}, None])
+def test_cli(mocker, faker, token_cache, exported, stats, backend_concurrency):
+    mocker.patch("cinder_snapshooter.cli.parse_common_args")
     mocker.patch("cinder_snapshooter.cli.parse_args")
-    mocker.patch("cinder_snapshooter.cli.setup_logging")
+    mocker.patch("eventlet.monkey_patch")
+    mocker.patch("cinder_snapshooter.utils.setup_logging")
+    mocker.patch("cinder_snapshooter.token_cache.TokenCache")
+    mocker.patch("cinder_snapshooter.project_stats.ProjectStats")
+    mocker.patch("cinder_snapshooter.journal.Journal")
+    mocker.patch("cinder_snapshooter.utils.PollingPolicy")
+    mocker.patch("cinder_snapshooter.rate_limit.RateLimiter")
+    mocker.patch("cinder_snapshooter.metrics.serve")
+    mocker.patch("cinder_snapshooter.metrics.write_textfile")
     mocker.patch("openstack.connect")
-    args = argparse.Namespace(os_cloud=faker.word(), func=mocker.MagicMock())
+    args = argparse.Namespace(
+        os_cloud=faker.word(),
+        func=mocker.MagicMock(),
+        token_cache_path=faker.file_path() if token_cache else None,
+        token_min_validity=faker.random_int(),
+        stats_file=faker.file_path() if stats else None,
+        journal_path=faker.file_path() if stats else None,
+        resume=faker.boolean(),
+        poll_initial_delay=faker.pyfloat(positive=True),
+        poll_max_delay=faker.pyfloat(positive=True),
+        poll_backoff_factor=faker.pyfloat(positive=True),
+        adaptive_polling=faker.boolean(),
+        backend_key="host",
+        backend_concurrency=backend_concurrency,
+        default_backend_concurrency=None,
+        block_storage_rate_limit=faker.pyfloat(positive=True),
+        identity_rate_limit=None,
+        metrics_textfile=faker.file_path() if exported else None,
+        metrics_port=faker.port_number() if exported else None,
+    )
     os_client = mocker.MagicMock()
     openstack.connect.return_value = os_client
     cinder_snapshooter.cli.parse_args.return_value = args
 
     cinder_snapshooter.cli.cli()
 
+    eventlet.monkey_patch.assert_called_once_with()
     openstack.connect.assert_called_once_with(cloud=args.os_cloud)
     assert args.os_client == os_client
+    assert args.connections is None
+    cinder_snapshooter.utils.PollingPolicy.assert_called_once_with(
+        args.poll_initial_delay,
+        args.poll_max_delay,
+        args.poll_backoff_factor,
+        args.adaptive_polling,
+    )
+    assert args.polling == cinder_snapshooter.utils.PollingPolicy.return_value
+    cinder_snapshooter.rate_limit.RateLimiter.assert_called_once_with(
+        {"block-storage": args.block_storage_rate_limit, "identity": None}
+    )
+    assert args.rate_limiter == cinder_snapshooter.rate_limit.RateLimiter.return_value
+    args.rate_limiter.install.assert_called_once_with(os_client)
+    args.rate_limiter.log_stats.assert_called_once_with()
+    if exported:
+        cinder_snapshooter.metrics.serve.assert_called_once_with(args.metrics_port)
+        cinder_snapshooter.metrics.write_textfile.assert_called_once_with(
+            args.metrics_textfile
+        )
+    else:
+        cinder_snapshooter.metrics.serve.assert_not_called()
+        cinder_snapshooter.metrics.write_textfile.assert_not_called()
+    if token_cache:
+        cinder_snapshooter.token_cache.TokenCache.assert_called_once_with(
+            args.token_cache_path, args.token_min_validity
+        )
+        assert (
+            args.token_cache == cinder_snapshooter.token_cache.TokenCache.return_value
+        )
+    else:
+        assert args.token_cache is None
+    if stats:
+        cinder_snapshooter.project_stats.ProjectStats.assert_called_once_with(
+            args.stats_file
+        )
+        assert (
+            args.project_stats
+            == cinder_snapshooter.project_stats.ProjectStats.return_value
+        )
+    else:
+        assert args.project_stats is None
+    journal = cinder_snapshooter.journal.Journal
+    if stats:
+        journal.assert_called_once_with(args.journal_path, args.resume)
+        assert args.journal == journal.return_value
+        args.journal.close.assert_called_once_with()
+    else:
+        assert args.journal is None
+    if backend_concurrency:
+        assert args.backend_limits.key == "host"
+        assert args.backend_limits.limits == backend_concurrency
+        assert args.backend_limits.default_limit is None
+    else:
+        assert args.backend_limits is None
     args.func.assert_called_once_with(args)
-    cinder_snapshooter.cli.setup_logging.assert_called_once_with(args)
+    cinder_snapshooter.utils.setup_logging.assert_called_once_with(args)
+
+
+def test_main(mocker):
+    mocker.patch("cinder_snapshooter.cli.cli", return_value=None)
+
+    with pytest.raises(SystemExit) as exit_info:
+        runpy.run_module("cinder_snapshooter", run_name="__main__")
+
+    assert exit_info.value.code is None
+    cinder_snapshooter.cli.cli.assert_called_once_with()
+
+
+def test_parse_common_args():
+    args = cinder_snapshooter.cli.parse_common_args(
+        ["--pool-size", "5", "creator", "--help", "-n"]
+    )
+
+    assert args.pool_size == 5
+    assert args.subcommand == "creator"
+    assert not hasattr(args, "func")
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--shard-count", "0", "creator"],
+        ["--shard-index", "2", "--shard-count", "2", "creator"],
+        ["--shard-index", "-1", "creator"],
+    ],
+)
+def test_parse_common_args_invalid_shard(args):
+    with pytest.raises(SystemExit):
+        cinder_snapshooter.cli.parse_common_args(args)
+
+
+def test_parse_common_args_resume_without_journal():
+    with pytest.raises(SystemExit):
+        cinder_snapshooter.cli.parse_common_args(["--resume", "creator"])
+
+
+def test_parse_common_args_deadline_without_stats():
+    with pytest.raises(SystemExit):
+        cinder_snapshooter.cli.parse_common_args(["--deadline", "3600", "creator"])
+
+
+def test_parse_common_args_largest_first_without_stats():
+    with pytest.raises(SystemExit):
+        cinder_snapshooter.cli.parse_common_args(
+            ["--schedule", "largest-first", "creator"]
+        )
+
+    args = cinder_snapshooter.cli.parse_common_args(
+        ["--schedule", "largest-first", "--all-tenants", "creator"]
+    )
+    assert args.schedule == "largest-first"
+
+
+@pytest.mark.parametrize(
+    "value,limits",
+    [
+        ("nfs=4", {"nfs": 4}),
+        ("nfs@pool#a=4, ceph=50,", {"nfs@pool#a": 4, "ceph": 50}),
+        ("", {}),
+        ("nfs", None),
+        ("=4", None),
+        ("nfs=0", None),
+        ("nfs=many", None),
+    ],
+)
+def test_parse_backend_limits(value, limits):
+    if limits is None:
+        with pytest.raises(argparse.ArgumentTypeError):
+            cinder_snapshooter.cli.parse_backend_limits(value)
+    else:
+        assert cinder_snapshooter.cli.parse_backend_limits(value) == limits
+
+
+def _imported_modules(*args):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "cinder_snapshooter", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {
+        line.rsplit("|", 1)[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+
+def test_startup_imports():
+    # Importing any of these costs more than everything the help needs
+    heavy = {"openstack", "keystoneauth1", "requests", "eventlet"}
+    imported = _imported_modules("--help")
+    assert "cinder_snapshooter.cli" in imported
+    assert not imported & heavy
+
+    # importlib imports the subcommand module itself out of importtime's sight
+    imported = _imported_modules("reconcile", "--help")
+    assert {"cinder_snapshooter.snapshot_creator", "openstack", "eventlet"} <= imported
+    assert "cinder_snapshooter.daemon" not in imported
+
+    # The destroyer shares the listings, not the creator
+    imported = _imported_modules("destroyer", "--help")
+    assert "cinder_snapshooter.records" in imported
+    assert "cinder_snapshooter.snapshot_creator" not in imported
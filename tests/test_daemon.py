@@ -0,0 +1,175 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import datetime
+import signal
+
+import pytest
+
+import cinder_snapshooter.daemon
+
+from cinder_snapshooter.daemon import CronSchedule, Daemon
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+@pytest.mark.parametrize(
+    "expression, after, expected",
+    [
+        ("0 0 * * *", utc(2021, 6, 15, 12, 30, 10), utc(2021, 6, 16)),
+        ("0 0 * * *", utc(2021, 6, 16), utc(2021, 6, 17)),
+        ("*/15 * * * *", utc(2021, 6, 15, 12, 30, 10), utc(2021, 6, 15, 12, 45)),
+        ("5/20 8-9 * * *", utc(2021, 6, 15, 8, 50), utc(2021, 6, 15, 9, 5)),
+        ("30 2 1,15 * *", utc(2021, 6, 15, 3), utc(2021, 7, 1, 2, 30)),
+        ("0 0 * 2 *", utc(2021, 6, 15), utc(2022, 2, 1)),
+        # 2021-06-20 is a Sunday
+        ("0 12 * * 0", utc(2021, 6, 15), utc(2021, 6, 20, 12)),
+        ("0 12 * * 7", utc(2021, 6, 15), utc(2021, 6, 20, 12)),
+        # Either the day of month or the day of week
+        ("0 0 18 * 0", utc(2021, 6, 15), utc(2021, 6, 18)),
+        ("0 0 29 2 *", utc(2021, 3, 1), utc(2024, 2, 29)),
+    ],
+)
+def test_cron_schedule(expression, after, expected):
+    assert CronSchedule(expression).next_after(after) == expected
+
+
+@pytest.mark.parametrize(
+    "expression", ["* * * *", "60 * * * *", "* 5-2 * * *", "*/0 * * * *", "a * * * *"]
+)
+def test_cron_schedule_invalid(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_register_args_invalid_schedule():
+    parser = argparse.ArgumentParser()
+    cinder_snapshooter.daemon.register_args(parser)
+
+    assert parser.parse_args([]).creator_schedule == CronSchedule("0 0 * * *")
+    # A malformed expression is a usage error rather than a crash at startup
+    with pytest.raises(SystemExit):
+        parser.parse_args(["--creator-schedule", "0 25 * * *"])
+
+
+def test_cron_schedule_never():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 31 2 *").next_after(utc(2021, 6, 15))
+
+
+@pytest.fixture
+def clock(mocker, time_machine):
+    """Start on 2021-06-15 at noon, sleeping moves time forward"""
+    time_machine.move_to(utc(2021, 6, 15, 12), tick=False)
+    mocker.patch(
+        "cinder_snapshooter.daemon.eventlet.sleep", side_effect=time_machine.shift
+    )
+    return time_machine
+
+
+def test_daemon(mocker, log, clock):
+    runs = []
+
+    def run_pass(name, duration=0, error=None):
+        def run():
+            runs.append((name, datetime.datetime.now(datetime.timezone.utc)))
+            clock.shift(duration)
+            if len(runs) == 5:
+                daemon.stop()
+            if error is not None:
+                raise error
+            return True
+
+        return run
+
+    daemon = Daemon(
+        {
+            "creator": (CronSchedule("0 * * * *"), run_pass("creator", 90 * 60)),
+            "destroyer": (
+                CronSchedule("0 */2 * * *"),
+                run_pass("destroyer", error=Exception()),
+            ),
+        }
+    )
+    daemon.run_forever()
+
+    assert runs == [
+        ("creator", utc(2021, 6, 15, 13)),
+        ("destroyer", utc(2021, 6, 15, 14, 30)),
+        # The run of 14:00 was missed
+        ("creator", utc(2021, 6, 15, 15)),
+        ("destroyer", utc(2021, 6, 15, 16, 30)),
+        ("creator", utc(2021, 6, 15, 17)),
+    ]
+    assert log.has(
+        "Pass overran its schedule, skipping missed runs",
+        command="creator",
+        level="warning",
+    )
+    assert log.has("Pass failed", command="destroyer", level="error")
+    assert log.has("Pass over", command="destroyer", success=False)
+    assert log.has("Daemon stopped")
+
+
+def test_daemon_stopped(mocker, log, clock):
+    run = mocker.MagicMock()
+    daemon = Daemon({"creator": (CronSchedule("0 0 * * *"), run)})
+    cinder_snapshooter.daemon.eventlet.sleep.side_effect = lambda seconds: daemon.stop(
+        signal.SIGTERM
+    )
+
+    daemon.run_forever()
+
+    run.assert_not_called()
+    assert log.has("Stopping once the running pass is over", signal=signal.SIGTERM)
+
+
+def test_cli(mocker, faker):
+    mocker.patch("cinder_snapshooter.daemon.Daemon")
+    mocker.patch("cinder_snapshooter.daemon.metrics.write_textfile")
+    mocker.patch("cinder_snapshooter.daemon.snapshot_creator.run")
+    mocker.patch("cinder_snapshooter.daemon.snapshot_destroyer.run")
+    mocker.patch("signal.signal")
+    args = argparse.Namespace(
+        creator_schedule=CronSchedule("0 2 * * *"),
+        destroyer_schedule=CronSchedule("0 3 * * *"),
+        connections=None,
+        metrics_textfile=faker.file_path(),
+    )
+
+    cinder_snapshooter.daemon.cli(args)
+
+    assert args.connections == {}
+    daemon = cinder_snapshooter.daemon.Daemon.return_value
+    daemon.run_forever.assert_called_once_with()
+    signal.signal.assert_any_call(signal.SIGTERM, daemon.stop)
+    passes = cinder_snapshooter.daemon.Daemon.call_args.args[0]
+    assert list(passes) == ["creator", "destroyer"]
+    assert passes["creator"][0].hours == {2}
+    assert passes["destroyer"][0].hours == {3}
+    passes["creator"][1]()
+    cinder_snapshooter.daemon.snapshot_creator.run.assert_called_once_with(args)
+    passes["destroyer"][1]()
+    cinder_snapshooter.daemon.snapshot_destroyer.run.assert_called_once_with(args)
+    # The metrics are exported after each pass
+    assert cinder_snapshooter.daemon.metrics.write_textfile.call_count == 2
+    cinder_snapshooter.daemon.metrics.write_textfile.assert_called_with(
+        args.metrics_textfile
+    )
@@ -0,0 +1,225 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import dataclasses
+import datetime
+import json
+
+import eventlet
+import pytest
+
+from openstack.exceptions import ResourceNotFound
+
+import cinder_snapshooter.exceptions
+import cinder_snapshooter.groups
+import cinder_snapshooter.utils
+
+from cinder_snapshooter.groups import GroupRecord, GroupSnapshotRecord
+from fixtures import FakeGroup, FakeGroupSnapshot
+
+
+def fake_group_snapshot(faker, status="available", **attributes):
+    group_snapshot = FakeGroupSnapshot(
+        id=faker.uuid4(),
+        status=status,
+        group_id=faker.uuid4(),
+        created_at=faker.iso8601(),
+    )
+    return dataclasses.replace(group_snapshot, **attributes)
+
+
+def test_list_groups(mocker, faker):
+    block_storage = mocker.MagicMock()
+    groups = [
+        FakeGroup(id=faker.uuid4(), status="available", volumes=volumes)
+        for volumes in ([faker.uuid4(), faker.uuid4()], [], None)
+    ]
+    block_storage._list.return_value = iter(groups)
+
+    assert list(
+        cinder_snapshooter.groups.list_groups(block_storage, all_projects=True)
+    ) == [GroupRecord(groups[0].id, "available", tuple(groups[0].volumes), None)]
+    block_storage._list.assert_called_once_with(
+        cinder_snapshooter.groups._Group,
+        base_path="/groups/detail",
+        list_volume=True,
+        all_projects=True,
+    )
+
+
+@pytest.mark.parametrize(
+    "description,expire_at",
+    [
+        ('{"expire_at": "2023-09-15"}', "2023-09-15"),
+        ("A snapshot taken by hand", None),
+        ('["2023-09-15"]', None),
+        (None, None),
+    ],
+)
+def test_list_group_snapshots(mocker, faker, description, expire_at):
+    block_storage = mocker.MagicMock()
+    group_snapshot = fake_group_snapshot(faker, description=description)
+    block_storage._list.return_value = iter([group_snapshot])
+
+    assert list(cinder_snapshooter.groups.list_group_snapshots(block_storage)) == [
+        GroupSnapshotRecord(
+            group_snapshot.id,
+            "available",
+            group_snapshot.group_id,
+            group_snapshot.created_at,
+            expire_at,
+            None,
+        )
+    ]
+    block_storage._list.assert_called_once_with(
+        cinder_snapshooter.groups._GroupSnapshot,
+        base_path="/group_snapshots/detail",
+    )
+
+
+def test_group_creation_tracker(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    group_snapshots = {
+        status: fake_group_snapshot(
+            faker, status="creating", created_at=f"2023-09-14T10:00:0{i}.000000"
+        )
+        for i, status in enumerate(["available", "error", "creating"])
+    }
+    current = {
+        group_snapshot.id: dataclasses.replace(group_snapshot, status=status)
+        for status, group_snapshot in group_snapshots.items()
+    }
+    current[faker.uuid4()] = fake_group_snapshot(faker, status="creating")
+    # Newest first, as the API sorts them by default
+    os_client.block_storage._list.side_effect = lambda _type, base_path, status: [
+        group_snapshot
+        for group_snapshot in sorted(
+            current.values(), key=lambda group_snapshot: group_snapshot.created_at
+        )[::-1]
+        if group_snapshot.status == status
+    ]
+    os_client.block_storage._get.side_effect = lambda _type, group_snapshot_id: (
+        current[group_snapshot_id]
+    )
+    tracker = cinder_snapshooter.groups.GroupCreationTracker(
+        os_client, 0.05, cinder_snapshooter.utils.PollingPolicy(0, 0)
+    )
+
+    greenlets = {
+        status: eventlet.spawn(tracker.wait, group_snapshot)
+        for status, group_snapshot in group_snapshots.items()
+    }
+
+    assert greenlets["available"].wait().status == "available"
+    with pytest.raises(cinder_snapshooter.exceptions.GroupSnapshotInError) as err:
+        greenlets["error"].wait()
+    assert err.value.snapshot.group_id == group_snapshots["error"].group_id
+    with pytest.raises(cinder_snapshooter.exceptions.GroupSnapshotCreationTimeout):
+        greenlets["creating"].wait()
+    # The group snapshots are resolved by one round of listings, and the last
+    # one pending on its own
+    assert os_client.block_storage._list.call_args_list == [
+        mocker.call(
+            cinder_snapshooter.groups._GroupSnapshot,
+            base_path="/group_snapshots/detail",
+            status=status,
+        )
+        for status in ("creating", "error", "available")
+    ]
+    assert {call[0][1] for call in os_client.block_storage._get.call_args_list} == {
+        group_snapshots["creating"].id
+    }
+
+
+def test_create_group_snapshot(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    group = GroupRecord(
+        faker.uuid4(), "available", (faker.uuid4(), faker.uuid4()), None
+    )
+    group_snapshot = fake_group_snapshot(faker, status="creating", group_id=group.id)
+    os_client.block_storage._create.return_value = group_snapshot
+    os_client.block_storage._get.return_value = dataclasses.replace(
+        group_snapshot, status="available"
+    )
+    tracker = cinder_snapshooter.groups.GroupCreationTracker(
+        os_client, 1, cinder_snapshooter.utils.PollingPolicy(0, 0)
+    )
+    created = cinder_snapshooter.groups.metrics.SNAPSHOTS_CREATED
+    created_before = created.value(project=os_client.current_project_id)
+
+    assert (
+        cinder_snapshooter.groups.create_group_snapshot(
+            os_client,
+            group,
+            datetime.datetime(2023, 9, 15, tzinfo=datetime.timezone.utc),
+            1,
+            tracker=tracker,
+        )
+        == os_client.block_storage._get.return_value
+    )
+
+    os_client.block_storage._create.assert_called_once_with(
+        cinder_snapshooter.groups._GroupSnapshot,
+        group_id=group.id,
+        name="Automatic daily snapshot",
+        description=json.dumps({"expire_at": "2023-09-15"}),
+    )
+    os_client.block_storage._get.assert_called_once_with(
+        cinder_snapshooter.groups._GroupSnapshot, group_snapshot.id
+    )
+    # Each volume of the group got a snapshot
+    assert created.value(project=os_client.current_project_id) == created_before + 2
+    assert log.has(
+        "Created group snapshot",
+        group=group.id,
+        group_snapshot=group_snapshot.id,
+        volumes=2,
+        expire_at="2023-09-15",
+    )
+
+
+@pytest.mark.parametrize("missing", [True, False])
+def test_delete_group_snapshot(mocker, faker, log, missing):
+    os_client = mocker.MagicMock()
+    group_snapshot = GroupSnapshotRecord.from_resource(
+        fake_group_snapshot(faker, description='{"expire_at": "2023-09-15"}')
+    )
+    if missing:
+        os_client.block_storage._delete.side_effect = ResourceNotFound
+    os_client.block_storage._get.side_effect = ResourceNotFound
+    tracker = cinder_snapshooter.groups.GroupDeletionTracker(
+        os_client, 1, cinder_snapshooter.utils.PollingPolicy(0, 0)
+    )
+
+    assert cinder_snapshooter.groups.delete_group_snapshot(
+        os_client, group_snapshot, 1, tracker=tracker
+    )
+
+    os_client.block_storage._delete.assert_called_once_with(
+        cinder_snapshooter.groups._GroupSnapshot,
+        group_snapshot.id,
+        ignore_missing=False,
+    )
+    if missing:
+        os_client.block_storage._get.assert_not_called()
+        assert not log.has("Deleted group snapshot")
+    else:
+        assert log.has(
+            "Deleted group snapshot",
+            group_snapshot=group_snapshot.id,
+            group=group_snapshot.group_id,
+        )
@@ -0,0 +1,123 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+
+from cinder_snapshooter.journal import Journal
+
+
+def test_resume(tmp_path, faker, log):
+    path = str(tmp_path / "journal.jsonl")
+    project_ids = [faker.uuid4() for i in range(2)]
+    volume_ids = [faker.uuid4() for i in range(3)]
+    snapshot_ids = [faker.uuid4() for i in range(2)]
+    journal = Journal(path)
+    journal.begin("process_volumes")
+    run = journal.run("process_volumes")
+    journal.project_done("process_volumes", project_ids[0])
+    run.snapshot_requested(project_ids[1], volume_ids[0], snapshot_ids[0])
+    run.snapshot_requested(project_ids[1], volume_ids[1], snapshot_ids[1])
+    run.snapshot_available(project_ids[1], volume_ids[1])
+    # Killed before the end of the run
+    journal.close()
+
+    journal = Journal(path, resume=True)
+    journal.begin("process_volumes")
+    run = journal.run("process_volumes")
+
+    assert log.has(
+        "Resuming run left unfinished", task="process_volumes", finished=1, pending=1
+    )
+    assert journal.finished("process_volumes", project_ids[0])
+    assert not journal.finished("process_volumes", project_ids[1])
+    assert not journal.finished("process_snapshots", project_ids[0])
+    assert run.pending_snapshot(project_ids[1], volume_ids[0]) == snapshot_ids[0]
+    assert run.pending_snapshot(project_ids[1], volume_ids[1]) is None
+    assert run.snapshotted(project_ids[1], volume_ids[1])
+    assert not run.snapshotted(project_ids[1], volume_ids[2])
+    # The other tasks know nothing of these snapshots
+    other = journal.run("process_project")
+    assert other.pending_snapshot(project_ids[1], volume_ids[0]) is None
+    assert not other.snapshotted(project_ids[1], volume_ids[1])
+
+
+def test_no_resume(tmp_path, faker):
+    path = str(tmp_path / "journal.jsonl")
+    project_id = faker.uuid4()
+    journal = Journal(path)
+    journal.begin("process_volumes")
+    journal.project_done("process_volumes", project_id)
+    journal.close()
+
+    journal = Journal(path)
+    journal.begin("process_volumes")
+
+    assert not journal.finished("process_volumes", project_id)
+    with open(path) as journal_file:
+        assert [json.loads(line) for line in journal_file] == [
+            {"event": "begin", "task": "process_volumes"}
+        ]
+
+
+def test_torn_line(tmp_path, faker, log):
+    path = tmp_path / "journal.jsonl"
+    project_ids = [faker.uuid4() for i in range(2)]
+    journal = Journal(str(path))
+    journal.begin("process_volumes")
+    journal.project_done("process_volumes", project_ids[0])
+    journal.close()
+    # Died while writing an event
+    with open(path, "a") as journal_file:
+        journal_file.write('{"event": "project", "task": "process_vol')
+
+    journal = Journal(str(path), resume=True)
+    journal.project_done("process_volumes", project_ids[1])
+    journal.close()
+
+    assert log.has("Ignoring torn journal entry", path=str(path))
+    journal = Journal(str(path), resume=True)
+    assert all(
+        journal.finished("process_volumes", project_id) for project_id in project_ids
+    )
+
+
+def test_end(tmp_path, faker):
+    path = tmp_path / "journal.jsonl"
+    project_id = faker.uuid4()
+    journal = Journal(str(path))
+    journal.begin("process_volumes")
+    journal.begin("process_snapshots")
+    journal.project_done("process_volumes", project_id)
+    journal.project_done("process_snapshots", project_id)
+
+    journal.end("process_volumes")
+
+    assert not journal.finished("process_volumes", project_id)
+    assert journal.finished("process_snapshots", project_id)
+    assert path.stat().st_size > 0
+
+    # Nothing is left to resume once no run is in progress
+    journal.end("process_snapshots")
+
+    assert not journal.finished("process_snapshots", project_id)
+    assert path.stat().st_size == 0
+    journal.begin("process_volumes")
+    journal.close()
+    with open(path) as journal_file:
+        assert [json.loads(line) for line in journal_file] == [
+            {"event": "begin", "task": "process_volumes"}
+        ]
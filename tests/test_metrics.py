@@ -0,0 +1,117 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import stat
+
+import pytest
+
+from eventlet.green.urllib import error, request
+
+import cinder_snapshooter.metrics
+
+from cinder_snapshooter.metrics import Counter, Gauge, Histogram, Registry
+
+
+@pytest.fixture
+def registry():
+    registry = Registry()
+    counter = registry.register(
+        Counter("test_requests_total", "Requests made", ["endpoint"])
+    )
+    counter.inc(endpoint="identity")
+    counter.inc(2, endpoint='say "hello"\n')
+    gauge = registry.register(Gauge("test_in_progress", "In progress"))
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    histogram = registry.register(
+        Histogram("test_duration_seconds", "Duration", ["operation"], buckets=(1, 5))
+    )
+    for value in (0.5, 1, 3, 10):
+        histogram.observe(value, operation="create")
+    return registry
+
+
+def test_render(registry):
+    assert registry.render() == (
+        "# HELP test_requests_total Requests made\n"
+        "# TYPE test_requests_total counter\n"
+        'test_requests_total{endpoint="identity"} 1\n'
+        'test_requests_total{endpoint="say \\"hello\\"\\n"} 2\n'
+        "# HELP test_in_progress In progress\n"
+        "# TYPE test_in_progress gauge\n"
+        "test_in_progress 1\n"
+        "# HELP test_duration_seconds Duration\n"
+        "# TYPE test_duration_seconds histogram\n"
+        'test_duration_seconds_bucket{operation="create",le="1"} 2\n'
+        'test_duration_seconds_bucket{operation="create",le="5"} 3\n'
+        'test_duration_seconds_bucket{operation="create",le="+Inf"} 4\n'
+        'test_duration_seconds_sum{operation="create"} 14.5\n'
+        'test_duration_seconds_count{operation="create"} 4\n'
+    )
+
+
+def test_values(registry):
+    counter, gauge, histogram = registry.metrics
+    assert counter.value(endpoint="identity") == 1
+    assert counter.value(endpoint="compute") == 0
+    assert gauge.value() == 1
+    assert histogram.count(operation="create") == 4
+    assert histogram.count(operation="delete") == 0
+    with pytest.raises(ValueError):
+        counter.inc(project="42")
+
+
+@pytest.mark.parametrize(
+    "method, url, operation",
+    [
+        ("GET", "https://cinder/v3/1234/snapshots/detail?status=available", "list"),
+        ("GET", "/snapshots", "list"),
+        ("GET", "/snapshots/f728b4fa-4248-4e3a-8a5d-2f346baa9455", "get"),
+        ("GET", "/v3/projects/0123456789abcdef0123456789abcdef/", "get"),
+        ("POST", "/snapshots", "create"),
+        ("PUT", "/snapshots/f728b4fa-4248-4e3a-8a5d-2f346baa9455", "update"),
+        ("DELETE", "/snapshots/f728b4fa-4248-4e3a-8a5d-2f346baa9455", "delete"),
+        ("head", "/", "head"),
+    ],
+)
+def test_api_operation(method, url, operation):
+    assert cinder_snapshooter.metrics.api_operation(method, url) == operation
+
+
+def test_write_textfile(tmp_path, log, registry):
+    path = tmp_path / "cinder_snapshooter.prom"
+    cinder_snapshooter.metrics.write_textfile(str(path), registry)
+    assert path.read_text() == registry.render()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+
+def test_serve(log):
+    server = cinder_snapshooter.metrics.serve(0, "127.0.0.1")
+    port = log.events[-1]["port"]
+    try:
+        with request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"] == (
+                cinder_snapshooter.metrics.CONTENT_TYPE
+            )
+            body = response.read().decode()
+        assert body == cinder_snapshooter.metrics.REGISTRY.render()
+        with pytest.raises(error.HTTPError):
+            request.urlopen(f"http://127.0.0.1:{port}/other")
+    finally:
+        server.kill()
@@ -0,0 +1,80 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+
+import pytest
+
+from cinder_snapshooter.project_stats import ProjectStats
+
+
+def test_record(tmp_path, faker):
+    path = str(tmp_path / "stats.json")
+    project_id = faker.uuid4()
+    stats = ProjectStats(path)
+    assert stats.estimate("process_volumes", project_id) is None
+
+    stats.record("process_volumes", project_id, 10)
+    assert stats.estimate("process_volumes", project_id) == 10
+    stats.record("process_volumes", project_id, 20)
+    assert stats.estimate("process_volumes", project_id) == 15
+    # Tasks are estimated separately
+    assert stats.estimate("process_snapshots", project_id) is None
+
+    stats.save()
+    stats = ProjectStats(path)
+    assert stats.estimate("process_volumes", project_id) == 15
+    with open(path) as stats_file:
+        assert json.load(stats_file) == {
+            "process_volumes": {project_id: {"estimate": 15, "duration": 20}}
+        }
+
+
+def test_skip(tmp_path, faker):
+    path = str(tmp_path / "stats.json")
+    project_ids = [faker.uuid4() for i in range(2)]
+    stats = ProjectStats(path)
+    stats.record("process_volumes", project_ids[0], 10)
+
+    for project_id in project_ids:
+        stats.skip("process_volumes", project_id)
+    stats.save()
+    stats = ProjectStats(path)
+
+    assert stats.skipped("process_volumes", project_ids[0])
+    assert stats.skipped("process_volumes", project_ids[1])
+    assert not stats.skipped("process_snapshots", project_ids[0])
+    assert stats.estimate("process_volumes", project_ids[0]) == 10
+    assert stats.estimate("process_volumes", project_ids[1]) is None
+    # Until processed again
+    stats.record("process_volumes", project_ids[1], 20)
+    assert not stats.skipped("process_volumes", project_ids[1])
+    assert stats.estimate("process_volumes", project_ids[1]) == 20
+
+
+@pytest.mark.parametrize("content", [None, "not json"])
+def test_unreadable(tmp_path, faker, log, content):
+    path = tmp_path / "stats.json"
+    if content is not None:
+        path.write_text(content)
+
+    stats = ProjectStats(str(path))
+
+    assert stats.estimate("process_volumes", faker.uuid4()) is None
+    assert log.has("Unable to read project stats, ignoring them") == (
+        content is not None
+    )
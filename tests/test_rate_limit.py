@@ -0,0 +1,211 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import email.utils
+
+import keystoneauth1.exceptions
+import pytest
+
+import cinder_snapshooter.rate_limit
+
+
+@pytest.fixture
+def clock(mocker):
+    """Fake monotonic clock, sleeping moves it forward"""
+    now = [1000.0]
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    mocker.patch("cinder_snapshooter.rate_limit.time.monotonic", lambda: now[0])
+    mocker.patch("cinder_snapshooter.rate_limit.eventlet.sleep", side_effect=sleep)
+    return now
+
+
+@pytest.mark.parametrize(
+    "headers, delay",
+    [
+        ({}, cinder_snapshooter.rate_limit.DEFAULT_RETRY_AFTER),
+        ({"Retry-After": "3"}, 3),
+        ({"Retry-After": "-3"}, 0),
+        ({"Retry-After": "soon"}, cinder_snapshooter.rate_limit.DEFAULT_RETRY_AFTER),
+    ],
+)
+def test_parse_retry_after(headers, delay):
+    assert cinder_snapshooter.rate_limit.parse_retry_after(headers) == delay
+
+
+def test_parse_retry_after_date():
+    retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=60
+    )
+    delay = cinder_snapshooter.rate_limit.parse_retry_after(
+        {"Retry-After": email.utils.format_datetime(retry_at, usegmt=True)}
+    )
+    assert 55 < delay <= 60
+
+
+def test_token_bucket(clock):
+    bucket = cinder_snapshooter.rate_limit.TokenBucket(2)
+    # The burst goes through, then one request every half second
+    assert [bucket.acquire() for i in range(5)] == [0, 0, 0.5, 0.5, 0.5]
+    clock[0] += 10
+    assert [bucket.acquire() for i in range(3)] == [0, 0, 0.5]
+
+    # Tokens keep coming while paused
+    bucket.pause(3)
+    assert [bucket.acquire() for i in range(3)] == [3, 0, 0.5]
+
+
+def test_token_bucket_unlimited(clock):
+    bucket = cinder_snapshooter.rate_limit.TokenBucket()
+    assert [bucket.acquire() for i in range(100)] == [0] * 100
+    bucket.pause(2)
+    assert bucket.acquire() == 2
+
+
+@pytest.mark.parametrize(
+    "endpoint_filter, endpoint",
+    [
+        (None, "identity"),
+        ({"service_type": "identity"}, "identity"),
+        ({"service_type": "block-storage"}, "block-storage"),
+        ({"service_type": "volumev3"}, "block-storage"),
+        ({"service_type": "compute"}, "compute"),
+    ],
+)
+def test_endpoint(endpoint_filter, endpoint):
+    assert cinder_snapshooter.rate_limit.RateLimiter.endpoint(endpoint_filter) == (
+        endpoint
+    )
+
+
+def fake_response(mocker, status_code, retry_after=None):
+    response = mocker.MagicMock(status_code=status_code, headers={})
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+@pytest.mark.parametrize("raise_exc", [True, False])
+def test_rate_limiter_throttled(mocker, log, clock, raise_exc):
+    os_client = mocker.MagicMock()
+    request = os_client.session.request
+    ok = fake_response(mocker, 200)
+    throttled = [fake_response(mocker, 429, 4), fake_response(mocker, 413, 2)]
+    if raise_exc:
+        request.side_effect = [
+            keystoneauth1.exceptions.from_response(response, "GET", "/snapshots")
+            for response in throttled
+        ] + [ok]
+    else:
+        request.side_effect = throttled + [ok]
+
+    requests_metric = cinder_snapshooter.rate_limit.metrics.API_REQUESTS
+    latency_metric = cinder_snapshooter.rate_limit.metrics.API_LATENCY
+    throttled_before = requests_metric.value(
+        endpoint="block-storage", operation="list", status=429
+    )
+    ok_before = requests_metric.value(
+        endpoint="block-storage", operation="list", status=200
+    )
+    latency_before = latency_metric.count(endpoint="block-storage", operation="list")
+
+    limiter = cinder_snapshooter.rate_limit.RateLimiter(
+        {"block-storage": None, "identity": 1}
+    )
+    limiter.install(os_client)
+    endpoint_filter = {"service_type": "block-storage"}
+    assert (
+        os_client.session.request("/snapshots", "GET", endpoint_filter=endpoint_filter)
+        == ok
+    )
+
+    assert request.call_count == 3
+    request.assert_called_with("/snapshots", "GET", endpoint_filter=endpoint_filter)
+    assert limiter.requests == {"block-storage": 3}
+    assert limiter.throttled == {"block-storage": 2}
+    assert limiter.waited == {"block-storage": 6}
+    assert (
+        requests_metric.value(endpoint="block-storage", operation="list", status=429)
+        == throttled_before + 1
+    )
+    assert (
+        requests_metric.value(endpoint="block-storage", operation="list", status=200)
+        == ok_before + 1
+    )
+    assert (
+        latency_metric.count(endpoint="block-storage", operation="list")
+        == latency_before + 3
+    )
+    assert log.has(
+        "Request throttled, retrying later",
+        endpoint="block-storage",
+        retry_after=4,
+        level="warning",
+    )
+
+    limiter.log_stats()
+    assert log.has(
+        "API requests",
+        endpoint="block-storage",
+        requests=3,
+        throttled=2,
+        waited=6,
+    )
+
+
+@pytest.mark.parametrize("raise_exc", [True, False])
+def test_rate_limiter_gives_up(mocker, log, clock, raise_exc):
+    os_client = mocker.MagicMock()
+    response = fake_response(mocker, 429)
+    if raise_exc:
+        os_client.session.request.side_effect = keystoneauth1.exceptions.from_response(
+            response, "POST", "/auth/tokens"
+        )
+    else:
+        os_client.session.request.return_value = response
+
+    limiter = cinder_snapshooter.rate_limit.RateLimiter({}, retries=2)
+    limiter.install(os_client)
+    if raise_exc:
+        with pytest.raises(keystoneauth1.exceptions.HttpError):
+            os_client.session.request("/auth/tokens", "POST")
+    else:
+        assert os_client.session.request("/auth/tokens", "POST") == response
+    assert limiter.requests == {"identity": 3}
+    assert limiter.throttled == {"identity": 2}
+
+
+def test_rate_limiter_install(mocker, log, clock):
+    os_client = mocker.MagicMock()
+    connect_as = os_client.connect_as
+    project_client = connect_as.return_value
+    project_request = project_client.session.request
+
+    limiter = cinder_snapshooter.rate_limit.RateLimiter({"identity": 1})
+    limiter.install(os_client)
+    assert os_client.connect_as(project_id="42") == project_client
+    connect_as.assert_called_once_with(project_id="42")
+
+    # Project clients share the limit of the client they are derived from
+    os_client.session.request("/auth/tokens", "POST")
+    project_client.session.request("/auth/tokens", "POST")
+    project_request.assert_called_once_with("/auth/tokens", "POST")
+    assert limiter.requests == {"identity": 2}
+    assert limiter.waited == {"identity": 1}
@@ -0,0 +1,197 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import sys
+
+import pytest
+
+import cinder_snapshooter.reconcile
+import cinder_snapshooter.records
+import cinder_snapshooter.utils as utils
+
+
+@pytest.mark.parametrize("all_tenants", [True, False])
+@pytest.mark.parametrize("success", [True, False])
+@pytest.mark.parametrize("state", [True, False])
+def test_cli(mocker, faker, success, all_tenants, state):
+    mocker.patch(
+        "cinder_snapshooter.reconcile.snapshot_creator.supports_metadata_filter",
+        return_value=True,
+    )
+    mocker.patch("cinder_snapshooter.reconcile.run_on_all_projects")
+    mocker.patch("cinder_snapshooter.reconcile.run_on_all_tenants")
+    mocker.patch("cinder_snapshooter.reconcile.StateStore")
+    mocker.patch("sys.exit")
+    if all_tenants:
+        run = cinder_snapshooter.reconcile.run_on_all_tenants
+    else:
+        run = cinder_snapshooter.reconcile.run_on_all_projects
+    run.return_value = [True, success]
+    fake_args = argparse.Namespace(
+        dry_run=faker.boolean(),
+        os_client=mocker.MagicMock(),
+        pool_size=10,
+        wait_completion_timeout=1,
+        volume_concurrency=2,
+        delete_concurrency=5,
+        all_tenants=all_tenants,
+        auth_concurrency=None,
+        token_cache=mocker.MagicMock(),
+        project_preference="membership",
+        connections=None,
+        shard_index=0,
+        shard_count=1,
+        schedule="listing",
+        project_stats=None,
+        deadline=None,
+        journal=None,
+        backend_limits=mocker.MagicMock(),
+        use_groups=False,
+        polling=mocker.MagicMock(),
+        state_file=faker.file_path() if state else None,
+        state_max_age=3600,
+        server_side_filter=state,
+        page_size=100,
+    )
+    cinder_snapshooter.reconcile.cli(fake_args)
+    store = cinder_snapshooter.reconcile.StateStore
+    if state:
+        store.assert_called_once_with(fake_args.state_file, fake_args.state_max_age)
+        store.return_value.close.assert_called_once_with()
+    else:
+        store.assert_not_called()
+    expected_kwargs = dict(
+        polling=fake_args.polling,
+        state=store.return_value if state else None,
+        backend_limits=fake_args.backend_limits,
+        use_groups=fake_args.use_groups,
+        **utils.run_options(fake_args),
+    )
+    if all_tenants:
+        listings = run.call_args.kwargs["listings"]
+        assert listings["volumes"].func == cinder_snapshooter.records.list_volumes
+        assert listings["volumes"].args == (
+            fake_args.os_client.block_storage,
+            # Server side filtering is disabled along with the state
+            state,
+            100,
+        )
+        listings["snapshots"](all_projects=True)
+        fake_args.os_client.block_storage.snapshots.assert_called_once_with(
+            all_projects=True, limit=100
+        )
+        expected_kwargs["listings"] = listings
+        expected_kwargs["scoped"] = True
+    else:
+        probe = run.call_args.kwargs["metadata_filter"]
+        assert probe.enabled == state
+        expected_kwargs["metadata_filter"] = probe
+        expected_kwargs["page_size"] = fake_args.page_size
+    run.assert_called_once_with(
+        fake_args.os_client,
+        cinder_snapshooter.reconcile.process_project,
+        fake_args.pool_size,
+        fake_args.wait_completion_timeout,
+        fake_args.dry_run,
+        fake_args.volume_concurrency,
+        fake_args.delete_concurrency,
+        **expected_kwargs,
+    )
+    if success:
+        sys.exit.assert_not_called()
+    else:
+        sys.exit.assert_called_once_with(1)
+
+
+@pytest.mark.parametrize("prefetched", [True, False])
+@pytest.mark.parametrize("created", [True, False])
+@pytest.mark.parametrize("destroyed", [True, False])
+def test_process_project(mocker, prefetched, created, destroyed):
+    mocker.patch(
+        "cinder_snapshooter.reconcile.snapshot_creator.process_volumes",
+        return_value=created,
+    )
+    mocker.patch(
+        "cinder_snapshooter.reconcile.snapshot_destroyer.process_snapshots",
+        return_value=destroyed,
+    )
+    mocker.patch("cinder_snapshooter.reconcile.list_snapshots")
+    os_client = mocker.MagicMock()
+    snapshots = [mocker.MagicMock() for _ in range(3)]
+    volumes = [mocker.MagicMock()]
+    polling = mocker.MagicMock()
+    state = mocker.MagicMock()
+    backend_limits = mocker.MagicMock()
+    if prefetched:
+        listed = iter(snapshots)
+    else:
+        listed = None
+        cinder_snapshooter.reconcile.list_snapshots.return_value = iter(snapshots)
+
+    assert cinder_snapshooter.reconcile.process_project(
+        os_client,
+        30,
+        False,
+        2,
+        5,
+        volumes=volumes,
+        snapshots=listed,
+        polling=polling,
+        state=state,
+        metadata_filter=True,
+        page_size=100,
+        backend_limits=backend_limits,
+    ) == (created and destroyed)
+
+    if prefetched:
+        cinder_snapshooter.reconcile.list_snapshots.assert_not_called()
+    else:
+        # A single listing of every snapshot, whatever their status
+        cinder_snapshooter.reconcile.list_snapshots.assert_called_once_with(
+            os_client.block_storage, 100
+        )
+    cinder_snapshooter.snapshot_creator.process_volumes.assert_called_once_with(
+        os_client,
+        30,
+        False,
+        2,
+        volumes=volumes,
+        snapshots=snapshots,
+        polling=polling,
+        state=state,
+        metadata_filter=True,
+        page_size=100,
+        backend_limits=backend_limits,
+        use_groups=False,
+        groups=None,
+        group_snapshots=None,
+        journal=None,
+    )
+    cinder_snapshooter.snapshot_destroyer.process_snapshots.assert_called_once_with(
+        os_client,
+        30,
+        False,
+        5,
+        snapshots=snapshots,
+        polling=polling,
+        page_size=100,
+        volumes=volumes,
+        backend_limits=backend_limits,
+        use_groups=False,
+        group_snapshots=None,
+    )
@@ -0,0 +1,145 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import pytest
+
+from openstack.block_storage.v3.snapshot import Snapshot
+from openstack.block_storage.v3.volume import Volume
+
+import cinder_snapshooter.records
+
+from cinder_snapshooter.records import SnapshotRecord, VolumeRecord
+from fixtures import FakeVolume
+
+
+@pytest.mark.parametrize(
+    "metadata, enrolled",
+    [({"automatic_snapshots": "Yes"}, True), ({"automatic_snapshots": "0"}, False)],
+)
+def test_volume_record(faker, metadata, enrolled):
+    volume = Volume(
+        id=faker.uuid4(),
+        status="in-use",
+        volume_type="ssd",
+        project_id=faker.uuid4(),
+        metadata=metadata,
+        host="cinder@nfs#pool",
+        availability_zone="nova",
+    )
+
+    record = VolumeRecord.from_resource(volume)
+
+    assert record == (
+        volume.id,
+        "in-use",
+        "ssd",
+        volume.project_id,
+        enrolled,
+        "cinder@nfs#pool",
+        "nova",
+    )
+    assert not hasattr(record, "__dict__")
+
+
+@pytest.mark.parametrize("metadata", [{"expire_at": "2021-06-22"}, {}])
+def test_snapshot_record(faker, metadata):
+    snapshot = Snapshot(
+        id=faker.uuid4(),
+        status="available",
+        volume_id=faker.uuid4(),
+        created_at="2021-06-15T00:00:00.000000",
+        project_id=faker.uuid4(),
+        metadata=metadata,
+    )
+
+    record = SnapshotRecord.from_resource(snapshot)
+
+    assert record == (
+        snapshot.id,
+        "available",
+        snapshot.volume_id,
+        "2021-06-15T00:00:00.000000",
+        metadata.get("expire_at"),
+        snapshot.project_id,
+    )
+    assert not hasattr(record, "__dict__")
+
+
+@pytest.mark.parametrize("page_size", [None, 50])
+def test_list_snapshots(mocker, faker, page_size):
+    block_storage = mocker.MagicMock()
+    snapshots = [
+        Snapshot(id=faker.uuid4(), status="error", metadata={}) for _ in range(3)
+    ]
+    block_storage.snapshots.return_value = iter(snapshots)
+
+    records = cinder_snapshooter.records.list_snapshots(
+        block_storage, page_size, status="error"
+    )
+
+    assert [record.id for record in records] == [s.id for s in snapshots]
+    if page_size is None:
+        block_storage.snapshots.assert_called_once_with(status="error")
+    else:
+        block_storage.snapshots.assert_called_once_with(status="error", limit=50)
+
+
+@pytest.mark.parametrize("page_size", [None, 100])
+@pytest.mark.parametrize("metadata_filter", [True, False])
+def test_list_volumes(mocker, faker, metadata_filter, page_size):
+    enrolled_volume = cinder_snapshooter.records._EnrolledVolume
+    mocker.patch.object(enrolled_volume, "list")
+    block_storage = mocker.MagicMock()
+    volumes = [
+        FakeVolume(id=faker.uuid4(), status="available", metadata=metadata)
+        for metadata in ({"automatic_snapshots": "true"}, {})
+    ]
+    enrolled_volume.list.return_value = iter(volumes)
+    block_storage.volumes.return_value = iter(volumes)
+    expected_query = {"all_projects": True}
+    if page_size is not None:
+        expected_query["limit"] = page_size
+
+    records = cinder_snapshooter.records.list_volumes(
+        block_storage, metadata_filter, page_size, all_projects=True
+    )
+
+    assert list(records) == [
+        VolumeRecord(volumes[0].id, "available", None, None, True),
+        VolumeRecord(volumes[1].id, "available", None, None, False),
+    ]
+    if metadata_filter:
+        enrolled_volume.list.assert_called_once_with(
+            block_storage,
+            base_path="/volumes/detail",
+            metadata='{"automatic_snapshots": "true"}',
+            **expected_query,
+        )
+        block_storage.volumes.assert_not_called()
+    else:
+        block_storage.volumes.assert_called_once_with(**expected_query)
+        enrolled_volume.list.assert_not_called()
+
+
+def test_enrolled_volume_query():
+    enrolled_volume = cinder_snapshooter.records._EnrolledVolume
+    query = {"metadata": '{"automatic_snapshots": "true"}', "all_projects": True}
+    enrolled_volume._query_mapping._validate(query, enrolled_volume.base_path)
+    assert enrolled_volume._query_mapping._transpose(query, enrolled_volume) == {
+        "metadata": '{"automatic_snapshots": "true"}',
+        "all_tenants": True,
+    }
@@ -16,25 +16,48 @@ limitations under the License.
 SPDX-License-Identifier: Apache-2.0
 """
 import argparse
+import dataclasses
 import datetime
+import gc
 import sys
+import weakref
 
+import eventlet
 import pytest
 
 from dateutil.relativedelta import relativedelta
-from openstack.exceptions import ResourceNotFound
+from openstack.exceptions import NotFoundException, ResourceNotFound
 
 import cinder_snapshooter.exceptions
 import cinder_snapshooter.snapshot_creator
+import cinder_snapshooter.utils
 
-from fixtures import FakeSnapshot, FakeVolume
+from cinder_snapshooter.backend_limits import BackendLimits
+from cinder_snapshooter.groups import GroupRecord, GroupSnapshotRecord
+from cinder_snapshooter.journal import Journal
+from cinder_snapshooter.records import SnapshotRecord, VolumeRecord
+from fixtures import FakeGroupSnapshot, FakeSnapshot, FakeVolume
 
 
+@pytest.mark.parametrize("state", [True, False])
+@pytest.mark.parametrize("all_tenants", [True, False])
 @pytest.mark.parametrize("success", [True, False])
-def test_cli(mocker, faker, success):
+@pytest.mark.parametrize("metadata_filter", [True, False])
+def test_cli(mocker, faker, success, all_tenants, state, metadata_filter):
     mocker.patch("sys.exit")
+    mocker.patch("cinder_snapshooter.snapshot_creator.StateStore")
+    mocker.patch(
+        "cinder_snapshooter.snapshot_creator.supports_metadata_filter",
+        return_value=metadata_filter,
+    )
+    mocker.patch("cinder_snapshooter.snapshot_creator.list_volumes")
     mocker.patch("cinder_snapshooter.snapshot_creator.run_on_all_projects")
-    cinder_snapshooter.snapshot_creator.run_on_all_projects.return_value = [
+    mocker.patch("cinder_snapshooter.snapshot_creator.run_on_all_tenants")
+    if all_tenants:
+        run = cinder_snapshooter.snapshot_creator.run_on_all_tenants
+    else:
+        run = cinder_snapshooter.snapshot_creator.run_on_all_projects
+    run.return_value = [
         True,
         True,
         success,
@@ -44,21 +67,99 @@ def test_cli(mocker, faker, success):
         os_client=mocker.MagicMock(),
         pool_size=10,
         wait_completion_timeout=1,
+        volume_concurrency=5,
+        all_tenants=all_tenants,
+        auth_concurrency=None,
+        token_cache=mocker.MagicMock(),
+        project_preference="membership",
+        connections=None,
+        shard_index=0,
+        shard_count=1,
+        schedule="listing",
+        project_stats=None,
+        deadline=None,
+        journal=None,
+        backend_limits=mocker.MagicMock(),
+        use_groups=False,
+        polling=mocker.MagicMock(),
+        state_file=faker.file_path() if state else None,
+        state_max_age=faker.random_int(),
+        server_side_filter=True,
+        page_size=100,
     )
 
     cinder_snapshooter.snapshot_creator.cli(fake_args)
 
-    cinder_snapshooter.snapshot_creator.run_on_all_projects.assert_called_once_with(
+    state_store = cinder_snapshooter.snapshot_creator.StateStore
+    if state:
+        state_store.assert_called_once_with(
+            fake_args.state_file, fake_args.state_max_age
+        )
+        state_store.return_value.close.assert_called_once_with()
+        expected_state = state_store.return_value
+    else:
+        state_store.assert_not_called()
+        expected_state = None
+
+    expected_args = (
         fake_args.os_client,
         cinder_snapshooter.snapshot_creator.process_volumes,
         fake_args.pool_size,
         fake_args.wait_completion_timeout,
         fake_args.dry_run,
+        fake_args.volume_concurrency,
     )
+    if all_tenants:
+        cinder_snapshooter.snapshot_creator.run_on_all_projects.assert_not_called()
+        run.assert_called_once()
+        assert run.call_args.args == expected_args
+        assert run.call_args.kwargs.pop("polling") == fake_args.polling
+        assert run.call_args.kwargs.pop("state") == expected_state
+        listings = run.call_args.kwargs.pop("listings")
+        listings["volumes"](all_projects=True)
+        cinder_snapshooter.snapshot_creator.list_volumes.assert_called_once_with(
+            fake_args.os_client.block_storage, metadata_filter, 100, all_projects=True
+        )
+        listings["snapshots"](all_projects=True)
+        fake_args.os_client.block_storage.snapshots.assert_called_once_with(
+            status="available", all_projects=True, limit=100
+        )
+        assert run.call_args.kwargs == dict(
+            scoped=True,
+            backend_limits=fake_args.backend_limits,
+            use_groups=fake_args.use_groups,
+            **cinder_snapshooter.utils.run_options(fake_args),
+        )
+    else:
+        cinder_snapshooter.snapshot_creator.run_on_all_tenants.assert_not_called()
+        probe = run.call_args.kwargs["metadata_filter"]
+        run.assert_called_once_with(
+            *expected_args,
+            polling=fake_args.polling,
+            state=expected_state,
+            metadata_filter=probe,
+            page_size=fake_args.page_size,
+            backend_limits=fake_args.backend_limits,
+            use_groups=fake_args.use_groups,
+            **cinder_snapshooter.utils.run_options(fake_args),
+        )
+        # Probed once with the first project
+        assert isinstance(
+            probe, cinder_snapshooter.snapshot_creator.MetadataFilterProbe
+        )
+        supports_metadata_filter = (
+            cinder_snapshooter.snapshot_creator.supports_metadata_filter
+        )
+        supports_metadata_filter.assert_not_called()
+        project_client = mocker.MagicMock()
+        assert probe(project_client) == metadata_filter
+        assert probe(mocker.MagicMock()) == metadata_filter
+        supports_metadata_filter.assert_called_once_with(project_client)
     if not success:
         sys.exit.assert_called_once_with(1)
 
 
+@pytest.mark.parametrize("volume_concurrency", [1, 5])
 @pytest.mark.parametrize("dry_run", [True, False], ids=["dry_run", "real_run"])
 @pytest.mark.parametrize(
     "error",
@@ -68,7 +169,7 @@ def test_cli(mocker, faker, success):
         cinder_snapshooter.exceptions.SnapshotInError,
     ],
 )
-def test_process_volumes(mocker, faker, log, dry_run, error):
+def test_process_volumes(mocker, faker, log, dry_run, error, volume_concurrency):
     os_client = mocker.MagicMock()
     mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot_if_needed")
 
@@ -106,9 +207,21 @@ def test_process_volumes(mocker, faker, log, dry_run, error):
     volumes += ok_volumes
 
     os_client.block_storage.volumes.return_value = volumes
-
-    def create_snapshot_if_needed(ivolume, _client, _wait_completion_timeout, _dry_run):
-        if ivolume in nok_volumes:
+    mocker.patch("cinder_snapshooter.snapshot_creator.snapshot_index")
+    mocker.patch("cinder_snapshooter.snapshot_creator.CreationTracker")
+
+    def create_snapshot_if_needed(
+        ivolume,
+        _client,
+        _wait_completion_timeout,
+        _dry_run,
+        _snapshots,
+        _tracker,
+        _state,
+        _backend_limits,
+        _journal,
+    ):
+        if ivolume.id in {volume.id for volume in nok_volumes}:
             raise error(mocker.MagicMock())
         return ["a snapshot"]
 
@@ -120,8 +233,9 @@ def test_process_volumes(mocker, faker, log, dry_run, error):
     os_client.block_storage.delete_snapshot.return_value = True
     os_client.block_storage.get_snapshot.side_effect = ResourceNotFound
 
+    polling = cinder_snapshooter.utils.PollingPolicy(0, 0)
     assert cinder_snapshooter.snapshot_creator.process_volumes(
-        os_client, 1, dry_run
+        os_client, 1, dry_run, volume_concurrency, polling=polling
     ) == (error is None)
 
     assert (
@@ -138,12 +252,26 @@ def test_process_volumes(mocker, faker, log, dry_run, error):
 
     for volume in ok_volumes:
         cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.assert_any_call(
-            volume,
+            VolumeRecord.from_resource(volume),
             os_client,
             1,
             dry_run,
+            cinder_snapshooter.snapshot_creator.snapshot_index.return_value,
+            cinder_snapshooter.snapshot_creator.CreationTracker.return_value,
+            None,
+            None,
+            None,
         )
 
+    cinder_snapshooter.snapshot_creator.CreationTracker.assert_called_once_with(
+        os_client, 1, polling
+    )
+    # The project snapshots are listed at most once
+    if ok_volumes:
+        cinder_snapshooter.snapshot_creator.snapshot_index.assert_called_once()
+        os_client.block_storage.snapshots.assert_called_once_with(status="available")
+    else:
+        cinder_snapshooter.snapshot_creator.snapshot_index.assert_not_called()
     os_client.block_storage.volumes.assert_called_once_with()
     assert log.has(
         "All volumes processed for project",
@@ -235,8 +363,14 @@ def test_create_snapshot_if_needed(mocker, faker, time_machine, dry_run, last_sn
 
     time_machine.move_to(now)
 
+    tracker = cinder_snapshooter.utils.CreationTracker(
+        os_client, 1, cinder_snapshooter.utils.PollingPolicy(0, 0)
+    )
+    state = mocker.MagicMock()
+    created = cinder_snapshooter.utils.metrics.SNAPSHOTS_CREATED
+    created_before = created.value(project=os_client.current_project_id)
     return_value = cinder_snapshooter.snapshot_creator.create_snapshot_if_needed(
-        volume, os_client, 1, dry_run
+        volume, os_client, 1, dry_run, tracker=tracker, state=state
     )
     os_client.block_storage.snapshots.assert_called_once_with(
         status="available",
@@ -246,9 +380,14 @@ def test_create_snapshot_if_needed(mocker, faker, time_machine, dry_run, last_sn
     if dry_run or last_snapshot == "in_day":
         assert return_value == []
         os_client.block_storage.create_snapshot.assert_not_called()
+        state.record.assert_not_called()
         return
 
-    assert return_value == [os_client.block_storage.get_snapshot.return_value]
+    assert return_value == [
+        SnapshotRecord.from_resource(os_client.block_storage.get_snapshot.return_value)
+    ]
+    state.record.assert_called_once_with(os_client.current_project_id, volume.id, now)
+    assert created.value(project=os_client.current_project_id) == created_before + 1
 
     if last_snapshot == "in_month":
         expire_at = now + relativedelta(days=+7)
@@ -260,3 +399,522 @@ def test_create_snapshot_if_needed(mocker, faker, time_machine, dry_run, last_sn
         description="Automatic daily snapshot",
         metadata={"expire_at": expire_at.date().isoformat()},
     )
+
+
+def test_snapshot_index(mocker, faker, time_machine):
+    now = datetime.datetime(2021, 6, 15, 12, 0, 0, 0, datetime.timezone.utc)
+    time_machine.move_to(now)
+    volume_ids = [faker.uuid4() for i in range(3)]
+
+    def fake_snapshot(volume_id, created_at, automatic=True):
+        return FakeSnapshot(
+            id=faker.uuid4(),
+            status="available",
+            volume_id=volume_id,
+            metadata={"expire_at": "2021-09-15"} if automatic else {},
+            created_at=created_at.isoformat(),
+        )
+
+    snapshots = [
+        fake_snapshot(volume_ids[0], now + relativedelta(days=-3)),
+        fake_snapshot(volume_ids[0], now + relativedelta(months=-2)),
+        fake_snapshot(volume_ids[0], now + relativedelta(hours=-1), automatic=False),
+        fake_snapshot(volume_ids[1], now + relativedelta(months=-1)),
+        fake_snapshot(volume_ids[1], now + relativedelta(months=-2)),
+        fake_snapshot(volume_ids[2], now, automatic=False),
+        dataclasses.replace(
+            fake_snapshot(volume_ids[2], now + relativedelta(days=-1)), status="error"
+        ),
+    ]
+
+    index = cinder_snapshooter.snapshot_creator.snapshot_index(snapshots)
+
+    assert index == {
+        volume_ids[0]: cinder_snapshooter.snapshot_creator.SnapshotHistory(
+            now + relativedelta(days=-3), True
+        ),
+        volume_ids[1]: cinder_snapshooter.snapshot_creator.SnapshotHistory(
+            now + relativedelta(months=-1), False
+        ),
+    }
+
+
+def test_process_volumes_concurrency(mocker, faker):
+    os_client = mocker.MagicMock()
+    mocker.patch("cinder_snapshooter.snapshot_creator.snapshot_index")
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot_if_needed")
+    os_client.block_storage.volumes.return_value = [
+        FakeVolume(
+            id=faker.uuid4(),
+            status="available",
+            metadata={"automatic_snapshots": "true"},
+        )
+        for i in range(10)
+    ]
+    in_flight = []
+    max_in_flight = []
+
+    def create_snapshot_if_needed(ivolume, *_args):
+        in_flight.append(ivolume)
+        max_in_flight.append(len(in_flight))
+        eventlet.sleep(0.01)
+        in_flight.remove(ivolume)
+        return ["a snapshot"]
+
+    cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.side_effect = (
+        create_snapshot_if_needed
+    )
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(os_client, 1, False, 4)
+    assert max(max_in_flight) == 4
+
+
+def test_process_volumes_tally(mocker, faker, log):
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot_if_needed")
+    volumes = [
+        FakeVolume(
+            id=faker.uuid4(),
+            status="available",
+            metadata={"automatic_snapshots": "true"},
+        )
+        for i in range(3)
+    ]
+    created = []
+
+    def create_snapshot_if_needed(volume, *_args):
+        gc.collect()
+        # The snapshots of the volumes done are not kept until the project ends
+        assert all(snapshot() is None for snapshot in created)
+        snapshot = FakeSnapshot(faker.uuid4(), "available", {}, volume.id, "")
+        created.append(weakref.ref(snapshot))
+        return [snapshot]
+
+    cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.side_effect = (
+        create_snapshot_if_needed
+    )
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(
+        mocker.MagicMock(), 1, False, 1, volumes=volumes, snapshots=[]
+    )
+    assert len(created) == 3
+    assert log.has("All volumes processed for project", snapshot_created=3, errors=0)
+
+
+def test_process_volumes_backend_limits(mocker, faker):
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot")
+    backend_limits = BackendLimits(limits={"nfs": 1})
+    in_flight = {"nfs": [], "ceph": []}
+    max_in_flight = {"nfs": [], "ceph": []}
+
+    def create_snapshot(_client, volume, *_args, **_kwargs):
+        in_flight[volume.volume_type].append(volume)
+        max_in_flight[volume.volume_type].append(len(in_flight[volume.volume_type]))
+        eventlet.sleep(0.01)
+        in_flight[volume.volume_type].remove(volume)
+        return mocker.MagicMock()
+
+    cinder_snapshooter.snapshot_creator.create_snapshot.side_effect = create_snapshot
+
+    def process_project():
+        volumes = [
+            FakeVolume(
+                id=faker.uuid4(),
+                status="available",
+                metadata={"automatic_snapshots": "true"},
+                volume_type=volume_type,
+            )
+            for volume_type in ("nfs", "ceph") * 3
+        ]
+        return cinder_snapshooter.snapshot_creator.process_volumes(
+            mocker.MagicMock(),
+            1,
+            False,
+            10,
+            volumes=map(VolumeRecord.from_resource, volumes),
+            snapshots=[],
+            backend_limits=backend_limits,
+        )
+
+    # The cap of a backend is shared between the projects
+    projects = [eventlet.spawn(process_project) for i in range(2)]
+
+    assert all(project.wait() for project in projects)
+    assert max(max_in_flight["nfs"]) == 1
+    assert max(max_in_flight["ceph"]) == 6
+
+
+def test_process_volumes_cancelled(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    volumes = [
+        FakeVolume(
+            id=faker.uuid4(),
+            status="available",
+            metadata={"automatic_snapshots": "true"},
+        )
+        for i in range(4)
+    ]
+    os_client.block_storage.create_snapshot.side_effect = lambda volume_id, **_: (
+        FakeSnapshot(
+            id=faker.uuid4(),
+            status="creating",
+            metadata={},
+            volume_id=volume_id,
+            created_at=faker.iso8601(),
+        )
+    )
+    os_client.block_storage.snapshots.return_value = []
+
+    with pytest.raises(eventlet.Timeout):
+        with eventlet.Timeout(0.05):
+            cinder_snapshooter.snapshot_creator.process_volumes(
+                os_client,
+                10,
+                False,
+                2,
+                volumes=map(VolumeRecord.from_resource, volumes),
+                snapshots=[],
+                polling=cinder_snapshooter.utils.PollingPolicy(0.01, 0.01),
+            )
+    calls = len(os_client.method_calls)
+    eventlet.sleep(0.05)
+
+    # Nothing is left running once the project is cancelled
+    assert os_client.block_storage.create_snapshot.call_count == 2
+    assert len(os_client.method_calls) == calls
+
+
+def test_process_volumes_prefetched(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    mocker.patch("cinder_snapshooter.snapshot_creator.snapshot_index")
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot_if_needed")
+    cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.return_value = []
+    volumes = [
+        FakeVolume(
+            id=faker.uuid4(),
+            status="available",
+            metadata={"automatic_snapshots": "true"},
+        )
+    ]
+    snapshots = [mocker.MagicMock()]
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(
+        os_client, 1, False, volumes=volumes, snapshots=snapshots
+    )
+
+    os_client.block_storage.volumes.assert_not_called()
+    os_client.block_storage.snapshots.assert_not_called()
+    cinder_snapshooter.snapshot_creator.snapshot_index.assert_called_once_with(
+        snapshots
+    )
+
+
+@pytest.mark.parametrize("state_index", ["complete", "partial", "stale"])
+def test_process_volumes_state(mocker, faker, log, state_index):
+    os_client = mocker.MagicMock()
+    mocker.patch("cinder_snapshooter.snapshot_creator.snapshot_index")
+    create = mocker.patch(
+        "cinder_snapshooter.snapshot_creator.create_snapshot_if_needed"
+    )
+    create.return_value = []
+    volumes = [
+        FakeVolume(
+            id=faker.uuid4(),
+            status="available",
+            metadata={"automatic_snapshots": "true"},
+        )
+        for i in range(2)
+    ]
+    os_client.block_storage.volumes.return_value = volumes
+    state = mocker.MagicMock()
+    known = {volume.id: mocker.MagicMock() for volume in volumes}
+    if state_index == "partial":
+        del known[volumes[1].id]
+    state.index.return_value = known if state_index != "stale" else None
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(
+        os_client, 1, False, state=state
+    )
+
+    state.index.assert_called_once_with(os_client.current_project_id)
+    index = cinder_snapshooter.snapshot_creator.snapshot_index.return_value
+    indexes = [c.args[4] for c in create.call_args_list]
+    if state_index == "complete":
+        os_client.block_storage.snapshots.assert_not_called()
+        state.reconcile.assert_not_called()
+        assert indexes == [known, known]
+        return
+
+    # The state is reconciled with the listing of the project's snapshots
+    os_client.block_storage.snapshots.assert_called_once_with(status="available")
+    state.reconcile.assert_called_once_with(os_client.current_project_id, index)
+    if state_index == "partial":
+        assert indexes == [known, index]
+    else:
+        assert indexes == [index, index]
+
+
+@pytest.mark.parametrize(
+    "filters, expected",
+    [
+        ([["name", "status", "metadata"]], True),
+        ([["name", "status"]], False),
+        ([None], False),
+        ([], False),
+    ],
+)
+def test_supports_metadata_filter(mocker, filters, expected):
+    os_client = mocker.MagicMock()
+    os_client.block_storage.resource_filters.return_value = [
+        mocker.MagicMock(filters=f) for f in filters
+    ]
+
+    assert (
+        cinder_snapshooter.snapshot_creator.supports_metadata_filter(os_client)
+        == expected
+    )
+    os_client.block_storage.resource_filters.assert_called_once_with(resource="volume")
+
+
+def test_supports_metadata_filter_unavailable(mocker, log):
+    os_client = mocker.MagicMock()
+    # Cinder older than the microversion 3.33
+    os_client.block_storage.resource_filters.side_effect = NotFoundException()
+
+    assert not cinder_snapshooter.snapshot_creator.supports_metadata_filter(os_client)
+    assert log.has("Unable to probe the volume filters, filtering them client side")
+
+
+def test_process_volumes_metadata_filter(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    mocker.patch("cinder_snapshooter.snapshot_creator.list_volumes")
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot_if_needed")
+    cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.return_value = []
+    cinder_snapshooter.snapshot_creator.list_volumes.return_value = [
+        FakeVolume(
+            id=faker.uuid4(),
+            status="available",
+            metadata={"automatic_snapshots": "true"},
+        )
+    ]
+    os_client.block_storage.snapshots.return_value = []
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(
+        os_client, 1, False, metadata_filter=True
+    )
+
+    cinder_snapshooter.snapshot_creator.list_volumes.assert_called_once_with(
+        os_client.block_storage, True, None
+    )
+    cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.assert_called_once()
+
+
+def test_metadata_filter_probe_disabled(mocker):
+    mocker.patch("cinder_snapshooter.snapshot_creator.supports_metadata_filter")
+    probe = cinder_snapshooter.snapshot_creator.MetadataFilterProbe(False)
+
+    assert not probe(mocker.MagicMock())
+    cinder_snapshooter.snapshot_creator.supports_metadata_filter.assert_not_called()
+
+
+def test_process_volumes_metadata_filter_probe(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    mocker.patch("cinder_snapshooter.snapshot_creator.list_volumes", return_value=[])
+    probe = mocker.MagicMock(
+        spec=cinder_snapshooter.snapshot_creator.MetadataFilterProbe
+    )
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(
+        os_client, 1, False, metadata_filter=probe
+    )
+
+    probe.assert_called_once_with(os_client)
+    cinder_snapshooter.snapshot_creator.list_volumes.assert_called_once_with(
+        os_client.block_storage, probe.return_value, None
+    )
+
+
+@pytest.mark.parametrize(
+    "error", [None, Exception, cinder_snapshooter.exceptions.GroupSnapshotInError]
+)
+def test_process_volumes_groups(mocker, faker, log, error):
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot_if_needed")
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_group_snapshot_if_needed")
+    mocker.patch("cinder_snapshooter.snapshot_creator.delete_group_snapshot")
+    mocker.patch("cinder_snapshooter.snapshot_creator.list_groups")
+    mocker.patch("cinder_snapshooter.snapshot_creator.list_group_snapshots")
+    cinder_snapshooter.snapshot_creator.create_snapshot_if_needed.return_value = [
+        "a snapshot"
+    ]
+    create_group_snapshot = (
+        cinder_snapshooter.snapshot_creator.create_group_snapshot_if_needed
+    )
+    if error is None:
+        create_group_snapshot.return_value = ["a group snapshot"]
+    else:
+        group_snapshot = mocker.MagicMock(
+            id=faker.uuid4(), status="error", description=None
+        )
+        create_group_snapshot.side_effect = error(group_snapshot)
+    os_client = mocker.MagicMock()
+
+    def fake_volume(enrolled=True):
+        return VolumeRecord(faker.uuid4(), "available", None, None, enrolled)
+
+    # Only the first group has all its volumes enrolled
+    grouped = [fake_volume() for i in range(2)]
+    partial = [fake_volume(), fake_volume(enrolled=False)]
+    alone = fake_volume()
+    groups = [
+        GroupRecord(faker.uuid4(), "available", tuple(v.id for v in volumes), None)
+        for volumes in (grouped, partial)
+    ]
+    cinder_snapshooter.snapshot_creator.list_groups.return_value = iter(groups)
+    group_snapshots = [mocker.MagicMock()]
+    cinder_snapshooter.snapshot_creator.list_group_snapshots.return_value = iter(
+        group_snapshots
+    )
+    mocker.patch(
+        "cinder_snapshooter.snapshot_creator.snapshot_index",
+        side_effect=lambda snapshots, key="volume_id": {key: list(snapshots)},
+    )
+
+    assert cinder_snapshooter.snapshot_creator.process_volumes(
+        os_client,
+        1,
+        False,
+        5,
+        volumes=grouped + partial + [alone],
+        snapshots=[],
+        use_groups=True,
+    ) == (error is None)
+
+    cinder_snapshooter.snapshot_creator.list_groups.assert_called_once_with(
+        os_client.block_storage
+    )
+    cinder_snapshooter.snapshot_creator.list_group_snapshots.assert_called_once_with(
+        os_client.block_storage
+    )
+    create_group_snapshot.assert_called_once()
+    assert create_group_snapshot.call_args.args[0] == groups[0]
+    assert create_group_snapshot.call_args.args[4] == {"group_id": group_snapshots}
+    # The enrolled volumes of the other group are snapshotted one by one
+    create_snapshot = cinder_snapshooter.snapshot_creator.create_snapshot_if_needed
+    assert {c.args[0] for c in create_snapshot.call_args_list} == {partial[0], alone}
+    assert log.has(
+        "Group not fully enrolled, snapshotting its volumes one by one",
+        group=groups[1].id,
+        enrolled=1,
+        volumes=2,
+    )
+    delete_group_snapshot = cinder_snapshooter.snapshot_creator.delete_group_snapshot
+    if error == cinder_snapshooter.exceptions.GroupSnapshotInError:
+        delete_group_snapshot.assert_called_once()
+        assert delete_group_snapshot.call_args.args[1].id == group_snapshot.id
+    else:
+        delete_group_snapshot.assert_not_called()
+    assert log.has(
+        "All volumes processed for project",
+        snapshot_created=2,
+        group_snapshot_created=int(error is None),
+        errors=int(error is not None),
+    )
+
+
+@pytest.mark.parametrize("last_snapshot", ["never", "in_month", "in_day"])
+def test_create_group_snapshot_if_needed(mocker, faker, time_machine, last_snapshot):
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_group_snapshot")
+    now = datetime.datetime(2021, 6, 15, 12, 0, 0, 0, datetime.timezone.utc)
+    time_machine.move_to(now, tick=False)
+    group = GroupRecord(faker.uuid4(), "available", (faker.uuid4(),), None)
+    cinder_snapshooter.snapshot_creator.create_group_snapshot.return_value = (
+        FakeGroupSnapshot(faker.uuid4(), "available", group.id, now.isoformat())
+    )
+    os_client = mocker.MagicMock()
+    delta = {"in_month": relativedelta(days=-3), "in_day": relativedelta(hours=-3)}
+    group_snapshots = []
+    if last_snapshot != "never":
+        group_snapshots.append(
+            GroupSnapshotRecord(
+                faker.uuid4(),
+                "available",
+                group.id,
+                (now + delta[last_snapshot]).isoformat(),
+                "2021-06-22",
+                None,
+            )
+        )
+    index = cinder_snapshooter.snapshot_creator.snapshot_index(
+        group_snapshots, key="group_id"
+    )
+    tracker = mocker.MagicMock()
+
+    created = cinder_snapshooter.snapshot_creator.create_group_snapshot_if_needed(
+        group, os_client, 1, False, index, tracker
+    )
+
+    create_group_snapshot = cinder_snapshooter.snapshot_creator.create_group_snapshot
+    if last_snapshot == "in_day":
+        assert created == []
+        create_group_snapshot.assert_not_called()
+        return
+    assert created == [
+        GroupSnapshotRecord.from_resource(create_group_snapshot.return_value)
+    ]
+    if last_snapshot == "in_month":
+        expire_at = now + relativedelta(days=+7)
+    else:
+        expire_at = now + relativedelta(months=+3)
+    create_group_snapshot.assert_called_once_with(
+        os_client, group, expire_at, 1, tracker=tracker
+    )
+
+
+@pytest.mark.parametrize("progress", ["none", "requested", "gone", "available"])
+def test_create_snapshot_if_needed_journal(tmp_path, mocker, faker, progress):
+    mocker.patch("cinder_snapshooter.snapshot_creator.create_snapshot")
+    mocker.patch("cinder_snapshooter.snapshot_creator.adopt_snapshot")
+    os_client = mocker.MagicMock(current_project_id=faker.uuid4())
+    volume = VolumeRecord(faker.uuid4(), "available", None, None, True)
+    snapshot_id = faker.uuid4()
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.begin("process_volumes")
+    run = journal.run("process_volumes")
+    if progress != "none":
+        run.snapshot_requested(os_client.current_project_id, volume.id, snapshot_id)
+    if progress == "available":
+        run.snapshot_available(os_client.current_project_id, volume.id)
+    adopt_snapshot = cinder_snapshooter.snapshot_creator.adopt_snapshot
+    create_snapshot = cinder_snapshooter.snapshot_creator.create_snapshot
+    for snapshot in (adopt_snapshot.return_value, create_snapshot.return_value):
+        snapshot.created_at = faker.iso8601()
+    if progress == "gone":
+        adopt_snapshot.return_value = None
+    state = mocker.MagicMock()
+    tracker = mocker.MagicMock()
+
+    created = cinder_snapshooter.snapshot_creator.create_snapshot_if_needed(
+        volume, os_client, 1, False, {}, tracker, state, journal=run
+    )
+
+    if progress == "available":
+        assert created == []
+        adopt_snapshot.assert_not_called()
+        create_snapshot.assert_not_called()
+        return
+    if progress == "none":
+        adopt_snapshot.assert_not_called()
+    else:
+        adopt_snapshot.assert_called_once_with(
+            os_client, volume, snapshot_id, 1, tracker=tracker
+        )
+    if progress == "requested":
+        # Adopted rather than requested again
+        assert created == [SnapshotRecord.from_resource(adopt_snapshot.return_value)]
+        create_snapshot.assert_not_called()
+    else:
+        assert created == [SnapshotRecord.from_resource(create_snapshot.return_value)]
+        create_snapshot.assert_called_once_with(
+            os_client, volume, mocker.ANY, 1, tracker=tracker, journal=run
+        )
+    state.record.assert_called_once()
+    assert run.snapshotted(os_client.current_project_id, volume.id)
@@ -16,9 +16,11 @@ limitations under the License.
 SPDX-License-Identifier: Apache-2.0
 """
 import argparse
+import dataclasses
 import datetime
 import sys
 
+import eventlet
 import pytest
 
 from openstack.exceptions import ResourceNotFound
@@ -26,14 +28,24 @@ from openstack.exceptions import ResourceNotFound
 import cinder_snapshooter.snapshot_destroyer
 import cinder_snapshooter.utils as utils
 
-from fixtures import FakeSnapshot
+from cinder_snapshooter.backend_limits import BackendLimits
+from cinder_snapshooter.groups import GroupSnapshotRecord
+from cinder_snapshooter.records import VolumeRecord
+from fixtures import FakeGroupSnapshot, FakeSnapshot, FakeVolume
 
 
+@pytest.mark.parametrize("all_tenants", [True, False])
 @pytest.mark.parametrize("success", [True, False])
-def test_cli(mocker, faker, success):
+@pytest.mark.parametrize("backend_limits", [True, False])
+def test_cli(mocker, faker, success, all_tenants, backend_limits):
     mocker.patch("cinder_snapshooter.snapshot_destroyer.run_on_all_projects")
+    mocker.patch("cinder_snapshooter.snapshot_destroyer.run_on_all_tenants")
     mocker.patch("sys.exit")
-    cinder_snapshooter.snapshot_destroyer.run_on_all_projects.return_value = [
+    if all_tenants:
+        run = cinder_snapshooter.snapshot_destroyer.run_on_all_tenants
+    else:
+        run = cinder_snapshooter.snapshot_destroyer.run_on_all_projects
+    run.return_value = [
         True,
         True,
         success,
@@ -43,22 +55,65 @@ def test_cli(mocker, faker, success):
         os_client=mocker.MagicMock(),
         pool_size=10,
         wait_completion_timeout=1,
+        delete_concurrency=5,
+        all_tenants=all_tenants,
+        auth_concurrency=None,
+        token_cache=mocker.MagicMock(),
+        project_preference="membership",
+        connections=None,
+        shard_index=0,
+        shard_count=1,
+        schedule="listing",
+        project_stats=None,
+        deadline=None,
+        journal=None,
+        backend_limits=mocker.MagicMock() if backend_limits else None,
+        use_groups=False,
+        polling=mocker.MagicMock(),
+        page_size=100,
     )
     cinder_snapshooter.snapshot_destroyer.cli(fake_args)
-    cinder_snapshooter.snapshot_destroyer.run_on_all_projects.assert_called_once_with(
+    expected_kwargs = dict(
+        polling=fake_args.polling,
+        backend_limits=fake_args.backend_limits,
+        use_groups=fake_args.use_groups,
+        **utils.run_options(fake_args),
+    )
+    if all_tenants:
+        listings = run.call_args.kwargs["listings"]
+        listings["snapshots"](all_projects=True)
+        fake_args.os_client.block_storage.snapshots.assert_called_once_with(
+            all_projects=True, limit=100
+        )
+        # The volumes tell the backend of the snapshots to delete
+        assert ("volumes" in listings) == backend_limits
+        if backend_limits:
+            list(listings["volumes"](all_projects=True))
+            fake_args.os_client.block_storage.volumes.assert_called_once_with(
+                all_projects=True, limit=100
+            )
+        expected_kwargs["listings"] = listings
+    else:
+        expected_kwargs["page_size"] = fake_args.page_size
+    run.assert_called_once_with(
         fake_args.os_client,
         cinder_snapshooter.snapshot_destroyer.process_snapshots,
         fake_args.pool_size,
         fake_args.wait_completion_timeout,
         fake_args.dry_run,
+        fake_args.delete_concurrency,
+        **expected_kwargs,
     )
     if not success:
         sys.exit.assert_called_once_with(1)
 
 
+@pytest.mark.parametrize("delete_concurrency", [1, 10])
 @pytest.mark.parametrize("dry_run", [True, False], ids=["dry-run", "real-run"])
 @pytest.mark.parametrize("success", [True, False])
-def test_process_snapshots(mocker, faker, log, time_machine, dry_run, success):
+def test_process_snapshots(
+    mocker, faker, log, time_machine, dry_run, success, delete_concurrency
+):
     # No retries to speedup test
     mocker.patch.object(utils.delete_snapshot, "__defaults__", (0,))
     os_client = mocker.MagicMock()
@@ -163,13 +218,18 @@ def test_process_snapshots(mocker, faker, log, time_machine, dry_run, success):
     )
     snapshots_in_error = manual_errored_snapshots + errored_snapshots
 
-    os_client.block_storage.snapshots.side_effect = [
-        snapshots,
-        snapshots_in_error,
-    ]
+    def list_snapshots(status=None):
+        if status == "available":
+            return snapshots
+        if status == "error":
+            return snapshots_in_error
+        # Only the snapshots failing to be deleted are left
+        return nok_snapshot_is_deleted
+
+    os_client.block_storage.snapshots.side_effect = list_snapshots
 
     def delete_snapshot(isnapshot):
-        if isnapshot in nok_snapshot_delete:
+        if isnapshot in [s.id for s in nok_snapshot_delete]:
             raise Exception()
         return 1
 
@@ -183,7 +243,9 @@ def test_process_snapshots(mocker, faker, log, time_machine, dry_run, success):
     os_client.block_storage.get_snapshot.side_effect = get_snapshot
 
     assert (
-        cinder_snapshooter.snapshot_destroyer.process_snapshots(os_client, 0, dry_run)
+        cinder_snapshooter.snapshot_destroyer.process_snapshots(
+            os_client, 0, dry_run, delete_concurrency
+        )
         == success
         or dry_run
     )
@@ -192,7 +254,8 @@ def test_process_snapshots(mocker, faker, log, time_machine, dry_run, success):
         [
             mocker.call(status="available"),
             mocker.call(status="error"),
-        ]
+        ],
+        any_order=True,
     )
 
     if dry_run:
@@ -204,11 +267,195 @@ def test_process_snapshots(mocker, faker, log, time_machine, dry_run, success):
     ) + len(errored_snapshots) + len(nok_snapshot_delete) + len(nok_snapshot_is_deleted)
 
     for snapshot in expired_snapshot + nok_snapshot_delete + nok_snapshot_is_deleted:
-        os_client.block_storage.delete_snapshot.assert_any_call(snapshot)
+        os_client.block_storage.delete_snapshot.assert_any_call(snapshot.id)
 
     assert log.has(
         "Processed all snapshots in project",
         destroyed_snapshot=len(expired_snapshot) + len(errored_snapshots),
         errors=len(nok_snapshot_delete) + len(nok_snapshot_is_deleted),
+        still_present=[s.id for s in nok_snapshot_is_deleted],
         project=os_client.current_project_id,
     )
+
+
+def test_process_snapshots_prefetched(mocker, faker, log, time_machine):
+    time_machine.move_to(datetime.datetime(2021, 6, 15, tzinfo=datetime.timezone.utc))
+    mocker.patch("cinder_snapshooter.snapshot_destroyer.delete_snapshot")
+    os_client = mocker.MagicMock()
+
+    def fake_snapshot(status, expire_at):
+        return FakeSnapshot(
+            id=faker.uuid4(),
+            status=status,
+            created_at=faker.iso8601(),
+            volume_id=faker.uuid4(),
+            metadata={"expire_at": expire_at},
+        )
+
+    expired = fake_snapshot("available", "2021-06-01")
+    in_error = fake_snapshot("error", "2021-06-22")
+    snapshots = [
+        expired,
+        in_error,
+        fake_snapshot("available", "2021-06-22"),
+        fake_snapshot("creating", "2021-06-01"),
+    ]
+
+    assert cinder_snapshooter.snapshot_destroyer.process_snapshots(
+        os_client, 0, False, snapshots=snapshots
+    )
+
+    os_client.block_storage.snapshots.assert_not_called()
+    assert [
+        c.args[1]
+        for c in cinder_snapshooter.snapshot_destroyer.delete_snapshot.call_args_list
+    ] == [expired, in_error]
+
+
+def test_process_snapshots_cancelled(mocker, faker, log, time_machine):
+    time_machine.move_to(datetime.datetime(2021, 6, 15, tzinfo=datetime.timezone.utc))
+    os_client = mocker.MagicMock()
+    snapshots = [
+        FakeSnapshot(
+            id=faker.uuid4(),
+            status="available",
+            created_at=faker.iso8601(),
+            volume_id=faker.uuid4(),
+            metadata={"expire_at": "2021-06-01"},
+        )
+        for i in range(4)
+    ]
+    os_client.block_storage.snapshots.return_value = [
+        dataclasses.replace(snapshot, status="deleting") for snapshot in snapshots
+    ]
+
+    with pytest.raises(eventlet.Timeout):
+        with eventlet.Timeout(0.05):
+            cinder_snapshooter.snapshot_destroyer.process_snapshots(
+                os_client,
+                10,
+                False,
+                2,
+                snapshots=snapshots,
+                polling=utils.PollingPolicy(0.01, 0.01),
+            )
+    calls = len(os_client.method_calls)
+    eventlet.sleep(0.05)
+
+    # Nothing is left running once the project is cancelled
+    assert os_client.block_storage.delete_snapshot.call_count == 2
+    assert len(os_client.method_calls) == calls
+
+
+@pytest.mark.parametrize("listed", [True, False])
+def test_process_snapshots_backend_limits(mocker, faker, time_machine, listed):
+    time_machine.move_to(datetime.datetime(2021, 6, 15, tzinfo=datetime.timezone.utc))
+    mocker.patch("cinder_snapshooter.snapshot_destroyer.delete_snapshot")
+    os_client = mocker.MagicMock()
+    volumes = [
+        FakeVolume(id=faker.uuid4(), status="available", metadata={}, volume_type=t)
+        for t in ("nfs", "ceph")
+    ]
+    if not listed:
+        os_client.block_storage.volumes.return_value = volumes
+    backends = {volume.id: volume.volume_type for volume in volumes}
+    snapshots = [
+        FakeSnapshot(
+            id=faker.uuid4(),
+            status="available",
+            created_at=faker.iso8601(),
+            # The volume of the last snapshot is gone
+            volume_id=volume_id,
+            metadata={"expire_at": "2021-06-01"},
+        )
+        for volume_id in [volumes[0].id] * 4 + [volumes[1].id] * 4 + [faker.uuid4()]
+    ]
+    in_flight = {"nfs": [], "ceph": [], "unknown": []}
+    max_in_flight = {"nfs": [], "ceph": [], "unknown": []}
+
+    def delete_snapshot(_client, snapshot, *_args, **_kwargs):
+        backend = backends.get(snapshot.volume_id, "unknown")
+        in_flight[backend].append(snapshot)
+        max_in_flight[backend].append(len(in_flight[backend]))
+        eventlet.sleep(0.01)
+        in_flight[backend].remove(snapshot)
+        return True
+
+    cinder_snapshooter.snapshot_destroyer.delete_snapshot.side_effect = delete_snapshot
+
+    assert cinder_snapshooter.snapshot_destroyer.process_snapshots(
+        os_client,
+        0,
+        False,
+        10,
+        snapshots=snapshots,
+        page_size=50,
+        volumes=list(map(VolumeRecord.from_resource, volumes)) if listed else None,
+        backend_limits=BackendLimits(limits={"nfs": 1}, default_limit=2),
+    )
+
+    assert max(max_in_flight["nfs"]) == 1
+    assert max(max_in_flight["ceph"]) == 2
+    assert max(max_in_flight["unknown"]) == 1
+    if listed:
+        os_client.block_storage.volumes.assert_not_called()
+    else:
+        os_client.block_storage.volumes.assert_called_once_with(limit=50)
+
+
+@pytest.mark.parametrize("listed", [True, False])
+def test_process_snapshots_groups(mocker, faker, log, time_machine, listed):
+    time_machine.move_to(datetime.datetime(2021, 6, 15, tzinfo=datetime.timezone.utc))
+    mocker.patch("cinder_snapshooter.snapshot_destroyer.delete_group_snapshot")
+    mocker.patch("cinder_snapshooter.snapshot_destroyer.list_group_snapshots")
+    os_client = mocker.MagicMock()
+
+    def fake_group_snapshot(status, expire_at):
+        return GroupSnapshotRecord.from_resource(
+            FakeGroupSnapshot(
+                id=faker.uuid4(),
+                status=status,
+                group_id=faker.uuid4(),
+                created_at=faker.iso8601(),
+                description=f'{{"expire_at": "{expire_at}"}}',
+            )
+        )
+
+    expired = fake_group_snapshot("available", "2021-06-01")
+    in_error = fake_group_snapshot("error", "2021-06-22")
+    group_snapshots = [
+        expired,
+        in_error,
+        fake_group_snapshot("available", "2021-06-22"),
+        fake_group_snapshot("creating", "2021-06-01"),
+    ]
+    if not listed:
+        cinder_snapshooter.snapshot_destroyer.list_group_snapshots.return_value = (
+            group_snapshots
+        )
+
+    assert cinder_snapshooter.snapshot_destroyer.process_snapshots(
+        os_client,
+        0,
+        False,
+        snapshots=[],
+        use_groups=True,
+        group_snapshots=group_snapshots if listed else None,
+    )
+
+    list_group_snapshots = cinder_snapshooter.snapshot_destroyer.list_group_snapshots
+    if listed:
+        list_group_snapshots.assert_not_called()
+    else:
+        list_group_snapshots.assert_called_once_with(os_client.block_storage)
+    delete_group_snapshot = cinder_snapshooter.snapshot_destroyer.delete_group_snapshot
+    assert [c.args[1] for c in delete_group_snapshot.call_args_list] == [
+        expired,
+        in_error,
+    ]
+    assert log.has(
+        "Processed all snapshots in project",
+        destroyed_snapshot=0,
+        destroyed_group_snapshot=2,
+        errors=0,
+    )
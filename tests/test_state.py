@@ -0,0 +1,108 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+
+import pytest
+
+from cinder_snapshooter.state import SnapshotHistory, StateStore
+
+
+NOW = datetime.datetime(2021, 6, 15, 12, 0, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def state(tmp_path, time_machine):
+    time_machine.move_to(NOW, tick=False)
+    state = StateStore(str(tmp_path / "state.sqlite"), 3600)
+    yield state
+    state.close()
+
+
+def test_index_unknown_project(state, faker):
+    assert state.index(faker.uuid4()) is None
+
+
+def test_record(state, faker, log):
+    project_id, volume_id = faker.uuid4(), faker.uuid4()
+    state.reconcile(project_id, {})
+    assert state.index(project_id) == {}
+
+    # Cinder timestamps are naive UTC ones
+    state.record(project_id, volume_id, datetime.datetime(2021, 5, 31, 23, 0))
+    assert state.index(project_id) == {
+        volume_id: SnapshotHistory(
+            datetime.datetime(2021, 5, 31, 23, 0, tzinfo=datetime.timezone.utc), False
+        )
+    }
+    state.record(project_id, volume_id, NOW - datetime.timedelta(days=1))
+    state.record(project_id, volume_id, NOW - datetime.timedelta(days=2))
+    assert state.index(project_id) == {
+        volume_id: SnapshotHistory(NOW - datetime.timedelta(days=1), True)
+    }
+    assert not log.has("Local state disagreed with the API")
+
+
+def test_stale(state, faker, time_machine):
+    project_id = faker.uuid4()
+    state.reconcile(project_id, {})
+    time_machine.move_to(NOW + datetime.timedelta(seconds=3601), tick=False)
+    assert state.index(project_id) is None
+
+
+def test_persisted(tmp_path, faker):
+    project_id, volume_id = faker.uuid4(), faker.uuid4()
+    path = str(tmp_path / "state.sqlite")
+    state = StateStore(path, 3600)
+    state.reconcile(project_id, {volume_id: SnapshotHistory(NOW, True)})
+    state.close()
+
+    state = StateStore(path, 3600)
+    assert volume_id in state.index(project_id)
+    state.close()
+
+
+def test_reconcile(state, faker, log):
+    project_id, other_project_id = faker.uuid4(), faker.uuid4()
+    agreeing, disagreeing, missing, unknown = [faker.uuid4() for i in range(4)]
+    state.reconcile(
+        project_id,
+        {
+            agreeing: SnapshotHistory(NOW, True),
+            disagreeing: SnapshotHistory(NOW - datetime.timedelta(days=1), True),
+            missing: SnapshotHistory(NOW - datetime.timedelta(days=40), False),
+        },
+    )
+    state.reconcile(other_project_id, {unknown: SnapshotHistory(NOW, True)})
+    assert not log.has("Local state disagreed with the API")
+
+    listed = {
+        agreeing: SnapshotHistory(NOW.replace(tzinfo=None), True),
+        disagreeing: SnapshotHistory(NOW, True),
+        unknown: SnapshotHistory(NOW, True),
+    }
+    state.reconcile(project_id, listed)
+
+    assert log.has(
+        "Local state disagreed with the API",
+        project=project_id,
+        volumes=sorted([disagreeing, missing, unknown]),
+    )
+    assert state.index(project_id) == {
+        volume_id: SnapshotHistory(NOW, True) for volume_id in listed
+    }
+    assert state.index(other_project_id) == {unknown: SnapshotHistory(NOW, True)}
@@ -0,0 +1,85 @@
+"""
+Copyright 2023 Gandi SAS
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import json
+import os
+import stat
+
+import pytest
+
+import cinder_snapshooter.token_cache
+
+
+def fake_auth(mocker, faker, expires_in):
+    auth = mocker.MagicMock()
+    auth.auth_ref.expires = datetime.datetime.now(
+        datetime.timezone.utc
+    ) + datetime.timedelta(seconds=expires_in)
+    auth.get_auth_state.return_value = json.dumps({"auth_token": faker.sha256()})
+    return auth
+
+
+@pytest.mark.parametrize(
+    "expires_in, reused",
+    [(7200, True), (1800, False)],
+    ids=["valid", "expiring"],
+)
+def test_token_cache(mocker, faker, tmp_path, log, expires_in, reused):
+    path = tmp_path / "tokens.json"
+    cache = cinder_snapshooter.token_cache.TokenCache(str(path), 3600)
+    key = faker.uuid4()
+    auth = fake_auth(mocker, faker, expires_in)
+    expired_auth = fake_auth(mocker, faker, -10)
+
+    assert not cache.restore(key, auth)
+    cache.store(key, auth)
+    cache.store(faker.uuid4(), expired_auth)
+    cache.save()
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert list(json.loads(path.read_text())) == [key]
+    assert os.listdir(tmp_path) == ["tokens.json"]
+
+    new_auth = mocker.MagicMock()
+    cache = cinder_snapshooter.token_cache.TokenCache(str(path), 3600)
+    assert cache.restore(key, new_auth) == reused
+    if reused:
+        new_auth.set_auth_state.assert_called_once_with(
+            auth.get_auth_state.return_value
+        )
+    else:
+        new_auth.set_auth_state.assert_not_called()
+
+
+def test_token_cache_unreadable(tmp_path, log):
+    path = tmp_path / "tokens.json"
+    path.write_text("not json")
+    cache = cinder_snapshooter.token_cache.TokenCache(str(path), 3600)
+    assert log.has("Unable to read token cache, ignoring it", path=str(path))
+    cache.save()
+    assert json.loads(path.read_text()) == {}
+
+
+def test_key(mocker, faker):
+    os_client = mocker.MagicMock()
+    project_id = faker.uuid4()
+    trust_id = faker.uuid4()
+    key = cinder_snapshooter.token_cache.TokenCache.key
+    assert key(os_client, None, project_id) != key(os_client, trust_id, project_id)
+    assert key(os_client, None, project_id).endswith(f"project:{project_id}")
+    assert key(os_client, trust_id, project_id).endswith(f"trust:{trust_id}")
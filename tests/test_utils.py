@@ -16,15 +16,25 @@ limitations under the License.
 SPDX-License-Identifier: Apache-2.0
 """
 import argparse
+import dataclasses
+import datetime
+import json
 import logging
 
+import eventlet
 import keystoneauth1.exceptions
 import pytest
 import structlog.stdlib
 
+from openstack.exceptions import ResourceNotFound
+
+import cinder_snapshooter.exceptions
 import cinder_snapshooter.utils
 import fixtures
 
+from cinder_snapshooter.journal import Journal
+from cinder_snapshooter.project_stats import ProjectStats
+
 
 @pytest.mark.parametrize(
     "value, result",
@@ -89,7 +99,7 @@ def test_setup_logging(mocker, faker, devel, verbose):
         assert loggers[logger].setLevel.call_args == mocker.call(logging.DEBUG)
 
 
-def test_available_projects(mocker, faker):
+def test_available_projects(mocker, faker, log):
     os_client = mocker.MagicMock()
     trusts = [fixtures.FakeTrust(id=faker.uuid4(), project_id=faker.uuid4())]
     projects = [fixtures.FakeProject(id=faker.uuid4(), name=faker.domain_name())]
@@ -100,6 +110,86 @@ def test_available_projects(mocker, faker):
     ] + [(None, project.id) for project in projects]
 
 
+@pytest.mark.parametrize("preference", ["membership", "trust"])
+def test_available_projects_duplicates(mocker, faker, log, preference):
+    os_client = mocker.MagicMock()
+    shared_project_id = faker.uuid4()
+    trusts = [
+        fixtures.FakeTrust(id=faker.uuid4(), project_id=faker.uuid4()),
+        fixtures.FakeTrust(id=faker.uuid4(), project_id=shared_project_id),
+        fixtures.FakeTrust(id=faker.uuid4(), project_id=shared_project_id),
+    ]
+    projects = [
+        fixtures.FakeProject(id=shared_project_id, name=faker.domain_name()),
+        fixtures.FakeProject(id=faker.uuid4(), name=faker.domain_name()),
+    ]
+    os_client.identity.trusts.return_value = trusts
+    os_client.identity.user_projects.return_value = projects
+
+    assert list(cinder_snapshooter.utils.available_projects(os_client, preference)) == [
+        (trusts[0].id, trusts[0].project_id),
+        (trusts[1].id if preference == "trust" else None, shared_project_id),
+        (None, projects[1].id),
+    ]
+    assert log.has("Listed available projects", projects=3, duplicates_collapsed=2)
+
+
+def test_in_shard(faker):
+    project_ids = [faker.uuid4() for _ in range(4000)]
+    shards = [
+        {
+            project_id
+            for project_id in project_ids
+            if cinder_snapshooter.utils.in_shard(project_id, index, 4)
+        }
+        for index in range(4)
+    ]
+
+    # Every project is in exactly one shard, the shards being about even
+    assert sum(len(shard) for shard in shards) == len(project_ids)
+    assert set().union(*shards) == set(project_ids)
+    assert all(900 < len(shard) < 1100 for shard in shards)
+    assert all(
+        cinder_snapshooter.utils.in_shard(project_id) for project_id in project_ids
+    )
+    # Shards do not depend on the run
+    assert cinder_snapshooter.utils.in_shard("9b1bb2ee22a04b4ba8b4b5b2a5b35d3c", 1, 4)
+
+
+def test_available_projects_shard(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    trusts = [fixtures.FakeTrust(id=faker.uuid4(), project_id=faker.uuid4())]
+    projects = [
+        fixtures.FakeProject(id=faker.uuid4(), name=faker.domain_name())
+        for _ in range(20)
+    ]
+    os_client.identity.trusts.return_value = trusts
+    os_client.identity.user_projects.return_value = projects
+    available = list(cinder_snapshooter.utils.available_projects(os_client))
+
+    shards = [
+        list(
+            cinder_snapshooter.utils.available_projects(
+                os_client, shard_index=index, shard_count=3
+            )
+        )
+        for index in range(3)
+    ]
+
+    assert sorted(sum(shards, []), key=str) == sorted(available, key=str)
+    for index, shard in enumerate(shards):
+        assert all(
+            cinder_snapshooter.utils.in_shard(project_id, index, 3)
+            for _, project_id in shard
+        )
+        assert log.has(
+            "Listed available projects",
+            projects=21,
+            in_shard=len(shard),
+            shard=f"{index}/3",
+        )
+
+
 def test_run_on_all_projects(mocker, faker, log):
     mocker.patch("cinder_snapshooter.utils.available_projects")
     projects = [
@@ -108,13 +198,15 @@ def test_run_on_all_projects(mocker, faker, log):
     ]
     cinder_snapshooter.utils.available_projects.return_value = projects
 
+    clients = {}
+
     def connect_as(**kwargs):
-        return kwargs
+        return clients.setdefault(tuple(kwargs.items()), mocker.MagicMock())
 
     os_client = mocker.MagicMock()
     os_client.connect_as.side_effect = connect_as
 
-    process_function = mocker.MagicMock()
+    process_function = mocker.MagicMock(__name__="process_things")
     process_function_args = (("yet another argument",), {"some_kwargs": True})
     process_function_rv = [faker.boolean() for _ in projects]
     process_function.side_effect = process_function_rv
@@ -127,23 +219,33 @@ def test_run_on_all_projects(mocker, faker, log):
         **process_function_args[1],
     )
 
+    cinder_snapshooter.utils.available_projects.assert_called_once_with(
+        os_client, "membership", shard_index=0, shard_count=1
+    )
     assert rv == process_function_rv
     assert os_client.connect_as.call_args_list == [
         mocker.call(project_id=projects[0][1]),
         mocker.call(trust_id=projects[1][0]),
     ]
+    for client in clients.values():
+        client.session.get_token.assert_called_once_with()
     assert process_function.call_args_list == [
         mocker.call(
-            {"project_id": projects[0][1]},
+            clients[(("project_id", projects[0][1]),)],
             *process_function_args[0],
             **process_function_args[1],
         ),
         mocker.call(
-            {"trust_id": projects[1][0]},
+            clients[(("trust_id", projects[1][0]),)],
             *process_function_args[0],
             **process_function_args[1],
         ),
     ]
+    metrics = cinder_snapshooter.utils.metrics
+    assert metrics.POOL_SIZE.value(task="process_things") == 10
+    assert metrics.PROJECTS_IN_PROGRESS.value(task="process_things") == 0
+    for _, project_id in projects:
+        assert metrics.PROJECT_DURATION.value(task="process_things", project=project_id)
 
 
 @pytest.mark.parametrize("return_code", [401, 403])
@@ -156,8 +258,10 @@ def test_run_on_all_project_raising(mocker, faker, log, return_code):
     ]
     cinder_snapshooter.utils.available_projects.return_value = projects
 
+    clients = {}
+
     def connect_as(**kwargs):
-        return kwargs
+        return clients.setdefault(tuple(kwargs.items()), mocker.MagicMock())
 
     os_client = mocker.MagicMock()
     os_client.connect_as.side_effect = connect_as
@@ -180,10 +284,10 @@ def test_run_on_all_project_raising(mocker, faker, log, return_code):
         ]
         assert process_function.call_args_list == [
             mocker.call(
-                {"project_id": projects[0][1]},
+                clients[(("project_id", projects[0][1]),)],
             ),
             mocker.call(
-                {"trust_id": projects[1][0]},
+                clients[(("trust_id", projects[1][0]),)],
             ),
         ]
     else:
@@ -193,3 +297,759 @@ def test_run_on_all_project_raising(mocker, faker, log, return_code):
                 process_function,
                 10,
             )
+
+
+@pytest.mark.parametrize("adaptive", [True, False])
+def test_polling_policy(mocker, adaptive):
+    mocker.patch("random.uniform", side_effect=lambda low, high: high)
+    policy = cinder_snapshooter.utils.PollingPolicy(1, 10, 2, adaptive)
+    delays = policy.delays("ssd")
+    assert [next(delays) for i in range(6)] == [1, 2, 4, 8, 10, 10]
+
+    for duration in (3, 5, 40):
+        policy.record("ssd", duration)
+    delays = policy.delays("ssd")
+    if adaptive:
+        assert [next(delays) for i in range(3)] == [5, 10, 10]
+    else:
+        assert [next(delays) for i in range(3)] == [1, 2, 4]
+    # Other kinds of operation are not seeded
+    assert next(policy.delays("hdd")) == 1
+
+
+def test_creation_tracker(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    snapshots = {
+        status: fixtures.FakeSnapshot(
+            id=faker.uuid4(),
+            status="creating",
+            metadata={},
+            volume_id=faker.uuid4(),
+            created_at=f"2023-05-02T10:00:0{i}.000000",
+        )
+        for i, status in enumerate(["available", "error", "creating"])
+    }
+    current = {
+        snapshot.id: dataclasses.replace(snapshot, status=status)
+        for status, snapshot in snapshots.items()
+    }
+    # Snapshots of the project older than the ones pending
+    for day in (1, 2):
+        snapshot = fixtures.FakeSnapshot(
+            id=faker.uuid4(),
+            status="available",
+            metadata={},
+            volume_id=faker.uuid4(),
+            created_at=f"2023-05-0{day}T09:00:00.000000",
+        )
+        current[snapshot.id] = snapshot
+    listed = []
+
+    def list_snapshots(status):
+        # Newest first, as the API sorts them by default
+        for snapshot in sorted(
+            current.values(), key=lambda snapshot: snapshot.created_at, reverse=True
+        ):
+            if snapshot.status == status:
+                listed.append(snapshot.created_at)
+                yield snapshot
+
+    os_client.block_storage.snapshots.side_effect = list_snapshots
+    os_client.block_storage.get_snapshot.side_effect = current.get
+    tracker = cinder_snapshooter.utils.CreationTracker(
+        os_client, 0.05, cinder_snapshooter.utils.PollingPolicy(0, 0)
+    )
+
+    greenlets = {
+        status: eventlet.spawn(tracker.wait, snapshot)
+        for status, snapshot in snapshots.items()
+    }
+
+    assert greenlets["available"].wait() == current[snapshots["available"].id]
+    with pytest.raises(cinder_snapshooter.exceptions.SnapshotInError):
+        greenlets["error"].wait()
+    with pytest.raises(cinder_snapshooter.exceptions.SnapshotCreationTimeout):
+        greenlets["creating"].wait()
+    # The snapshots are resolved by one round of listings, the available ones
+    # listed back to the oldest pending, and the last one pending on its own
+    assert [call[1] for call in os_client.block_storage.snapshots.call_args_list] == [
+        {"status": "creating"},
+        {"status": "error"},
+        {"status": "available"},
+    ]
+    assert "2023-05-01T09:00:00.000000" not in listed
+    get_snapshot = os_client.block_storage.get_snapshot
+    assert {call[0][0] for call in get_snapshot.call_args_list} == {
+        snapshots["creating"].id
+    }
+
+
+def test_deletion_tracker(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    snapshots = {
+        status: fixtures.FakeSnapshot(
+            id=faker.uuid4(),
+            status="deleting",
+            metadata={},
+            volume_id=faker.uuid4(),
+            created_at=faker.iso8601(),
+        )
+        for status in ["deleted", "error_deleting", "deleting"]
+    }
+    current = {
+        snapshot.id: dataclasses.replace(snapshot, status=status)
+        for status, snapshot in snapshots.items()
+        if status != "deleted"
+    }
+    os_client.block_storage.snapshots.side_effect = lambda status: [
+        snapshot for snapshot in current.values() if snapshot.status == status
+    ]
+
+    def get_snapshot(snapshot_id):
+        if snapshot_id not in current:
+            raise ResourceNotFound
+        return current[snapshot_id]
+
+    os_client.block_storage.get_snapshot.side_effect = get_snapshot
+    tracker = cinder_snapshooter.utils.DeletionTracker(
+        os_client, 0.05, cinder_snapshooter.utils.PollingPolicy(0, 0)
+    )
+
+    greenlets = {
+        status: eventlet.spawn(tracker.wait, snapshot)
+        for status, snapshot in snapshots.items()
+    }
+
+    assert greenlets["deleted"].wait() == snapshots["deleted"]
+    with pytest.raises(cinder_snapshooter.exceptions.SnapshotStillPresent) as err:
+        greenlets["error_deleting"].wait()
+    assert err.value.snapshot.status == "error_deleting"
+    with pytest.raises(cinder_snapshooter.exceptions.SnapshotStillPresent) as err:
+        greenlets["deleting"].wait()
+    assert err.value.snapshot.status == "deleting"
+    # The snapshots missing from the listings are gone, none is fetched but the
+    # last one pending on its own
+    assert [call[1] for call in os_client.block_storage.snapshots.call_args_list] == [
+        {"status": "deleting"},
+        {"status": "error_deleting"},
+    ]
+    get_snapshot = os_client.block_storage.get_snapshot
+    assert {call[0][0] for call in get_snapshot.call_args_list} == {
+        snapshots["deleting"].id
+    }
+
+
+def test_tracker_waiter_killed(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    snapshots = [
+        fixtures.FakeSnapshot(
+            id=faker.uuid4(),
+            status="creating",
+            metadata={},
+            volume_id=faker.uuid4(),
+            created_at=faker.iso8601(),
+        )
+        for i in range(2)
+    ]
+    os_client.block_storage.snapshots.return_value = snapshots
+    tracker = cinder_snapshooter.utils.CreationTracker(
+        os_client, 10, cinder_snapshooter.utils.PollingPolicy(0.01, 0.01)
+    )
+    greenlets = [eventlet.spawn(tracker.wait, snapshot) for snapshot in snapshots]
+    eventlet.sleep(0.05)
+
+    for greenlet in greenlets:
+        greenlet.kill()
+    polls = os_client.block_storage.snapshots.call_count
+    eventlet.sleep(0.05)
+
+    # The poller is gone with the last waiter
+    assert polls > 0
+    assert os_client.block_storage.snapshots.call_count == polls
+    assert tracker._poller is None
+
+
+@pytest.mark.parametrize("auth_concurrency", [None, 1, 2])
+def test_run_on_all_projects_auth_concurrency(mocker, faker, log, auth_concurrency):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    cinder_snapshooter.utils.available_projects.return_value = [
+        (None, faker.uuid4()) for i in range(6)
+    ]
+    authenticating = []
+    max_authenticating = []
+
+    def get_token():
+        authenticating.append(True)
+        max_authenticating.append(len(authenticating))
+        eventlet.sleep(0.01)
+        authenticating.pop()
+
+    os_client = mocker.MagicMock()
+    os_client.connect_as.return_value.session.get_token.side_effect = get_token
+    process_function = mocker.MagicMock(return_value=True)
+
+    rv = cinder_snapshooter.utils.run_on_all_projects(
+        os_client,
+        process_function,
+        4,
+        auth_concurrency=auth_concurrency,
+    )
+
+    assert rv == [True] * 6
+    assert max(max_authenticating) == (auth_concurrency or 4)
+
+
+@pytest.mark.parametrize("schedule", ["listing", "largest-first"])
+def test_run_on_all_projects_schedule(tmp_path, mocker, faker, log, schedule):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    project_ids = [faker.uuid4() for i in range(5)]
+    cinder_snapshooter.utils.available_projects.return_value = [
+        (None, project_id) for project_id in project_ids
+    ]
+    project_stats = ProjectStats(str(tmp_path / "stats.json"))
+    for project_id, duration in zip(project_ids, [10, None, 30, 20, None]):
+        if duration is not None:
+            project_stats.record("process_things", project_id, duration)
+    processed = []
+
+    def process_things(client, fail_on):
+        processed.append(client.project_id)
+        if client.project_id == fail_on:
+            raise ValueError(client.project_id)
+        return True
+
+    os_client = mocker.MagicMock()
+    os_client.connect_as.side_effect = lambda project_id: mocker.MagicMock(
+        project_id=project_id
+    )
+
+    # A single project at a time makes the dispatch order observable
+    cinder_snapshooter.utils.run_on_all_projects(
+        os_client,
+        process_things,
+        1,
+        None,
+        schedule=schedule,
+        project_stats=project_stats,
+    )
+
+    if schedule == "listing":
+        assert processed == project_ids
+        assert not log.has("Scheduled projects largest first")
+    else:
+        order = [project_ids[i] for i in (1, 4, 2, 3, 0)]
+        assert processed == order
+        assert log.has(
+            "Scheduled projects largest first", task="process_things", order=order
+        )
+    for project_id in project_ids:
+        assert log.has("Processed project", task="process_things", project=project_id)
+    assert project_stats.estimate("process_things", project_ids[1]) < 1
+    assert project_stats.estimate("process_things", project_ids[2]) < 30
+    assert json.loads((tmp_path / "stats.json").read_text()).keys() == {
+        "process_things"
+    }
+
+    # Failures do not count
+    estimate = project_stats.estimate("process_things", project_ids[0])
+    cinder_snapshooter.utils.available_projects.return_value = [(None, project_ids[0])]
+    with pytest.raises(ValueError):
+        cinder_snapshooter.utils.run_on_all_projects(
+            os_client,
+            process_things,
+            1,
+            project_ids[0],
+            project_stats=project_stats,
+        )
+    assert project_stats.estimate("process_things", project_ids[0]) == estimate
+
+
+def test_run_on_all_tenants_schedule(mocker, faker, log):
+    project_ids = [faker.uuid4() for i in range(3)]
+    volumes = [mocker.MagicMock(project_id=project_ids[i]) for i in (0, 1, 1, 1, 2, 2)]
+    process_function = mocker.MagicMock(__name__="process_things", return_value=True)
+    project_stats = mocker.MagicMock()
+    project_stats.estimate.side_effect = lambda task, project_id: {
+        project_ids[0]: 10
+    }.get(project_id)
+    project_stats.skipped.return_value = False
+
+    cinder_snapshooter.utils.run_on_all_tenants(
+        mocker.MagicMock(),
+        process_function,
+        1,
+        listings={"volumes": mocker.MagicMock(return_value=volumes)},
+        schedule="largest-first",
+        project_stats=project_stats,
+    )
+
+    # Without an estimate, the projects having the most resources go first
+    assert [
+        call[0][0].current_project_id for call in process_function.call_args_list
+    ] == [project_ids[1], project_ids[2], project_ids[0]]
+    assert {call[0][1] for call in project_stats.record.call_args_list} == set(
+        project_ids
+    )
+    project_stats.save.assert_called_once_with()
+
+
+def test_run_on_all_projects_deadline(tmp_path, mocker, faker, log):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    # Quick, never processed and too long for the deadline
+    project_ids = [faker.uuid4() for i in range(3)]
+    cinder_snapshooter.utils.available_projects.return_value = [
+        (None, project_id) for project_id in project_ids
+    ]
+    project_stats = ProjectStats(str(tmp_path / "stats.json"))
+    project_stats.record("process_things", project_ids[0], 0.001)
+    project_stats.record("process_things", project_ids[2], 1000)
+    processed = []
+
+    def process_things(client, duration):
+        processed.append(client.project_id)
+        eventlet.sleep(duration if client.project_id == project_ids[1] else 0)
+        return True
+
+    os_client = mocker.MagicMock()
+    os_client.connect_as.side_effect = lambda project_id: mocker.MagicMock(
+        project_id=project_id
+    )
+
+    rv = cinder_snapshooter.utils.run_on_all_projects(
+        os_client,
+        process_things,
+        3,
+        10,
+        project_stats=project_stats,
+        deadline=0.1,
+    )
+
+    assert rv == [True, False, False]
+    assert processed == project_ids[:2]
+    assert log.has(
+        "Deadline reached, projects left out",
+        task="process_things",
+        processed=1,
+        skipped=[project_ids[2]],
+        cancelled=[project_ids[1]],
+    )
+    assert [
+        project_stats.skipped("process_things", project_id)
+        for project_id in project_ids
+    ] == [False, True, True]
+    # The cancelled project says nothing of its duration
+    assert project_stats.estimate("process_things", project_ids[1]) is None
+
+    # The next run starts with the projects left out
+    processed.clear()
+    rv = cinder_snapshooter.utils.run_on_all_projects(
+        os_client, process_things, 1, 0, project_stats=project_stats
+    )
+
+    assert rv == [True] * 3
+    assert processed == [project_ids[1], project_ids[2], project_ids[0]]
+    assert log.has(
+        "Resuming projects left out by the previous run",
+        task="process_things",
+        projects=project_ids[1:],
+    )
+    assert not any(
+        project_stats.skipped("process_things", project_id)
+        for project_id in project_ids
+    )
+
+
+def test_run_on_all_tenants_deadline(mocker, faker, log):
+    project_ids = [faker.uuid4() for i in range(2)]
+    volumes = [mocker.MagicMock(project_id=project_id) for project_id in project_ids]
+    process_function = mocker.MagicMock(__name__="process_things", return_value=True)
+    project_stats = mocker.MagicMock()
+    project_stats.estimate.side_effect = lambda task, project_id: {
+        project_ids[1]: 1000
+    }.get(project_id)
+    project_stats.skipped.return_value = False
+
+    rv = cinder_snapshooter.utils.run_on_all_tenants(
+        mocker.MagicMock(),
+        process_function,
+        2,
+        listings={"volumes": mocker.MagicMock(return_value=volumes)},
+        project_stats=project_stats,
+        deadline=60,
+    )
+
+    assert rv == [True, False]
+    process_function.assert_called_once()
+    project_stats.skip.assert_called_once_with("process_things", project_ids[1])
+    assert log.has(
+        "Deadline reached, projects left out",
+        task="process_things",
+        skipped=[project_ids[1]],
+        cancelled=[],
+    )
+
+
+def test_run_on_all_projects_journal(tmp_path, mocker, faker, log):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    project_ids = [faker.uuid4() for i in range(3)]
+    cinder_snapshooter.utils.available_projects.return_value = [
+        (None, project_id) for project_id in project_ids
+    ]
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.begin("process_things")
+    journal.project_done("process_things", project_ids[0])
+    journal.close()
+    processed = []
+
+    def process_things(client, journal=None):
+        processed.append((client.project_id, journal.task))
+        return client.project_id != project_ids[2]
+
+    os_client = mocker.MagicMock()
+    os_client.connect_as.side_effect = lambda project_id: mocker.MagicMock(
+        project_id=project_id
+    )
+    journal = Journal(path, resume=True)
+    mocker.spy(journal, "project_done")
+    mocker.spy(journal, "end")
+
+    rv = cinder_snapshooter.utils.run_on_all_projects(
+        os_client, process_things, 2, journal=journal
+    )
+
+    assert rv == [True, False]
+    # The finished project is neither authenticated to nor processed again
+    assert processed == [
+        (project_ids[1], "process_things"),
+        (project_ids[2], "process_things"),
+    ]
+    assert os_client.connect_as.call_count == 2
+    assert log.has(
+        "Skipping projects processed before the crash",
+        task="process_things",
+        projects=[project_ids[0]],
+    )
+    journal.project_done.assert_called_once_with("process_things", project_ids[1])
+    journal.end.assert_called_once_with("process_things")
+    # The next run starts afresh
+    assert not journal.finished("process_things", project_ids[0])
+
+
+def test_run_on_all_tenants_journal(mocker, faker, log):
+    project_ids = [faker.uuid4() for i in range(2)]
+    volumes = [mocker.MagicMock(project_id=project_id) for project_id in project_ids]
+    process_function = mocker.MagicMock(__name__="process_things", return_value=True)
+    journal = mocker.MagicMock()
+    journal.finished.side_effect = lambda task, project_id: project_id == project_ids[0]
+
+    rv = cinder_snapshooter.utils.run_on_all_tenants(
+        mocker.MagicMock(),
+        process_function,
+        2,
+        listings={"volumes": mocker.MagicMock(return_value=volumes)},
+        journal=journal,
+    )
+
+    assert rv == [True]
+    journal.begin.assert_called_once_with("process_things")
+    process_function.assert_called_once()
+    # The process function takes no journal
+    assert "journal" not in process_function.call_args.kwargs
+    journal.project_done.assert_called_once_with("process_things", project_ids[1])
+    journal.end.assert_called_once_with("process_things")
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_run_on_all_projects_token_cache(mocker, faker, log, cached):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    project_id = faker.uuid4()
+    cinder_snapshooter.utils.available_projects.return_value = [(None, project_id)]
+    os_client = mocker.MagicMock()
+    project_client = os_client.connect_as.return_value
+    token_cache = mocker.MagicMock()
+    token_cache.restore.return_value = cached
+    process_function = mocker.MagicMock(return_value=True)
+
+    assert cinder_snapshooter.utils.run_on_all_projects(
+        os_client, process_function, 4, token_cache=token_cache
+    ) == [True]
+
+    token_cache.key.assert_called_with(os_client, None, project_id)
+    token_cache.restore.assert_called_once_with(
+        token_cache.key.return_value, project_client.session.auth
+    )
+    if cached:
+        project_client.session.get_token.assert_not_called()
+    else:
+        project_client.session.get_token.assert_called_once_with()
+    token_cache.store.assert_called_once_with(
+        token_cache.key.return_value, project_client.session.auth
+    )
+    token_cache.save.assert_called_once_with()
+
+
+def test_run_on_all_projects_connections(mocker, faker, log):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    project_id, trust_id = faker.uuid4(), faker.uuid4()
+    cinder_snapshooter.utils.available_projects.return_value = [
+        (None, project_id),
+        (trust_id, faker.uuid4()),
+    ]
+    os_client = mocker.MagicMock()
+    os_client.connect_as.side_effect = lambda **kwargs: mocker.MagicMock(
+        through_trust="trust_id" in kwargs
+    )
+
+    def process_function(os_project_client):
+        if os_project_client.through_trust:
+            raise Exception()
+        return True
+
+    connections = {}
+    for i in range(2):
+        with pytest.raises(Exception):
+            cinder_snapshooter.utils.run_on_all_projects(
+                os_client, process_function, 4, connections=connections
+            )
+        # The connection of the failing project is dropped
+        assert list(connections) == [(None, project_id)]
+
+    # The working project authenticated once, the failing one on each run
+    assert os_client.connect_as.call_count == 3
+    connections[None, project_id].session.get_token.assert_called_once_with()
+
+
+@pytest.mark.parametrize("scoped", [True, False])
+def test_run_on_all_tenants(mocker, faker, log, scoped):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    project_ids = [faker.uuid4() for i in range(3)]
+    trust_id = faker.uuid4()
+    # The last project is not reachable
+    cinder_snapshooter.utils.available_projects.return_value = [
+        (None, project_ids[0]),
+        (trust_id, project_ids[1]),
+    ]
+    volumes = [mocker.MagicMock(project_id=project_ids[i % 3]) for i in range(6)]
+    snapshots = [mocker.MagicMock(project_id=project_ids[0])]
+    os_client = mocker.MagicMock()
+    listings = {
+        "volumes": mocker.MagicMock(return_value=volumes),
+        "snapshots": mocker.MagicMock(return_value=snapshots),
+    }
+    calls = {}
+
+    def process_function(client, argument, volumes, snapshots):
+        calls[client.current_project_id] = (argument, volumes, snapshots)
+        client.block_storage.volumes(status="available")
+        return True
+
+    rv = cinder_snapshooter.utils.run_on_all_tenants(
+        os_client,
+        process_function,
+        4,
+        "argument",
+        listings=listings,
+        scoped=scoped,
+        project_preference="trust",
+    )
+
+    for listing in listings.values():
+        listing.assert_called_once_with(all_projects=True)
+    expected_calls = {
+        project_ids[0]: ("argument", volumes[0::3], snapshots),
+        project_ids[1]: ("argument", volumes[1::3], []),
+        project_ids[2]: ("argument", volumes[2::3], []),
+    }
+    if scoped:
+        del expected_calls[project_ids[2]]
+        cinder_snapshooter.utils.available_projects.assert_called_once_with(
+            os_client, "trust", shard_index=0, shard_count=1
+        )
+        assert log.has("No access to project, skipping it", project=project_ids[2])
+        assert os_client.connect_as.call_args_list == [
+            mocker.call(project_id=project_ids[0]),
+            mocker.call(trust_id=trust_id),
+        ]
+        os_client.block_storage.volumes.assert_not_called()
+    else:
+        cinder_snapshooter.utils.available_projects.assert_not_called()
+        os_client.connect_as.assert_not_called()
+        for project_id in project_ids:
+            os_client.block_storage.volumes.assert_any_call(
+                all_projects=True, project_id=project_id, status="available"
+            )
+    assert calls == expected_calls
+    assert rv == [True] * len(expected_calls)
+
+
+def test_run_on_all_tenants_shard(mocker, faker, log):
+    project_ids = [faker.uuid4() for i in range(10)]
+    volumes = [mocker.MagicMock(project_id=project_id) for project_id in project_ids]
+    process_function = mocker.MagicMock(return_value=True)
+
+    rv = cinder_snapshooter.utils.run_on_all_tenants(
+        mocker.MagicMock(),
+        process_function,
+        4,
+        listings={"volumes": mocker.MagicMock(return_value=volumes)},
+        shard_index=1,
+        shard_count=2,
+    )
+
+    processed = {
+        call[0][0].current_project_id for call in process_function.call_args_list
+    }
+    assert processed == {
+        project_id
+        for project_id in project_ids
+        if cinder_snapshooter.utils.in_shard(project_id, 1, 2)
+    }
+    assert rv == [True] * len(processed)
+
+
+def test_project_connection(mocker, faker):
+    project_id = faker.uuid4()
+    connect = mocker.MagicMock()
+    client = cinder_snapshooter.utils.ProjectConnection(project_id, connect)
+
+    assert client.current_project_id == project_id
+    connect.assert_not_called()
+    assert client.block_storage == connect.return_value.block_storage
+    assert client.identity == connect.return_value.identity
+    connect.assert_called_once_with()
+
+
+def test_project_connection_auth_error(mocker, faker):
+    connect = mocker.MagicMock(
+        side_effect=keystoneauth1.exceptions.HTTPClientError(http_status=403)
+    )
+    client = cinder_snapshooter.utils.ProjectConnection(faker.uuid4(), connect)
+
+    for i in range(2):
+        with pytest.raises(keystoneauth1.exceptions.HTTPClientError):
+            client.block_storage
+    # Not authenticated to again
+    connect.assert_called_once_with()
+    assert client.auth_error == connect.side_effect
+
+
+def test_run_on_all_tenants_auth_error(mocker, faker, log):
+    mocker.patch("cinder_snapshooter.utils.available_projects")
+    project_id = faker.uuid4()
+    trust_id = faker.uuid4()
+    cinder_snapshooter.utils.available_projects.return_value = [(trust_id, project_id)]
+    os_client = mocker.MagicMock()
+    os_client.connect_as.return_value.session.get_token.side_effect = (
+        keystoneauth1.exceptions.HTTPClientError(http_status=403)
+    )
+    volumes = [mocker.MagicMock(project_id=project_id) for i in range(3)]
+
+    def process_function(client, volumes):
+        def create(volume):
+            try:
+                client.block_storage.create_snapshot(volume_id=volume.id)
+            except Exception:
+                pass
+
+        pool = eventlet.GreenPool()
+        for volume in volumes:
+            pool.spawn(create, volume)
+        pool.waitall()
+        return True
+
+    rv = cinder_snapshooter.utils.run_on_all_tenants(
+        os_client,
+        process_function,
+        4,
+        listings={"volumes": mocker.MagicMock(return_value=volumes)},
+        scoped=True,
+    )
+
+    # Failing in the green threads of the project, it is given up on as a whole
+    assert rv == []
+    os_client.connect_as.assert_called_once_with(trust_id=trust_id)
+    assert log.has("No effective rights on project", project=project_id)
+
+
+def test_create_snapshot_auth_error(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    volume = fixtures.FakeVolume(id=faker.uuid4(), status="in-use", metadata={})
+    os_client.block_storage.create_snapshot.side_effect = (
+        keystoneauth1.exceptions.HTTPClientError(http_status=403)
+    )
+
+    with pytest.raises(keystoneauth1.exceptions.HTTPClientError):
+        cinder_snapshooter.utils.create_snapshot(
+            os_client, volume, datetime.datetime(2021, 6, 22), 1
+        )
+    # Not retried
+    os_client.block_storage.create_snapshot.assert_called_once()
+
+
+@pytest.mark.parametrize("status", ["available", "creating", None])
+def test_adopt_snapshot(mocker, faker, log, status):
+    os_client = mocker.MagicMock()
+    volume = fixtures.FakeVolume(id=faker.uuid4(), status="in-use", metadata={})
+    snapshot = fixtures.FakeSnapshot(
+        id=faker.uuid4(),
+        status=status,
+        metadata={},
+        volume_id=volume.id,
+        created_at=faker.iso8601(),
+    )
+    if status is None:
+        os_client.block_storage.get_snapshot.side_effect = ResourceNotFound
+    else:
+        os_client.block_storage.get_snapshot.return_value = snapshot
+    tracker = mocker.MagicMock()
+
+    adopted = cinder_snapshooter.utils.adopt_snapshot(
+        os_client, volume, snapshot.id, 1, tracker=tracker
+    )
+
+    os_client.block_storage.get_snapshot.assert_called_once_with(snapshot.id)
+    if status is None:
+        assert adopted is None
+        assert log.has(
+            "Snapshot requested by the previous attempt is gone",
+            snapshot=snapshot.id,
+        )
+        return
+    if status == "available":
+        assert adopted == snapshot
+        tracker.wait.assert_not_called()
+    else:
+        assert adopted == tracker.wait.return_value
+        tracker.wait.assert_called_once_with(snapshot, None)
+    assert log.has("Adopted snapshot", volume=volume.id)
+
+
+def test_create_snapshot_journal(mocker, faker, log):
+    os_client = mocker.MagicMock()
+    volume = fixtures.FakeVolume(id=faker.uuid4(), status="in-use", metadata={})
+    snapshot = os_client.block_storage.create_snapshot.return_value
+    journal = mocker.MagicMock()
+    tracker = mocker.MagicMock()
+
+    def wait(requested, _key):
+        # Recorded before waiting for it to be available
+        journal.snapshot_requested.assert_called_once_with(
+            os_client.current_project_id, volume.id, snapshot.id
+        )
+        return requested
+
+    tracker.wait.side_effect = wait
+
+    assert (
+        cinder_snapshooter.utils.create_snapshot(
+            os_client,
+            volume,
+            datetime.datetime(2021, 6, 22),
+            1,
+            tracker=tracker,
+            journal=journal,
+        )
+        == snapshot
+    )
+    tracker.wait.assert_called_once()